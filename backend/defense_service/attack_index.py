@@ -0,0 +1,408 @@
+"""
+Known-attack fingerprint index.
+
+The same jailbreak strings arrive repeatedly from different clients and each one still costs a
+primary (often also a shadow) LLM call unless it trips inj_score >= 70. This index remembers payloads
+that were previously contained and short-circuits repeats before any LLM call:
+
+- exact: content hash of the policy ID and the normalized canonical text
+- fuzzy: 64-bit SimHash in a banded index (Hamming distance <= ATTACK_INDEX_MAX_DISTANCE), for
+  curated seed entries only
+
+Learned entries match exactly, never fuzzily: a benign prompt with a few injection markers appended
+scores as an injection, is contained and learned, and its SimHash sits a few bits from the clean
+prompt, so a fuzzy learned entry would contain every later sender of the clean prompt. Fuzzy
+matching is kept for the curated payloads in ATTACK_INDEX_SEED_PATH (JSONL lines {"text": ...,
+"policy_id": optional}; without policy_id a seed applies under every policy). Seeds are read at
+every start, never expire and are not written to the snapshot; removing one lasts until the next
+restart, so drop it from the seed file for good.
+
+Only contains that the input itself earned are learned (see the caller in main.py): a verdict that
+depended on a session's intent graph, the primary's output, a degraded heuristic or a campaign
+spike says nothing about the text under another policy. Entries are scoped to the policy they were
+learned under, expire ATTACK_INDEX_TTL seconds after they were (re)learned, can be removed with
+remove() (DELETE /attack-index/{id}), are evicted LRU beyond ATTACK_INDEX_MAX_ENTRIES, and are
+snapshotted to ATTACK_INDEX_PATH (hashes only, never the payload text) so they survive restarts.
+Every worker merges into the same snapshot, holding an exclusive flock on ATTACK_INDEX_PATH + ".lock"
+from read to replace so concurrent saves do not drop each other's entries. Removals are written to
+the snapshot as tombstones, so other workers drop the entry on their next save instead of writing
+it back.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; snapshots are then merged without a lock
+    fcntl = None
+
+from fingerprint import BandedSimHashIndex, content_hash, normalize_for_fingerprint, simhash64
+
+logger = logging.getLogger("shieldllm.defense.attack_index")
+
+ATTACK_INDEX_ENABLED = os.environ.get("ATTACK_INDEX_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+ATTACK_INDEX_MAX_ENTRIES = int(os.environ.get("ATTACK_INDEX_MAX_ENTRIES", "20000"))
+ATTACK_INDEX_MAX_DISTANCE = int(os.environ.get("ATTACK_INDEX_MAX_DISTANCE", "8"))
+# Fuzzy matching (seeds only) on very short texts is too coarse; they only match exactly
+ATTACK_INDEX_MIN_FUZZY_CHARS = int(os.environ.get("ATTACK_INDEX_MIN_FUZZY_CHARS", "40"))
+ATTACK_INDEX_MAX_LENGTH_RATIO = float(os.environ.get("ATTACK_INDEX_MAX_LENGTH_RATIO", "1.25"))
+ATTACK_INDEX_SAVE_INTERVAL = float(os.environ.get("ATTACK_INDEX_SAVE_INTERVAL", "30"))
+ATTACK_INDEX_TTL = float(os.environ.get("ATTACK_INDEX_TTL", str(7 * 24 * 3600)))
+ATTACK_INDEX_PATH = os.environ.get(
+    "ATTACK_INDEX_PATH", str(Path(__file__).resolve().parent / ".cache" / "attack_index.jsonl")
+).strip()
+ATTACK_INDEX_SEED_PATH = os.environ.get("ATTACK_INDEX_SEED_PATH", "").strip()
+
+# Scope of seeds that apply under every policy
+ANY_POLICY = "*"
+
+
+class AttackIndex:
+    def __init__(self, max_entries: int = ATTACK_INDEX_MAX_ENTRIES, max_distance: int = ATTACK_INDEX_MAX_DISTANCE,
+                 path: str = ATTACK_INDEX_PATH, seed_path: str = ATTACK_INDEX_SEED_PATH):
+        self.max_entries = max_entries
+        self.path = path
+        self.seed_path = seed_path
+        # Seeds only; learned entries are never fuzzy-indexed
+        self._fuzzy = BandedSimHashIndex(max_distance)
+        # entry id -> entry dict; id is derived from the policy ID and the content hash
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._seeds: Dict[str, Dict[str, Any]] = {}
+        # entry id -> removal time, until written to the snapshot as a tombstone
+        self._removed: Dict[str, float] = {}
+        self._dirty = False
+        self._seen_mtime = 0
+        self._save_task: Optional[asyncio.Task] = None
+        self.stats = {"lookups": 0, "exact_hits": 0, "fuzzy_hits": 0, "added": 0, "evictions": 0,
+                      "expired": 0, "removed": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._seeds)
+
+    @staticmethod
+    def _entry_id(policy_id: str, digest: str) -> str:
+        return "atk_" + hashlib.blake2b(f"{policy_id}:{digest}".encode("utf-8"), digest_size=6).hexdigest()
+
+    def _simhash_of(self, entry_id: str) -> Optional[int]:
+        seed = self._seeds.get(entry_id)
+        return seed["simhash"] if seed and seed["fuzzy"] else None
+
+    def _insert(self, entry: Dict[str, Any]) -> None:
+        self._entries[entry["id"]] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _drop(self, entry_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            entry = self._seeds.pop(entry_id, None)
+            if entry is not None and entry["fuzzy"]:
+                self._fuzzy.remove(entry["policy_id"], entry["simhash"], entry_id)
+        return entry
+
+    def _live(self, entry: Optional[Dict[str, Any]], now: float) -> Optional[Dict[str, Any]]:
+        """entry, or None (and dropped) once past its TTL."""
+        if entry is not None and entry["expires"] <= now:
+            self._drop(entry["id"])
+            self.stats["expired"] += 1
+            self._dirty = True
+            return None
+        return entry
+
+    def _nearest_seed(self, policy_id: str, normalized: str) -> Optional[Tuple[Dict[str, Any], int]]:
+        fp = simhash64(normalized)
+        best = None
+        for scope in (policy_id, ANY_POLICY):
+            found = self._fuzzy.nearest(scope, fp, self._simhash_of)
+            if found is not None and (best is None or found[1] < best[1]):
+                best = found
+        if best is None:
+            return None
+        seed = self._seeds[best[0]]
+        longer, shorter = max(seed["length"], len(normalized)), max(1, min(seed["length"], len(normalized)))
+        return (seed, best[1]) if longer / shorter <= ATTACK_INDEX_MAX_LENGTH_RATIO else None
+
+    def match(self, canonical_text: str, policy_id: str) -> Optional[Dict[str, Any]]:
+        """Return {"id", "match": "exact"|"fuzzy", "distance"} for a payload known under policy_id, else None."""
+        normalized = normalize_for_fingerprint(canonical_text)
+        if not normalized or not (self._entries or self._seeds):
+            return None
+        self.stats["lookups"] += 1
+        now = time.time()
+        digest = content_hash(normalized)
+        entry_id = self._entry_id(policy_id, digest)
+        entry = self._live(self._entries.get(entry_id), now)
+        if entry is None:
+            entry = self._seeds.get(entry_id) or self._seeds.get(self._entry_id(ANY_POLICY, digest))
+        result = None
+        if entry is not None:
+            self.stats["exact_hits"] += 1
+            result = {"id": entry["id"], "match": "exact", "distance": 0}
+        elif self._seeds and len(normalized) >= ATTACK_INDEX_MIN_FUZZY_CHARS:
+            found = self._nearest_seed(policy_id, normalized)
+            if found is not None:
+                entry = found[0]
+                self.stats["fuzzy_hits"] += 1
+                result = {"id": entry["id"], "match": "fuzzy", "distance": found[1]}
+        if result is not None:
+            entry["hits"] += 1
+            entry["last_seen"] = now
+            if entry["id"] in self._entries:
+                self._entries.move_to_end(entry["id"])
+                self._dirty = True
+        return result
+
+    def add(self, canonical_text: str, policy_id: str, source: str = "contain") -> Optional[str]:
+        """Record a payload contained under policy_id (exact matches only); re-adding renews its TTL.
+        Returns its entry id."""
+        normalized = normalize_for_fingerprint(canonical_text)
+        if not normalized:
+            return None
+        entry_id = self._entry_id(policy_id, content_hash(normalized))
+        now = time.time()
+        self._removed.pop(entry_id, None)
+        entry = self._entries.get(entry_id)
+        if entry is not None:
+            entry["added"] = now
+            entry["expires"] = now + ATTACK_INDEX_TTL
+            self._entries.move_to_end(entry_id)
+            self._dirty = True
+            return entry_id
+        self._insert({
+            "id": entry_id,
+            "policy_id": policy_id,
+            "length": len(normalized),
+            "source": source,
+            "hits": 0,
+            "first_seen": now,
+            "last_seen": now,
+            "added": now,
+            "expires": now + ATTACK_INDEX_TTL,
+        })
+        self.stats["added"] += 1
+        self._dirty = True
+        return entry_id
+
+    def seed(self, canonical_text: str, policy_id: str = ANY_POLICY) -> Optional[str]:
+        """Add a curated payload; seeds also match near-duplicates. Returns its entry id."""
+        normalized = normalize_for_fingerprint(canonical_text)
+        if not normalized:
+            return None
+        entry_id = self._entry_id(policy_id, content_hash(normalized))
+        if entry_id in self._seeds:
+            return entry_id
+        now = time.time()
+        fuzzy = len(normalized) >= ATTACK_INDEX_MIN_FUZZY_CHARS
+        self._seeds[entry_id] = {
+            "id": entry_id,
+            "policy_id": policy_id,
+            "simhash": simhash64(normalized) if fuzzy else 0,
+            "fuzzy": fuzzy,
+            "length": len(normalized),
+            "source": "seed",
+            "hits": 0,
+            "first_seen": now,
+            "last_seen": now,
+            "added": now,
+        }
+        if fuzzy:
+            self._fuzzy.add(policy_id, self._seeds[entry_id]["simhash"], entry_id)
+        return entry_id
+
+    def remove(self, entry_id: str) -> bool:
+        """Forget an entry (a false positive) here and, via the snapshot, in other workers."""
+        self._removed[entry_id] = time.time()
+        self._dirty = True
+        if self._drop(entry_id) is None:
+            return False
+        self.stats["removed"] += 1
+        return True
+
+    def list(self, policy_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Most recently seen entries first (hashes and counters only); seeds have expires None."""
+        now = time.time()
+        entries = [e for e in self._entries.values() if e["expires"] > now]
+        entries.extend(self._seeds.values())
+        entries = [e for e in entries if policy_id is None or e["policy_id"] in (policy_id, ANY_POLICY)]
+        entries.sort(key=lambda e: e["last_seen"], reverse=True)
+        return [{**{k: e[k] for k in ("id", "policy_id", "source", "hits", "first_seen", "last_seen")},
+                 "expires": e.get("expires")} for e in entries[:limit]]
+
+    # --- persistence ---
+
+    def load_seeds(self) -> int:
+        if not self.seed_path:
+            return 0
+        loaded = 0
+        try:
+            with open(self.seed_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    record = json.loads(line)
+                    if self.seed(record["text"], record.get("policy_id") or ANY_POLICY):
+                        loaded += 1
+        except Exception as e:
+            logger.warning("Attack index seed load failed (%s): %s", self.seed_path, e)
+        return loaded
+
+    @staticmethod
+    def _read_snapshot(path: str) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, float]]:
+        """(entries, tombstones: id -> removal time) from a snapshot file."""
+        entries: Dict[str, Dict[str, Any]] = {}
+        tombstones: Dict[str, float] = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if "removed" in record:
+                    tombstones[record["id"]] = record["removed"]
+                elif "policy_id" in record and "expires" in record:
+                    # Unscoped entries from older snapshots are not reloaded
+                    entries[record["id"]] = record
+        return entries, tombstones
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        loaded = 0
+        now = time.time()
+        try:
+            entries, tombstones = self._read_snapshot(self.path)
+            for entry in sorted(entries.values(), key=lambda e: e["last_seen"]):
+                if entry["expires"] > now and entry["added"] > tombstones.get(entry["id"], 0):
+                    self._insert(entry)
+                    loaded += 1
+        except Exception as e:
+            logger.warning("Attack index load failed (%s): %s", self.path, e)
+        self._seen_mtime = self._snapshot_mtime()
+        return loaded
+
+    @contextmanager
+    def _snapshot_lock(self) -> Iterator[None]:
+        """Exclusive across processes for the whole read-merge-replace of the snapshot."""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write_snapshot(self, entries: List[Dict[str, Any]], removed: Dict[str, float]) -> Dict[str, float]:
+        """Merge with the file on disk (other workers write it too), keep the most recent live entries.
+        Returns the tombstones, so entries removed by another worker are dropped here too."""
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._snapshot_lock():
+            merged: Dict[str, Dict[str, Any]] = {}
+            tombstones: Dict[str, float] = {}
+            if os.path.exists(self.path):
+                merged, tombstones = self._read_snapshot(self.path)
+            for entry in entries:
+                merged[entry["id"]] = entry
+            for entry_id, ts in removed.items():
+                tombstones[entry_id] = max(ts, tombstones.get(entry_id, 0))
+            now = time.time()
+            # A tombstone only has to outlive the entries it covers
+            tombstones = {k: ts for k, ts in tombstones.items() if ts > now - ATTACK_INDEX_TTL}
+            live = [e for e in merged.values() if e["expires"] > now and e["added"] > tombstones.get(e["id"], 0)]
+            kept = sorted(live, key=lambda e: e["last_seen"])[-self.max_entries:]
+            tmp = f"{self.path}.tmp.{os.getpid()}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for entry in kept:
+                    f.write(json.dumps(entry, separators=(",", ":")))
+                    f.write("\n")
+                for entry_id, ts in tombstones.items():
+                    f.write(json.dumps({"id": entry_id, "removed": ts}, separators=(",", ":")))
+                    f.write("\n")
+            os.replace(tmp, self.path)
+        return tombstones
+
+    def _apply_tombstones(self, tombstones: Dict[str, float]) -> None:
+        for entry_id, ts in tombstones.items():
+            entry = self._entries.get(entry_id) or self._seeds.get(entry_id)
+            if entry is not None and entry["added"] <= ts:
+                self._drop(entry_id)
+                self.stats["removed"] += 1
+
+    def _snapshot_mtime(self) -> int:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return 0
+
+    async def save(self) -> None:
+        if not self.path:
+            return
+        if not self._dirty:
+            # Nothing to write; still pick up removals another worker wrote since we last looked
+            mtime = self._snapshot_mtime()
+            if mtime and mtime != self._seen_mtime:
+                self._seen_mtime = mtime
+                try:
+                    _, tombstones = await asyncio.to_thread(self._read_snapshot, self.path)
+                except Exception as e:
+                    logger.warning("Attack index reload failed (%s): %s", self.path, e)
+                    return
+                self._apply_tombstones(tombstones)
+            return
+        self._dirty = False
+        snapshot = [dict(e) for e in self._entries.values()]
+        removed = dict(self._removed)
+        try:
+            tombstones = await asyncio.to_thread(self._write_snapshot, snapshot, removed)
+        except Exception as e:
+            self._dirty = True
+            logger.warning("Attack index save failed (%s): %s", self.path, e)
+            return
+        self._seen_mtime = self._snapshot_mtime()
+        for entry_id, ts in removed.items():
+            if self._removed.get(entry_id) == ts:
+                del self._removed[entry_id]
+        self._apply_tombstones(tombstones)
+
+    async def _save_loop(self) -> None:
+        while True:
+            await asyncio.sleep(ATTACK_INDEX_SAVE_INTERVAL)
+            await self.save()
+
+    def start(self) -> None:
+        loaded = self.load()
+        if loaded:
+            logger.info("Attack index: loaded %d entries from %s", loaded, self.path)
+        seeded = self.load_seeds()
+        if seeded:
+            logger.info("Attack index: loaded %d seeds from %s", seeded, self.seed_path)
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.get_running_loop().create_task(self._save_loop(), name="attack-index-save")
+
+    async def stop(self) -> None:
+        if self._save_task is not None:
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._save_task = None
+        await self.save()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "enabled": ATTACK_INDEX_ENABLED, "entries": len(self._entries),
+                "seeds": len(self._seeds), "ttl_s": ATTACK_INDEX_TTL}
+
+
+attack_index = AttackIndex()
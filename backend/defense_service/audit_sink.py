@@ -0,0 +1,277 @@
+"""
+Write-behind audit sink for turn verdicts.
+
+The service kept no record of its own verdicts beyond the analyze.completed log line; audits relied
+on the node layer writing Turn documents one at a time. AuditSink.record() builds a small dict per
+turn (verdict, signals, scores, latencies; input text only with AUDIT_INCLUDE_TEXT) and puts it on a
+bounded asyncio queue without awaiting. A single writer task collects up to AUDIT_BATCH_SIZE records
+or AUDIT_FLUSH_MS worth, and writes the batch from a worker thread to the configured backend:
+
+- AUDIT_SINK=jsonl: gzip-compressed JSON lines (one gzip member per batch) at AUDIT_PATH, rotated to
+  a timestamped file at AUDIT_MAX_BYTES, keeping AUDIT_BACKUPS rotated files;
+- AUDIT_SINK=mongodb: insert_many(ordered=False) into AUDIT_MONGO_COLLECTION (AUDIT_MONGO_URI,
+  default MONGODB_URI);
+- unset: disabled, record() returns immediately.
+
+Backpressure (AUDIT_BACKPRESSURE) when the queue is full: drop_newest (default) discards the new
+record, drop_oldest evicts the oldest queued one. A failed batch is retried AUDIT_RETRIES times with
+backoff, then dropped and counted. stop() drains and flushes the queue (bounded by
+AUDIT_SHUTDOWN_TIMEOUT_S) from the app lifespan.
+"""
+import asyncio
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from event_log import log_event
+
+AUDIT_SINK = os.environ.get("AUDIT_SINK", "").strip().lower()
+AUDIT_QUEUE_MAX = int(os.environ.get("AUDIT_QUEUE_MAX", "10000"))
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_MS = float(os.environ.get("AUDIT_FLUSH_MS", "1000"))
+AUDIT_BACKPRESSURE = os.environ.get("AUDIT_BACKPRESSURE", "drop_newest").strip().lower()
+AUDIT_RETRIES = int(os.environ.get("AUDIT_RETRIES", "3"))
+AUDIT_SHUTDOWN_TIMEOUT_S = float(os.environ.get("AUDIT_SHUTDOWN_TIMEOUT_S", "10"))
+AUDIT_INCLUDE_TEXT = os.environ.get("AUDIT_INCLUDE_TEXT", "false").lower() == "true"
+AUDIT_TEXT_MAX_CHARS = int(os.environ.get("AUDIT_TEXT_MAX_CHARS", "2000"))
+AUDIT_PATH = os.environ.get("AUDIT_PATH", str(Path(__file__).resolve().parent / ".cache" / "audit" / "turns.jsonl.gz"))
+AUDIT_MAX_BYTES = int(os.environ.get("AUDIT_MAX_BYTES", str(50 * 1024 * 1024)))
+AUDIT_BACKUPS = int(os.environ.get("AUDIT_BACKUPS", "10"))
+AUDIT_MONGO_URI = os.environ.get("AUDIT_MONGO_URI") or os.environ.get("MONGODB_URI", "")
+AUDIT_MONGO_DB = os.environ.get("AUDIT_MONGO_DB", "shieldllm")
+AUDIT_MONGO_COLLECTION = os.environ.get("AUDIT_MONGO_COLLECTION", "defense_audit")
+
+
+class JsonlAuditBackend:
+    """Gzip-compressed JSON lines with size-based rotation."""
+
+    def __init__(self, path: str = AUDIT_PATH, max_bytes: int = AUDIT_MAX_BYTES, backups: int = AUDIT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        stem = path[:-len(".jsonl.gz")] if path.endswith(".jsonl.gz") else path
+        self._rotated = stem + ".{}.jsonl.gz"
+
+    def write(self, records: List[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(r, separators=(",", ":"), default=str) + "\n" for r in records).encode("utf-8")
+        # Concatenated gzip members are one valid gzip stream (zcat / gzip.open read them all)
+        with open(self.path, "ab") as f:
+            f.write(gzip.compress(data, compresslevel=6))
+            size = f.tell()
+        if size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        now = time.time()
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f"{int(now * 1000) % 1000:03d}"
+        os.replace(self.path, self._rotated.format(stamp))
+        for old in sorted(glob.glob(self._rotated.format("*")))[:-self.backups or None]:
+            os.remove(old)
+
+    def close(self) -> None:
+        pass
+
+
+class MongoAuditBackend:
+    """insert_many into a MongoDB collection; records get a created_at date for TTL indexes."""
+
+    def __init__(self, uri: str = AUDIT_MONGO_URI, database: str = AUDIT_MONGO_DB,
+                 collection: str = AUDIT_MONGO_COLLECTION):
+        from pymongo import MongoClient  # only needed for AUDIT_SINK=mongodb
+
+        if not uri:
+            raise ValueError("AUDIT_SINK=mongodb needs AUDIT_MONGO_URI or MONGODB_URI")
+        self._client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+        self._collection = self._client.get_default_database(default=database)[collection]
+
+    def write(self, records: List[Dict[str, Any]]) -> None:
+        # insert_many adds _id to the documents it is given; send copies
+        docs = [{**r, "created_at": datetime.fromtimestamp(r["ts"], timezone.utc)} for r in records]
+        self._collection.insert_many(docs, ordered=False)
+
+    def close(self) -> None:
+        self._client.close()
+
+
+BACKENDS: Dict[str, Callable[[], Any]] = {"jsonl": JsonlAuditBackend, "mongodb": MongoAuditBackend}
+
+
+def _clip(text: Optional[str]) -> Optional[str]:
+    if text is None or len(text) <= AUDIT_TEXT_MAX_CHARS:
+        return text
+    return text[:AUDIT_TEXT_MAX_CHARS]
+
+
+def turn_record(values: Dict[str, Any], user_text: str, req_id: str, client_id: str, session_id: Optional[str],
+                defense_mode: str, source: str) -> Dict[str, Any]:
+    """Audit record for one analyzed turn, from the pipeline's plain values."""
+    log = values.get("log") or {}
+    record = {
+        "ts": round(time.time(), 3),
+        "request_id": req_id,
+        "session_id": session_id,
+        "client_id": client_id,
+        "source": source,
+        "defense_mode": defense_mode,
+        "policy_id": log.get("policy_id"),
+        "status": values.get("status"),
+        "action": values.get("action"),
+        "risk_level": values.get("risk_level"),
+        "risk_score": log.get("risk_score"),
+        "divergence_score": values.get("divergence_score"),
+        "signals": list(values.get("signals") or []),
+        "llm_called": values.get("llm_called"),
+        "primary_ok": values.get("primary_ok"),
+        "shadow_ok": values.get("shadow_ok"),
+        "provider": values.get("provider"),
+        "model": values.get("model"),
+        "circuit_state": log.get("circuit_state"),
+        "latency_ms": {
+            "llm": values.get("llm_latency_ms"),
+            "preprocessing": values.get("preprocessing_latency_ms"),
+            "total": values.get("total_latency_ms"),
+        },
+        "input_chars": len(user_text),
+        "input_sha256": hashlib.sha256(user_text.encode("utf-8", "surrogatepass")).hexdigest(),
+    }
+    if AUDIT_INCLUDE_TEXT:
+        record["user_input"] = _clip(user_text)
+        record["final_answer"] = _clip(values.get("final_answer"))
+    return record
+
+
+class AuditSink:
+    def __init__(self, sink: str = AUDIT_SINK):
+        self.sink = sink
+        self._backend = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+        self._stop_waiter: Optional[asyncio.Future] = None
+        self.stats = {"enqueued": 0, "dropped": 0, "evicted": 0, "written": 0, "batches": 0,
+                      "failed": 0, "retries": 0, "last_flush_ms": 0.0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._queue is not None
+
+    def start(self) -> None:
+        """Build the backend and start the writer task (no-op when AUDIT_SINK is unset)."""
+        if not self.sink or self._task is not None:
+            return
+        try:
+            self._backend = BACKENDS[self.sink]()
+        except Exception as e:
+            log_event("audit.disabled", logging.ERROR, sink=self.sink, error=str(e))
+            return
+        self._stop = asyncio.Event()
+        self._stop_waiter = asyncio.ensure_future(self._stop.wait())
+        self._queue = asyncio.Queue(maxsize=AUDIT_QUEUE_MAX)
+        self._task = asyncio.create_task(self._run())
+
+    def record(self, record: Dict[str, Any]) -> None:
+        """Queue one record; never waits."""
+        q = self._queue
+        if q is None or self._stop.is_set():
+            return
+        try:
+            q.put_nowait(record)
+        except asyncio.QueueFull:
+            if AUDIT_BACKPRESSURE != "drop_oldest":
+                self.stats["dropped"] += 1
+                return
+            q.get_nowait()
+            q.put_nowait(record)
+            self.stats["evicted"] += 1
+        self.stats["enqueued"] += 1
+
+    async def _get(self, timeout: Optional[float]) -> Optional[Dict[str, Any]]:
+        """Next record, or None after timeout or once stop() is called."""
+        getter = asyncio.ensure_future(self._queue.get())
+        done, _ = await asyncio.wait({getter, self._stop_waiter}, timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if getter in done:
+            return getter.result()
+        getter.cancel()
+        return None
+
+    async def _next_batch(self) -> List[Dict[str, Any]]:
+        """Up to AUDIT_BATCH_SIZE records, waiting at most AUDIT_FLUSH_MS after the first one."""
+        q = self._queue
+        loop = asyncio.get_running_loop()
+        batch: List[Dict[str, Any]] = []
+        deadline = 0.0
+        while len(batch) < AUDIT_BATCH_SIZE:
+            try:
+                batch.append(q.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            if self._stop.is_set():
+                break
+            if not batch:
+                record = await self._get(None)
+                deadline = loop.time() + AUDIT_FLUSH_MS / 1000
+            else:
+                remaining = deadline - loop.time()
+                record = await self._get(remaining) if remaining > 0 else None
+            if record is None:
+                break
+            batch.append(record)
+        return batch
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        for attempt in range(AUDIT_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._backend.write, batch)
+            except Exception as e:
+                if attempt == AUDIT_RETRIES:
+                    self.stats["failed"] += len(batch)
+                    log_event("audit.flush_failed", logging.ERROR, sink=self.sink, records=len(batch), error=str(e))
+                    return
+                self.stats["retries"] += 1
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 10.0))
+                continue
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["last_flush_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            return
+
+    async def _run(self) -> None:
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+
+    async def stop(self) -> None:
+        """Flush everything queued, then close the backend (app shutdown)."""
+        if self._task is None:
+            return
+        self._stop.set()
+        try:
+            await asyncio.wait_for(self._task, AUDIT_SHUTDOWN_TIMEOUT_S)
+        except (asyncio.TimeoutError, TimeoutError):
+            log_event("audit.shutdown_timeout", logging.WARNING, pending=self._queue.qsize())
+        await asyncio.to_thread(self._backend.close)
+        self._task, self._queue, self._backend = None, None, None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "sink": self.sink or None,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "queue_max": AUDIT_QUEUE_MAX,
+            "backpressure": AUDIT_BACKPRESSURE,
+        }
+
+
+audit_sink = AuditSink()
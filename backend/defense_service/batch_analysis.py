@@ -0,0 +1,148 @@
+"""
+Batch analysis for red-team regressions, evaluation runs and backfills (POST /analyze/batch).
+
+One /analyze round-trip per turn, under the per-client limit of RATE_LIMIT_RPM, turns a 10k-prompt
+evaluation into hours. A batch request carries many turns and is authenticated with BATCH_API_KEY
+(X-Batch-Key header) instead of being rate limited per client. stream_batch():
+
+- canonicalizes and sanitizes turns in chunks of BATCH_PREPROCESS_CHUNK with one detector call per
+  chunk (duplicate texts are processed once), prepared on demand so the first results are not held
+  back by the last chunk;
+- runs the rest of the pipeline with at most BATCH_CONCURRENCY turns in flight; turns that share a
+  sessionId run in input order so multi-turn history matches a sequential run;
+- yields one NDJSON line per turn in completion order, tagged with its input index, then a summary.
+"""
+import asyncio
+import hmac
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from canonicalize import progressive_canonicalize
+from detector_exec import detectors
+from response_shapes import encode
+from sanitize import sanitize_input
+
+BATCH_API_KEY = os.environ.get("BATCH_API_KEY", "").strip()
+BATCH_MAX_TURNS = int(os.environ.get("BATCH_MAX_TURNS", "10000"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "16"))
+BATCH_PREPROCESS_CHUNK = int(os.environ.get("BATCH_PREPROCESS_CHUNK", "256"))
+
+# (canonical_text, canonical_signals), sanitized_text
+Preprocessed = Tuple[Tuple[str, List[str]], str]
+
+stats = {"batches": 0, "turns": 0, "errors": 0, "preprocess_chunks": 0, "preprocess_dedup_hits": 0}
+
+
+def batch_key_valid(key: Optional[str]) -> bool:
+    """Constant-time check of X-Batch-Key; batch analysis is disabled while BATCH_API_KEY is unset."""
+    if not BATCH_API_KEY or not key:
+        return False
+    return hmac.compare_digest(key.encode("utf-8"), BATCH_API_KEY.encode("utf-8"))
+
+
+def preprocess_batch(texts: Sequence[str], max_chars: int) -> List[Optional[Preprocessed]]:
+    """Canonicalize and sanitize a chunk of inputs in one call (picklable for the detector process pool).
+
+    Over-long inputs are skipped (None); the pipeline rejects them before using the result.
+    """
+    seen: Dict[str, Preprocessed] = {}
+    out: List[Optional[Preprocessed]] = []
+    for text in texts:
+        if len(text) > max_chars:
+            out.append(None)
+            continue
+        result = seen.get(text)
+        if result is None:
+            result = (progressive_canonicalize(text), sanitize_input(text))
+            seen[text] = result
+        out.append(result)
+    return out
+
+
+def _chains(session_ids: Sequence[Optional[str]]) -> List[List[int]]:
+    """Group indexes into chains that must run sequentially (same sessionId), in input order."""
+    chains: List[List[int]] = []
+    by_session: Dict[str, List[int]] = {}
+    for index, session_id in enumerate(session_ids):
+        if not session_id:
+            chains.append([index])
+        elif session_id in by_session:
+            by_session[session_id].append(index)
+        else:
+            by_session[session_id] = [index]
+            chains.append(by_session[session_id])
+    return chains
+
+
+def _line(payload: Dict[str, Any]) -> bytes:
+    return encode(payload) + b"\n"
+
+
+async def stream_batch(
+    texts: Sequence[str],
+    session_ids: Sequence[Optional[str]],
+    run_turn: Callable[[int, Optional[Preprocessed]], Awaitable[Tuple[int, Dict[str, Any]]]],
+    max_chars: int,
+    concurrency: int = BATCH_CONCURRENCY,
+) -> AsyncIterator[bytes]:
+    """Yield NDJSON lines {"index", "status", "result" | "error"} as turns finish, then {"done": true, ...}.
+
+    run_turn(index, preprocessed) returns (http_status, body) and must not raise.
+    """
+    stats["batches"] += 1
+    start = time.perf_counter()
+    chunk_size = max(1, BATCH_PREPROCESS_CHUNK)
+    chunks: Dict[int, asyncio.Future] = {}
+
+    async def preprocessed(index: int) -> Optional[Preprocessed]:
+        chunk = index // chunk_size
+        if chunk not in chunks:
+            part = list(texts[chunk * chunk_size:(chunk + 1) * chunk_size])
+            stats["preprocess_chunks"] += 1
+            stats["preprocess_dedup_hits"] += len(part) - len(set(part))
+            chunks[chunk] = asyncio.ensure_future(
+                detectors.run(preprocess_batch, part, max_chars, size=sum(map(len, part)), heavy=True)
+            )
+        return (await chunks[chunk])[index % chunk_size]
+
+    results: "asyncio.Queue[Tuple[bool, bytes]]" = asyncio.Queue()
+    pending = iter(_chains(session_ids))
+
+    async def worker() -> None:
+        for chain in pending:
+            for index in chain:
+                try:
+                    status, body = await run_turn(index, await preprocessed(index))
+                except Exception as e:
+                    status, body = 500, {"status": "error", "message": f"Batch turn failed: {type(e).__name__}"}
+                ok = status < 400
+                stats["turns"] += 1
+                if not ok:
+                    stats["errors"] += 1
+                await results.put((ok, _line({"index": index, "status": status, "result" if ok else "error": body})))
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(texts))))]
+    errors = 0
+    try:
+        for _ in range(len(texts)):
+            ok, line = await results.get()
+            errors += not ok
+            yield line
+        yield _line({
+            "done": True,
+            "count": len(texts),
+            "errors": errors,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+        })
+    finally:
+        # Client went away (or we finished): stop remaining turns
+        for task in workers:
+            task.cancel()
+        for future in chunks.values():
+            future.cancel()
+        await asyncio.gather(*workers, *chunks.values(), return_exceptions=True)
+
+
+def get_stats() -> Dict[str, Any]:
+    return {**stats, "enabled": bool(BATCH_API_KEY), "max_turns": BATCH_MAX_TURNS, "concurrency": BATCH_CONCURRENCY}
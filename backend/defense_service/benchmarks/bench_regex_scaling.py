@@ -0,0 +1,147 @@
+"""
+Worst-case scan time of every registered rule against input size, up to INPUT_MAX_CHARS.
+
+Usage (from backend/defense_service):
+    python benchmarks/bench_regex_scaling.py [--sizes 2500,5000,10000,20000] [--max-exponent 1.3]
+        [--pattern REGEX ...]
+
+For each rule, adversarial inputs are generated from its parsed form: a witness of the pattern
+without its last required element repeated to size (every start position matches a prefix, then
+fails), the same separated by spaces, and for each unbounded quantifier a run of its characters after
+a witness of everything before it. Each input is scanned to exhaustion (finditer, as sub/findall do).
+The growth exponent is the log-log slope of time between the smallest and largest size; 1.0 is linear.
+Exits 1 if a rule exceeds --max-exponent. --pattern measures extra patterns (e.g. a rejected one) and
+prints safe_regex.analyze() for them.
+"""
+import argparse
+import math
+import os
+import re
+import sys
+import time
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402,F401  (registers the weapon_output rules)
+import canonicalize  # noqa: E402,F401
+import divergence  # noqa: E402,F401
+import sanitize  # noqa: E402,F401
+from safe_regex import RULESETS, _REPEATS, _can_be_empty, _children, _is_unbounded, _sre, _sre_parse, analyze, atom_chars, chars_of  # noqa: E402
+from settings import settings  # noqa: E402
+
+_PREFERRED = "ax 0"
+_NOISE_FLOOR_MS = 0.05
+
+
+def _pick(chars) -> str:
+    for c in _PREFERRED:
+        if c in chars:
+            return c
+    return min(chars) if chars else "a"
+
+
+def _witness(seq, ignorecase: bool) -> str:
+    """A short string matched by seq."""
+    out = []
+    for op, av in seq:
+        atom = atom_chars(op, av, ignorecase)
+        if atom is not None:
+            out.append(_pick(atom))
+        elif op in _REPEATS:
+            out.append(_witness(av[2], ignorecase) * max(av[0], 1))
+        elif op is _sre.BRANCH:
+            out.append(_witness(av[1][0], ignorecase))
+        elif op is _sre.SUBPATTERN:
+            out.append(_witness(av[3], ignorecase))
+    return "".join(out)
+
+
+def _strip_required_tail(items: list) -> list:
+    """items without the last element that a match requires."""
+    for i in range(len(items) - 1, -1, -1):
+        if not _can_be_empty([items[i]]):
+            return items[:i]
+    return items[:-1]
+
+
+def _runs(items: list, ignorecase: bool) -> List[Tuple[str, str]]:
+    """(prefix witness, run character) for every unbounded quantifier, top level and nested."""
+    out = []
+    for i, (op, av) in enumerate(items):
+        if _is_unbounded(op, av):
+            run = chars_of(av[2], ignorecase)
+            out.append((_witness(items[:i], ignorecase), _pick(run)))
+            # Also a run character outside the preferred ones (e.g. not the suffix's first character)
+            others = sorted(run - set(_PREFERRED))
+            if others:
+                out.append((_witness(items[:i], ignorecase), others[0]))
+        for child in _children(op, av):
+            prefix = _witness(items[:i], ignorecase)
+            out.extend((prefix + p, c) for p, c in _runs(child, ignorecase))
+    return out
+
+
+def adversarial_inputs(pattern: str, flags: int, size: int) -> Dict[str, str]:
+    parsed = _sre_parse.parse(pattern, flags)
+    ignorecase = bool(flags & re.IGNORECASE)
+    items = list(parsed)
+    partial = _witness(_strip_required_tail(items), ignorecase) or _witness(items, ignorecase)[:-1] or "a"
+    inputs = {
+        "partial_repeat": (partial * (size // len(partial) + 1))[:size],
+        "partial_spaced": ((partial + " ") * (size // (len(partial) + 1) + 1))[:size],
+    }
+    for n, (prefix, c) in enumerate(_runs(items, ignorecase)):
+        inputs[f"run{n}:{c!r}"] = (prefix + c * size)[:size]
+    return inputs
+
+
+def _scan_ms(compiled, text: str, repeats: int = 3) -> float:
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _m in compiled.finditer(text):
+            pass
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def measure(pattern: str, flags: int, sizes: List[int]) -> Tuple[str, List[float], float]:
+    """Worst input family: (name, time per size in ms, growth exponent)."""
+    compiled = re.compile(pattern, flags)
+    results = []
+    for family in adversarial_inputs(pattern, flags, sizes[0]):
+        times = [_scan_ms(compiled, adversarial_inputs(pattern, flags, n)[family]) for n in sizes]
+        # Below the noise floor the slope is timer jitter
+        exponent = 1.0 if times[-1] < _NOISE_FLOOR_MS else math.log(times[-1] / max(times[0], 1e-6)) / math.log(sizes[-1] / sizes[0])
+        results.append((family, times, exponent))
+    return max(results, key=lambda r: (r[2], r[1][-1]))
+
+
+def run() -> None:
+    top = settings.input_max_chars
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=",".join(str(top // d) for d in (8, 4, 2, 1)))
+    parser.add_argument("--max-exponent", type=float, default=1.3)
+    parser.add_argument("--pattern", action="append", default=[], help="extra pattern (IGNORECASE) to measure")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    rows = [(rs.name, rule.pattern, rs.flags) for rs in RULESETS.values() for rule in rs.rules]
+    rows += [("extra", p, re.IGNORECASE) for p in args.pattern]
+    failed = 0
+    print(f"sizes: {sizes} chars; growth exponent 1.0 = linear (max {args.max_exponent})\n")
+    print(f"{'rule set':<22} {'exp':>5} {'ms @ max':>9}  {'worst input':<18} pattern")
+    for name, pattern, flags in rows:
+        family, times, exponent = measure(pattern, flags, sizes)
+        bad = exponent > args.max_exponent
+        failed += bad
+        print(f"{name:<22} {exponent:>5.2f} {times[-1]:>9.3f}  {family:<18} {pattern}{'  <-- SUPER-LINEAR' if bad else ''}")
+        if name == "extra":
+            print(f"{'':<22} analyze(): {analyze(pattern, flags) or 'no risks'}")
+    print(f"\n{len(rows) - failed}/{len(rows)} rules scale linearly")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    run()
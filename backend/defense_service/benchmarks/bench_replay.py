@@ -0,0 +1,229 @@
+"""
+Replay a JSONL corpus of turns straight through main._analyze_turn_impl with fake LLM backends.
+
+Usage (from backend/defense_service):
+    python benchmarks/bench_replay.py [--corpus benchmarks/corpus/turns.jsonl] [--backend instant]
+        [--iterations 20] [--warmup 1] [--concurrency 1] [--alloc-turns 200]
+        [--out results.json] [--baseline previous.json]
+
+Corpus lines: {"category": "...", "userText": "...", "sessionId": optional, "intentGraph"/"policy"/
+"defenseMode": optional}. Turns sharing a sessionId replay in order within each iteration (session IDs
+are suffixed per iteration so history does not grow across iterations).
+
+Reports throughput, p50/p95/p99 per pipeline stage and per category, and allocation per turn from a
+separate tracemalloc pass (peak and retained bytes). --out writes the results as JSON; --baseline
+prints the change against an earlier result file. Warmup iterations prime the detector cost models,
+attack index and campaign sketch and are not measured.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Dict, List
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Keep the replay in memory and quiet; must be set before main (and its modules) are imported
+os.environ.setdefault("SESSION_STORE", "memory")
+os.environ.setdefault("CIRCUIT_STATE_PATH", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+
+import main  # noqa: E402
+from fake_backends import BACKENDS, load_backend  # noqa: E402
+from telemetry import StageTimer  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "turns.jsonl")
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pct(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {"n": len(ordered), "mean": round(sum(ordered) / len(ordered), 4),
+            "p50": round(pct(50), 4), "p95": round(pct(95), 4), "p99": round(pct(99), 4)}
+
+
+def _load_corpus(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _request(row: Dict[str, Any], iteration: int) -> "main.TurnRequest":
+    session_id = row.get("sessionId")
+    return main.TurnRequest(
+        userText=row["userText"],
+        intentGraph=row.get("intentGraph", {}),
+        defenseMode=row.get("defenseMode", "active"),
+        policy=row.get("policy", {}),
+        sessionId=f"{session_id}#{iteration}" if session_id else None,
+    )
+
+
+async def _turn(row: Dict[str, Any], iteration: int, index: int) -> Dict[str, Any]:
+    timer = StageTimer()
+    start = time.perf_counter()
+    values = await main._analyze_turn_impl(_request(row, iteration), f"bench-{iteration}-{index}", "bench", start, timer)
+    build_start = time.perf_counter()
+    if isinstance(values, dict):
+        main._full_response(values)
+    timer.since("response_build", build_start)
+    total = time.perf_counter() - start
+    action = values["action"] if isinstance(values, dict) else "error"
+    return {"category": row.get("category", "uncategorized"), "durations": dict(timer.durations),
+            "total": total, "action": action}
+
+
+async def _iteration(corpus: List[Dict[str, Any]], iteration: int, concurrency: int) -> List[Dict[str, Any]]:
+    # Chains: turns of one session run in order; independent turns may overlap up to concurrency
+    chains: Dict[Any, List[int]] = defaultdict(list)
+    for i, row in enumerate(corpus):
+        chains[row.get("sessionId") or f"__single_{i}"].append(i)
+    slots = asyncio.Semaphore(max(1, concurrency))
+    results: List[Dict[str, Any]] = []
+
+    async def run_chain(indexes: List[int]) -> None:
+        async with slots:
+            for i in indexes:
+                results.append(await _turn(corpus[i], iteration, i))
+
+    await asyncio.gather(*(run_chain(ix) for ix in chains.values()))
+    return results
+
+
+async def _alloc_pass(corpus: List[Dict[str, Any]], turns: int) -> Dict[str, Any]:
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for n in range(turns):
+            row = corpus[n % len(corpus)]
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await _turn(row, 10_000_000 + n // len(corpus), n % len(corpus))
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+    finally:
+        tracemalloc.stop()
+    return {"turns": turns, "peak_bytes": _percentiles(peaks), "retained_bytes": _percentiles(retained)}
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVICE_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+def _compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    def delta(new: float, old: float) -> str:
+        return f"{(new - old) / old * 100:+6.1f}%" if old else "   n/a"
+
+    print(f"\nvs baseline {baseline['meta'].get('git_rev', '?')} ({baseline['meta'].get('timestamp', '?')}):")
+    print(f"  throughput           {current['throughput_tps']:10.1f} tps  {delta(current['throughput_tps'], baseline['throughput_tps'])}")
+    for stage, stats in current["stages_ms"].items():
+        old = baseline["stages_ms"].get(stage)
+        if old:
+            print(f"  {stage:<20} p50 {delta(stats['p50'], old['p50'])}   p95 {delta(stats['p95'], old['p95'])}")
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--backend", default="instant", help=f"{', '.join(BACKENDS)} or module:attribute")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--alloc-turns", type=int, default=200, help="turns in the tracemalloc pass (0 to skip)")
+    parser.add_argument("--out", default="")
+    parser.add_argument("--baseline", default="")
+    args = parser.parse_args()
+
+    corpus = _load_corpus(args.corpus)
+    backend = load_backend(args.backend)
+    # _analyze_turn_impl resolves these names from main's globals
+    main.call_primary = backend.primary
+    main.call_shadow = backend.shadow
+
+    async def replay() -> Dict[str, Any]:
+        for w in range(args.warmup):
+            await _iteration(corpus, -1 - w, args.concurrency)
+        turns: List[Dict[str, Any]] = []
+        start = time.perf_counter()
+        for it in range(args.iterations):
+            turns.extend(await _iteration(corpus, it, args.concurrency))
+        elapsed = time.perf_counter() - start
+        alloc = await _alloc_pass(corpus, args.alloc_turns) if args.alloc_turns > 0 else {}
+        main.detectors.shutdown()
+        return {"turns": turns, "elapsed": elapsed, "alloc": alloc}
+
+    out = asyncio.run(replay())
+    turns = out["turns"]
+    stages: Dict[str, List[float]] = defaultdict(list)
+    by_category: Dict[str, List[float]] = defaultdict(list)
+    actions: Dict[str, int] = defaultdict(int)
+    for t in turns:
+        for stage, seconds in t["durations"].items():
+            stages[stage].append(seconds * 1000)
+        stages["total"].append(t["total"] * 1000)
+        by_category[t["category"]].append(t["total"] * 1000)
+        actions[t["action"]] += 1
+
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_rev": _git_rev(),
+            "python": platform.python_version(),
+            "corpus": os.path.relpath(args.corpus, SERVICE_DIR),
+            "corpus_turns": len(corpus),
+            "backend": args.backend,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+        },
+        "turns": len(turns),
+        "elapsed_s": round(out["elapsed"], 3),
+        "throughput_tps": round(len(turns) / out["elapsed"], 2) if out["elapsed"] else 0.0,
+        "stages_ms": {stage: _percentiles(v) for stage, v in sorted(stages.items())},
+        "categories_ms": {cat: _percentiles(v) for cat, v in sorted(by_category.items())},
+        "actions": dict(actions),
+        "alloc_per_turn": out["alloc"],
+    }
+
+    print(f"{result['turns']} turns in {result['elapsed_s']} s -> {result['throughput_tps']} turns/s "
+          f"(backend {args.backend}, concurrency {args.concurrency})")
+    print(f"\n{'stage (ms)':<20} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, s in result["stages_ms"].items():
+        print(f"{stage:<20} {s['n']:>6} {s['p50']:>9.3f} {s['p95']:>9.3f} {s['p99']:>9.3f}")
+    print(f"\n{'category (ms)':<20} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for cat, s in result["categories_ms"].items():
+        print(f"{cat:<20} {s['n']:>6} {s['p50']:>9.3f} {s['p95']:>9.3f} {s['p99']:>9.3f}")
+    print(f"\nactions: {result['actions']}")
+    if out["alloc"]:
+        a = out["alloc"]
+        print(f"allocation per turn ({a['turns']} turns): peak p50 {a['peak_bytes']['p50']:.0f} B, "
+              f"p95 {a['peak_bytes']['p95']:.0f} B; retained mean {a['retained_bytes']['mean']:.0f} B")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nwrote {args.out}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            _compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,106 @@
+"""
+Response bytes and serialization time: full AnalysisResponse vs the compact shape.
+
+Usage (from backend/defense_service):
+    python benchmarks/bench_response_shape.py [--input-chars 2000] [--output-chars 1500] [--iterations 5000]
+
+The full shape is timed the way FastAPI serves it (pydantic validation, jsonable_encoder, stdlib JSON);
+the compact shape as main.py serves it (plain dict, orjson when installed).
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import main  # noqa: E402
+from response_shapes import compact_view, encode, orjson  # noqa: E402
+
+
+def _text(rng: random.Random, n: int) -> str:
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(n // 5)]
+    return " ".join(words)[:n]
+
+
+def _values(input_chars: int, output_chars: int) -> dict:
+    rng = random.Random(0)
+    user_input = _text(rng, input_chars)
+    answer = _text(rng, output_chars)
+    history = [
+        {"turn": i, "intent": "general_chat", "raw_text_preview": _text(rng, 50) + "...", "signals": [],
+         "suspicion": 0, "violations": []}
+        for i in range(1, 11)
+    ]
+    return {
+        "status": "ok",
+        "canonical_text": user_input,
+        "signals": ["zero_width_removed"],
+        "updated_graph": {"goal": "unknown", "allowed": ["read_code", "general_chat"],
+                          "forbidden": ["override_policy", "reveal_system"], "history": history},
+        "graph_delta": None,
+        "graph_store_shared": False,
+        "divergence_score": 12.0,
+        "risk_level": "low",
+        "action": "allow",
+        "sanitized_text": None,
+        "final_answer": answer,
+        "shadow_output": "",
+        "user_input": user_input,
+        "sanitized_input": user_input,
+        "primary_output": answer,
+        "primary_ok": True,
+        "shadow_ok": False,
+        "llm_mode": "legacy",
+        "defense_action_taken": False,
+        "rerun_with_cleaned": False,
+        "log": {"request_id": "0" * 32, "client_id": "10.0.0.1", "circuit_state": "CLOSED", "rate_limited": False,
+                "status": "ok", "llm_called": True, "latency_ms": 812.4, "model_type": "groq", "provider": "groq",
+                "model": "llama3-8b-8192", "decision": "allow", "risk_score": 10, "divergence_score": 12.0},
+        "llm_called": True,
+        "provider": "groq",
+        "model": "llama3-8b-8192",
+        "llm_latency_ms": 790.1,
+        "preprocessing_latency_ms": 0.4,
+        "total_latency_ms": 812.4,
+        "security_level": "full",
+    }
+
+
+def _full(values: dict) -> bytes:
+    return JSONResponse(jsonable_encoder(main._full_response(values))).body
+
+
+def _compact(values: dict) -> bytes:
+    return encode(compact_view(values))
+
+
+def _timed(label: str, n: int, fn, values: dict) -> None:
+    size = len(fn(values))
+    start = time.perf_counter()
+    for _ in range(n):
+        fn(values)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {size:>8} bytes  {elapsed * 1e6 / n:8.1f} us/response")
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-chars", type=int, default=2000)
+    parser.add_argument("--output-chars", type=int, default=1500)
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    values = _values(args.input_chars, args.output_chars)
+    print(f"encoder: {'orjson' if orjson is not None else 'json (orjson not installed)'}")
+    _timed("full", args.iterations, _full, values)
+    _timed("compact", args.iterations, _compact, values)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,90 @@
+"""
+Cold-start breakdown: interpreter + imports, then the app lifespan startup phases.
+
+Usage (from backend/defense_service):
+    python benchmarks/bench_startup.py [--runs 5] [--top 15] [--lmstudio]
+
+Each run is a fresh interpreter. Reports median time to import main, the lifespan phases recorded in
+main.startup_timings (backend client construction, inference workers, attack index) and, from one
+extra run with -X importtime, the slowest top-level packages by cumulative import time.
+--lmstudio points both roles at an (unused) OpenAI-compatible URL so client construction is included.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHILD = r"""
+import asyncio, json, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+
+async def startup():
+    async with main.lifespan(main.app):
+        t2 = time.perf_counter()
+    return t2
+
+t2 = asyncio.run(startup())
+print("@@" + json.dumps({"import_ms": (t1 - t0) * 1000, "startup_ms": (t2 - t1) * 1000,
+                         "phases": main.startup_timings}))
+"""
+
+
+def _env(lmstudio: bool) -> dict:
+    env = dict(os.environ, PYTHONPATH=SERVICE_DIR, LOG_LEVEL="ERROR", HEALTH_PROBE_INTERVAL="3600")
+    if lmstudio:
+        env.update(LLM_MODE="lmstudio", PRIMARY_BASE_URL="http://127.0.0.1:9/v1")
+    return env
+
+
+def _run_once(env: dict) -> dict:
+    out = subprocess.run([sys.executable, "-c", _CHILD], cwd=SERVICE_DIR, env=env, capture_output=True, text=True, check=True)
+    line = next(l for l in out.stdout.splitlines() if l.startswith("@@"))
+    return json.loads(line[2:])
+
+
+def _import_profile(env: dict, top: int) -> None:
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=SERVICE_DIR, env=env,
+                         capture_output=True, text=True, check=True)
+    cumulative = defaultdict(int)
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        # Direct imports of the service (depth 0/1) carry their whole subtree
+        if len(name) - len(name.lstrip()) <= 3:
+            cumulative[name.strip().split(".")[0]] = max(cumulative[name.strip().split(".")[0]], int(parts[1]))
+    print(f"\nslowest imports (cumulative, one run):")
+    for name, us in sorted(cumulative.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        print(f"  {name:<28} {us / 1000:8.1f} ms")
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--lmstudio", action="store_true")
+    args = parser.parse_args()
+
+    env = _env(args.lmstudio)
+    results = [_run_once(env) for _ in range(args.runs)]
+    print(f"runs: {args.runs}  (median)")
+    print(f"  import main            {statistics.median(r['import_ms'] for r in results):8.1f} ms")
+    print(f"  lifespan startup       {statistics.median(r['startup_ms'] for r in results):8.1f} ms")
+    for key in results[0]["phases"]:
+        values = [r["phases"][key] for r in results if isinstance(r["phases"].get(key), (int, float))]
+        if values:
+            print(f"    {key:<20} {statistics.median(values):8.1f} ms")
+    print(f"  backends: {results[-1]['phases'].get('backends')}")
+    _import_profile(env, args.top)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,174 @@
+"""
+Per-call overhead of the node-core -> defense service transport: TCP vs Unix socket, JSON vs MessagePack.
+
+Usage (from backend/defense_service):
+    python benchmarks/bench_transport.py [--iterations 2000] [--sizes 100,20000] [--shape full|compact]
+
+Starts the service (transport.serve, TCP on --port and a Unix socket) in a child process with the
+analysis pipeline replaced by canned values echoing the request's userText, so a call costs only
+what the transport adds: connection I/O, HTTP parsing, middleware, body decoding into TurnRequest,
+response building and encoding, and the client's own encode/decode. Each combination sends
+--iterations sequential /analyze calls over one keep-alive connection, with a small and a large
+(20k-character) userText by default. MessagePack rows need the msgpack package.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import MSGPACK_TYPE, msgpack  # noqa: E402
+
+_OUTPUT_CHARS = 1500
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float = 30):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class TCPHTTPConnection(http.client.HTTPConnection):
+    """Sets TCP_NODELAY, as undici does; without it small calls stall on delayed ACKs."""
+
+    def connect(self) -> None:
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _serve(port: int, uds_path: str) -> None:
+    """Child process: the real app and route, with canned pipeline values."""
+    os.environ.setdefault("RATE_LIMIT_RPM", "100000000")
+    os.environ["AUDIT_SINK"] = ""
+    os.environ["ANALYTICS_ENABLED"] = "false"
+    import main
+    from bench_response_shape import _values
+    from transport import serve
+
+    template = _values(100, _OUTPUT_CHARS)
+
+    async def canned_turn(req, req_id, client_ip, start_total, timer, preprocessed=None):
+        text = req.userText or ""
+        return {**template, "user_input": text, "canonical_text": text, "sanitized_input": text,
+                "log": {**template["log"], "request_id": req_id}}
+
+    main._analyze_turn_impl = canned_turn
+    serve(main.app, host="127.0.0.1", port=port, uds_path=uds_path)
+
+
+def _connect(transport: str, port: int, uds_path: str) -> http.client.HTTPConnection:
+    if transport == "uds":
+        return UnixHTTPConnection(uds_path)
+    return TCPHTTPConnection("127.0.0.1", port, timeout=30)
+
+
+def _wait_ready(port: int, uds_path: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            for transport in ("tcp", "uds"):
+                conn = _connect(transport, port, uds_path)
+                conn.request("GET", "/health")
+                conn.getresponse().read()
+                conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("defense service did not start")
+
+
+def _measure(transport: str, encoding: str, payload: Dict[str, Any], shape: str, iterations: int,
+             port: int, uds_path: str) -> Dict[str, Any]:
+    if encoding == "msgpack":
+        headers = {"Content-Type": MSGPACK_TYPE, "Accept": MSGPACK_TYPE}
+        encode, decode = msgpack.packb, msgpack.unpackb
+    else:
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        encode, decode = (lambda obj: json.dumps(obj).encode("utf-8")), json.loads
+    path = "/analyze?shape=compact" if shape == "compact" else "/analyze"
+    conn = _connect(transport, port, uds_path)
+    times: List[float] = []
+    sent = received = 0
+    for i in range(iterations + iterations // 10):
+        start = time.perf_counter()
+        body = encode(payload)
+        conn.request("POST", path, body=body, headers=headers)
+        response = conn.getresponse()
+        raw = response.read()
+        result = decode(raw)
+        elapsed = time.perf_counter() - start
+        if response.status != 200 or "action" not in result:
+            raise RuntimeError(f"{transport}/{encoding}: HTTP {response.status}: {raw[:200]!r}")
+        # The first tenth warms up connection, caches and the cost models
+        if i >= iterations // 10:
+            times.append(elapsed * 1e6)
+        sent, received = len(body), len(raw)
+    conn.close()
+    times.sort()
+    return {"mean": statistics.fmean(times), "p50": times[len(times) // 2], "p99": times[int(len(times) * 0.99) - 1],
+            "sent": sent, "received": received}
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--sizes", default="100,20000", help="userText lengths in characters")
+    parser.add_argument("--shape", choices=("full", "compact"), default="full")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--uds", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        _serve(args.port, args.uds)
+        return
+
+    uds_path = os.path.join(tempfile.mkdtemp(prefix="shieldllm-"), "defense.sock")
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port), "--uds", uds_path],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_ready(args.port, uds_path)
+        encodings = ["json"] + (["msgpack"] if msgpack is not None else [])
+        if msgpack is None:
+            print("msgpack not installed: JSON rows only")
+        print(f"{args.iterations} sequential calls per row, {args.shape} response shape, keep-alive\n")
+        print(f"{'chars':>6} {'transport':<9} {'encoding':<8} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} "
+              f"{'req bytes':>10} {'resp bytes':>10}")
+        for size in (int(s) for s in args.sizes.split(",")):
+            payload = {
+                "userText": ("lorem ipsum dolor sit amet " * (size // 27 + 1))[:size],
+                "intentGraph": {"goal": "code_review", "allowed": ["read_code"], "forbidden": ["reveal_system"]},
+                "defenseMode": "active",
+                "policyId": "0" * 16,
+                "sessionId": "bench",
+            }
+            for transport in ("tcp", "uds"):
+                for encoding in encodings:
+                    r = _measure(transport, encoding, payload, args.shape, args.iterations, args.port, uds_path)
+                    print(f"{size:>6} {transport:<9} {encoding:<8} {r['mean']:>9.1f} {r['p50']:>9.1f} {r['p99']:>9.1f} "
+                          f"{r['sent']:>10} {r['received']:>10}")
+    finally:
+        child.terminate()
+        child.wait(timeout=10)
+        if os.path.exists(uds_path):
+            os.unlink(uds_path)
+        os.rmdir(os.path.dirname(uds_path))
+
+
+if __name__ == "__main__":
+    run()
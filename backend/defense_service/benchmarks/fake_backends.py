@@ -0,0 +1,91 @@
+"""
+Fake LLM backends for in-process benchmarks.
+
+A backend is an object with async primary(messages, **kwargs) and shadow(messages, **kwargs) returning
+(text, meta) like llm_client.call_primary/call_shadow. The verdict is derived from simple keywords in
+the last user message, so benign turns stay on the primary-only path and injection-like turns also
+exercise the shadow call.
+
+Select one by name (instant, latency, flaky) or as "module:attribute" for a custom backend.
+"""
+import asyncio
+import importlib
+import json
+import random
+import time
+from typing import Any, Dict, List, Tuple
+
+_SUSPICIOUS = ("ignore", "bypass", "disregard", "system prompt", "developer mode", "no rules", "api key",
+               "disable", "override", "hidden instructions")
+
+
+def _verdict(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    text = (messages[-1].get("content") or "").lower() if messages else ""
+    hits = sum(word in text for word in _SUSPICIOUS)
+    if hits >= 2:
+        return {"risk_level": "high", "risk_score": 75, "action": "warn", "intent": "attack",
+                "answer": "I can't help with that request."}
+    if hits == 1:
+        return {"risk_level": "medium", "risk_score": 45, "action": "warn", "intent": "probe",
+                "answer": "Here is a general answer without changing my instructions."}
+    return {"risk_level": "low", "risk_score": 10, "action": "allow", "intent": "general_chat",
+            "answer": "Here is a helpful answer to your question. " * 8}
+
+
+def _meta(ok: bool, role: str, latency_ms: float, error_type: str = "") -> Dict[str, Any]:
+    return {"ok": ok, "latency_ms": round(latency_ms, 2), "model": f"fake-{role}", "base_url": "fake",
+            "error_type": error_type, "error_message": "", "provider": "fake", "model_type": "groq"}
+
+
+class InstantBackend:
+    """Answers immediately; isolates the pipeline's own cost."""
+
+    async def _call(self, role: str, messages: List[Dict[str, str]]) -> Tuple[str, Dict[str, Any]]:
+        start = time.perf_counter()
+        text = json.dumps(_verdict(messages))
+        return text, _meta(True, role, (time.perf_counter() - start) * 1000)
+
+    async def primary(self, messages, **kwargs):
+        return await self._call("primary", messages)
+
+    async def shadow(self, messages, **kwargs):
+        return await self._call("shadow", messages)
+
+
+class LatencyBackend(InstantBackend):
+    """Sleeps like a remote model: mean_ms +/- jitter (uniform), seeded for repeatable runs."""
+
+    def __init__(self, mean_ms: float = 300.0, jitter_ms: float = 100.0, seed: int = 0):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+        self._rng = random.Random(seed)
+
+    async def _call(self, role, messages):
+        start = time.perf_counter()
+        await asyncio.sleep(max(0.0, self.mean_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+        text = json.dumps(_verdict(messages))
+        return text, _meta(True, role, (time.perf_counter() - start) * 1000)
+
+
+class FlakyBackend(LatencyBackend):
+    """LatencyBackend that fails a fraction of calls, exercising the degraded paths."""
+
+    def __init__(self, fail_rate: float = 0.2, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_rate = fail_rate
+
+    async def _call(self, role, messages):
+        if self._rng.random() < self.fail_rate:
+            return None, _meta(False, role, 0.0, "LLMConnectionError")
+        return await super()._call(role, messages)
+
+
+BACKENDS = {"instant": InstantBackend, "latency": LatencyBackend, "flaky": FlakyBackend}
+
+
+def load_backend(spec: str):
+    """Backend by name or "module:attribute" (a class or factory called without arguments)."""
+    if ":" in spec:
+        module, _, attr = spec.partition(":")
+        return getattr(importlib.import_module(module), attr)()
+    return BACKENDS[spec]()
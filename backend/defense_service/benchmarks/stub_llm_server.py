@@ -0,0 +1,316 @@
+"""
+Local OpenAI-compatible stand-in LLM server for load tests (no Groq quota, no LM Studio box).
+
+Usage (from backend/defense_service):
+    python benchmarks/stub_llm_server.py [--port 1234] [--latency lognormal:300:0.6] [--token-ms 0]
+        [--verdicts low=0.7,medium=0.2,high=0.08,critical=0.02] [--p429 0] [--ptimeout 0]
+        [--ptruncated 0] [--preset 0] [--max-concurrency 0] [--seed 0]
+
+Then point the service at it:
+    LLM_MODE=lmstudio PRIMARY_BASE_URL=http://127.0.0.1:1234/v1 [SHADOW_BASE_URL=...] uvicorn main:app
+
+Endpoints (HTTP/1.1 keep-alive, implemented on asyncio streams so faults are exact):
+- GET  /v1/models                 what the health prober calls
+- POST /v1/chat/completions       non-streaming, or SSE chunks with "stream": true
+- GET  /stats                     request counts by outcome, in-flight and peak concurrency
+- POST /control                   change the profile at runtime, e.g. {"p429": 1.0} to start an outage
+
+Completions return system-prompt-schema verdict JSON with risk_level drawn from --verdicts. Latency is
+fixed:MS, uniform:LO:HI, normal:MEAN:SD or lognormal:MEDIAN:SIGMA (milliseconds). Faults are drawn per
+request: p429 (rate limited, Retry-After: 1), ptimeout (hangs for --hang-s), ptruncated (JSON cut
+mid-object) and preset (TCP reset before or during the response). --max-concurrency queues requests
+beyond N in flight, like a GPU with N slots.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import struct
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+_VERDICTS = {
+    "low": {"risk_level": "low", "action": "allow", "confidence": 0.92, "input_threat": "none",
+            "output_threat": "none", "session_anomaly": False, "reason": "Benign request."},
+    "medium": {"risk_level": "medium", "action": "warn", "confidence": 0.7, "input_threat": "suspicious phrasing",
+               "output_threat": "none", "session_anomaly": False, "reason": "Ambiguous intent."},
+    "high": {"risk_level": "high", "action": "block", "confidence": 0.85, "input_threat": "injection",
+             "output_threat": "none", "session_anomaly": False, "reason": "Instruction override attempt."},
+    "critical": {"risk_level": "critical", "action": "block", "confidence": 0.95, "input_threat": "role override",
+                 "output_threat": "none", "session_anomaly": True, "reason": "Escalating role override."},
+}
+_WORDS = ("the", "request", "looks", "fine", "here", "is", "a", "concise", "answer", "with", "details", "about",
+          "your", "question", "and", "some", "context", "for", "safe", "usage")
+
+
+def parse_latency(spec: str):
+    """Return a sampler rng -> seconds for fixed:MS, uniform:LO:HI, normal:MEAN:SD, lognormal:MEDIAN:SIGMA."""
+    kind, *params = spec.split(":")
+    p = [float(x) for x in params]
+    if kind == "fixed":
+        return lambda rng: p[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(p[0], p[1]) / 1000
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(p[0], p[1])) / 1000
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(max(p[0], 1e-3)), p[1]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_verdicts(spec: str) -> Dict[str, float]:
+    weights = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in _VERDICTS:
+            raise ValueError(f"Unknown verdict {name!r}; expected one of {', '.join(_VERDICTS)}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+class Profile:
+    """Live, mutable behaviour (POST /control updates it)."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.rng = random.Random(args.seed)
+        self.latency_spec = args.latency
+        self.latency = parse_latency(args.latency)
+        self.token_s = args.token_ms / 1000
+        self.verdicts = parse_verdicts(args.verdicts)
+        self.response_words = args.response_words
+        self.p429, self.ptimeout, self.ptruncated, self.preset = args.p429, args.ptimeout, args.ptruncated, args.preset
+        self.hang_s = args.hang_s
+
+    def update(self, changes: Dict[str, Any]) -> None:
+        for key in ("p429", "ptimeout", "ptruncated", "preset", "hang_s", "response_words"):
+            if key in changes:
+                setattr(self, key, type(getattr(self, key))(changes[key]))
+        if "token_ms" in changes:
+            self.token_s = float(changes["token_ms"]) / 1000
+        if "latency" in changes:
+            self.latency = parse_latency(changes["latency"])
+            self.latency_spec = changes["latency"]
+        if "verdicts" in changes:
+            self.verdicts = parse_verdicts(changes["verdicts"])
+
+    def describe(self) -> Dict[str, Any]:
+        return {"latency": self.latency_spec, "token_ms": self.token_s * 1000, "verdicts": self.verdicts,
+                "response_words": self.response_words, "p429": self.p429, "ptimeout": self.ptimeout,
+                "ptruncated": self.ptruncated, "preset": self.preset, "hang_s": self.hang_s}
+
+    def fault(self) -> Optional[str]:
+        r = self.rng.random()
+        for name, p in (("reset", self.preset), ("429", self.p429), ("timeout", self.ptimeout),
+                        ("truncated", self.ptruncated)):
+            if r < p:
+                return name
+            r -= p
+        return None
+
+    def verdict_text(self) -> str:
+        names = list(self.verdicts)
+        level = self.rng.choices(names, weights=[self.verdicts[n] for n in names])[0]
+        verdict = dict(_VERDICTS[level])
+        blocked = verdict["action"] == "block"
+        verdict["response"] = "" if blocked else " ".join(self.rng.choices(_WORDS, k=self.response_words)).capitalize() + "."
+        return json.dumps(verdict)
+
+
+class StubServer:
+    def __init__(self, profile: Profile, max_concurrency: int = 0):
+        self.profile = profile
+        self.slots = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.in_flight = 0
+        self.stats: Dict[str, Any] = {"requests": 0, "ok": 0, "stream": 0, "429": 0, "timeout": 0,
+                                      "truncated": 0, "reset": 0, "peak_in_flight": 0}
+
+    # --- HTTP plumbing ---
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+        headers: Dict[str, str] = {}
+        while True:
+            h = await reader.readline()
+            if h in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = h.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", "0") or 0))
+        return method, path.split("?", 1)[0], headers, body
+
+    @staticmethod
+    def _head(status: int, headers: Dict[str, str]) -> bytes:
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}"] + [f"{k}: {v}" for k, v in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, payload: Any,
+                         extra: Optional[Dict[str, str]] = None, raw: Optional[bytes] = None) -> None:
+        body = raw if raw is not None else json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Content-Length": str(len(body)), "Connection": "keep-alive"}
+        writer.write(self._head(status, {**headers, **(extra or {})}) + body)
+        await writer.drain()
+
+    @staticmethod
+    def _reset(writer: asyncio.StreamWriter) -> None:
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # Linger 0: close() sends RST instead of FIN
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        writer.transport.abort()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if not await self._route(method, path, body, writer):
+                    return  # connection reset
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            if not writer.transport.is_closing():
+                writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter) -> bool:
+        if method == "GET" and path in ("/v1/models", "/models"):
+            await self._send_json(writer, 200, {"object": "list", "data": [
+                {"id": "stub-model", "object": "model", "created": 0, "owned_by": "stub"}]})
+        elif method == "GET" and path == "/stats":
+            await self._send_json(writer, 200, {**self.stats, "in_flight": self.in_flight,
+                                                "profile": self.profile.describe()})
+        elif method == "POST" and path == "/control":
+            self.profile.update(json.loads(body or b"{}"))
+            await self._send_json(writer, 200, self.profile.describe())
+        elif method == "POST" and path in ("/v1/chat/completions", "/chat/completions"):
+            return await self._completion(json.loads(body or b"{}"), writer)
+        else:
+            await self._send_json(writer, 404, {"error": {"message": f"No route {method} {path}", "type": "not_found"}})
+        return True
+
+    # --- completions ---
+
+    async def _completion(self, req: Dict[str, Any], writer: asyncio.StreamWriter) -> bool:
+        self.stats["requests"] += 1
+        if self.slots is not None:
+            await self.slots.acquire()
+        self.in_flight += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+        try:
+            return await self._complete(req, writer)
+        finally:
+            self.in_flight -= 1
+            if self.slots is not None:
+                self.slots.release()
+
+    async def _complete(self, req: Dict[str, Any], writer: asyncio.StreamWriter) -> bool:
+        profile = self.profile
+        fault = profile.fault()
+        stream = bool(req.get("stream"))
+        if fault == "429":
+            self.stats["429"] += 1
+            await self._send_json(writer, 429, {"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_exceeded",
+                                                          "code": "rate_limit_exceeded"}}, extra={"Retry-After": "1"})
+            return True
+        if fault == "reset" and (not stream or profile.rng.random() < 0.5):
+            self.stats["reset"] += 1
+            self._reset(writer)
+            return False
+        await asyncio.sleep(profile.hang_s if fault == "timeout" else profile.latency(profile.rng))
+        if fault == "timeout":
+            self.stats["timeout"] += 1
+        text = profile.verdict_text()
+        if fault == "truncated":
+            self.stats["truncated"] += 1
+            text = text[:max(1, len(text) // 2)]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = req.get("model") or "stub-model"
+        usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) // 4 for m in req.get("messages", [])),
+                 "completion_tokens": len(text) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if not stream:
+            self.stats["ok"] += 1
+            await self._send_json(writer, 200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return True
+        return await self._stream(writer, completion_id, model, text, reset=fault == "reset")
+
+    async def _stream(self, writer: asyncio.StreamWriter, completion_id: str, model: str, text: str, reset: bool) -> bool:
+        writer.write(self._head(200, {"Content-Type": "text/event-stream", "Transfer-Encoding": "chunked",
+                                      "Connection": "keep-alive", "Cache-Control": "no-cache"}))
+
+        async def event(payload: Any) -> None:
+            data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8")
+            writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+            await writer.drain()
+
+        def chunk(delta: Dict[str, Any], finish: Optional[str] = None) -> Dict[str, Any]:
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+        await event(chunk({"role": "assistant", "content": ""}))
+        pieces = [text[i:i + 16] for i in range(0, len(text), 16)]
+        for n, piece in enumerate(pieces):
+            if reset and n == len(pieces) // 2:
+                self.stats["reset"] += 1
+                self._reset(writer)
+                return False
+            await event(chunk({"content": piece}))
+            if self.profile.token_s:
+                await asyncio.sleep(self.profile.token_s)
+        await event(chunk({}, "stop"))
+        await event("[DONE]")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        self.stats["ok"] += 1
+        self.stats["stream"] += 1
+        return True
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stand-in LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--latency", default="lognormal:300:0.6")
+    parser.add_argument("--token-ms", type=float, default=0.0, help="delay between streamed chunks")
+    parser.add_argument("--verdicts", default="low=0.7,medium=0.2,high=0.08,critical=0.02")
+    parser.add_argument("--response-words", type=int, default=60)
+    parser.add_argument("--p429", type=float, default=0.0)
+    parser.add_argument("--ptimeout", type=float, default=0.0)
+    parser.add_argument("--ptruncated", type=float, default=0.0)
+    parser.add_argument("--preset", type=float, default=0.0)
+    parser.add_argument("--hang-s", type=float, default=600.0, help="how long a 'timeout' request hangs")
+    parser.add_argument("--max-concurrency", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    async def serve() -> None:
+        server = StubServer(Profile(args), args.max_concurrency)
+        srv = await asyncio.start_server(server.handle, args.host, args.port)
+        print(f"stub LLM listening on http://{args.host}:{args.port}/v1  profile={server.profile.describe()}", flush=True)
+        async with srv:
+            await srv.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,201 @@
+"""
+Cross-client attack campaign detection with a streaming heavy-hitter sketch.
+
+Every /analyze turn is scored on its own, so one payload sprayed across thousands of sessions and IPs
+pays thousands of primary LLM calls before it is contained and lands in the attack index. Each turn's
+canonical text is fingerprinted (content hash, as for the attack index) and fed to:
+
+- a count-min sketch (CAMPAIGN_SKETCH_DEPTH x CAMPAIGN_SKETCH_WIDTH counters, conservative update) per
+  CAMPAIGN_WINDOW seconds; the rate is the current window plus the overlapping share of the previous
+  one, so memory and per-update cost are fixed regardless of traffic;
+- a top-K table (CAMPAIGN_TOP_K) of the heaviest fingerprints with first/last seen times and an
+  approximate count of distinct sources (bounded per entry).
+
+A fingerprint whose rate reaches CAMPAIGN_RATE_THRESHOLD per window and that came from at least
+CAMPAIGN_MIN_SOURCES distinct sources (client addresses) is reported as spiking; one client repeating
+itself is the rate limiter's business, not a campaign. Sessions do not count as sources because the
+caller picks the sessionId. main.py adds
+"campaign_spike" and "campaign:<id>" to signals, and contains the turn when the policy (or
+CAMPAIGN_ACTION) says "contain". Texts shorter than CAMPAIGN_MIN_CHARS (greetings, "continue") are not
+counted. Only hashes are kept, never payload text. State is per worker process, so with several
+uvicorn workers the threshold applies to each worker's share of traffic.
+"""
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from fingerprint import normalize_for_fingerprint
+
+CAMPAIGN_ENABLED = os.environ.get("CAMPAIGN_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+CAMPAIGN_WINDOW = float(os.environ.get("CAMPAIGN_WINDOW", "60"))
+CAMPAIGN_RATE_THRESHOLD = float(os.environ.get("CAMPAIGN_RATE_THRESHOLD", "50"))
+CAMPAIGN_SKETCH_WIDTH = int(os.environ.get("CAMPAIGN_SKETCH_WIDTH", "4096"))
+CAMPAIGN_SKETCH_DEPTH = int(os.environ.get("CAMPAIGN_SKETCH_DEPTH", "4"))
+CAMPAIGN_TOP_K = int(os.environ.get("CAMPAIGN_TOP_K", "64"))
+CAMPAIGN_MIN_CHARS = int(os.environ.get("CAMPAIGN_MIN_CHARS", "40"))
+CAMPAIGN_MIN_SOURCES = int(os.environ.get("CAMPAIGN_MIN_SOURCES", "3"))
+# "signal" only flags spiking payloads; "contain" also short-circuits them (policy "campaignAction" wins)
+CAMPAIGN_ACTION = os.environ.get("CAMPAIGN_ACTION", "signal").strip().lower()
+
+_MAX_SOURCES = 256
+
+
+class _Heavy:
+    __slots__ = ("fp", "slots", "rate", "count", "first_seen", "last_seen", "sources")
+
+    def __init__(self, fp: str, slots: List[int], now: float):
+        self.fp = fp
+        self.slots = slots
+        self.rate = 0.0
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.sources: set = set()
+
+
+class CampaignSketch:
+    def __init__(self, width: int = CAMPAIGN_SKETCH_WIDTH, depth: int = CAMPAIGN_SKETCH_DEPTH,
+                 window: float = CAMPAIGN_WINDOW, top_k: int = CAMPAIGN_TOP_K,
+                 threshold: float = CAMPAIGN_RATE_THRESHOLD, min_sources: int = CAMPAIGN_MIN_SOURCES):
+        self.width = max(16, width)
+        self.depth = max(1, min(depth, 8))
+        self.window = max(1.0, window)
+        self.top_k = max(1, top_k)
+        self.threshold = threshold
+        self.min_sources = max(1, min(min_sources, _MAX_SOURCES))
+        self._lock = threading.Lock()
+        self._current = [0] * (self.width * self.depth)
+        self._previous = [0] * (self.width * self.depth)
+        self._window_start = time.monotonic()
+        self._heavy: Dict[str, _Heavy] = {}
+        self._refreshed = 0.0
+        self._lightest: Optional[_Heavy] = None
+        self.stats = {"updates": 0, "skipped_short": 0, "spikes": 0, "below_min_sources": 0, "topk_replacements": 0}
+
+    def _slots(self, digest: bytes) -> List[int]:
+        # One 32-bit slice of the digest per row
+        return [
+            row * self.width + int.from_bytes(digest[row * 4:row * 4 + 4], "little") % self.width
+            for row in range(self.depth)
+        ]
+
+    def _rotate(self, now: float) -> float:
+        """Advance windows if needed; returns the previous window's weight in the sliding estimate."""
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            if elapsed >= 2 * self.window:
+                self._previous = [0] * len(self._current)
+            else:
+                self._previous = self._current
+            self._current = [0] * len(self._previous)
+            self._window_start = now - (elapsed % self.window)
+            elapsed = now - self._window_start
+        return 1.0 - elapsed / self.window
+
+    def _estimate(self, slots: List[int], weight: float) -> float:
+        cur, prev = self._current, self._previous
+        return min(cur[s] for s in slots) + weight * min(prev[s] for s in slots)
+
+    def observe(self, canonical_text: str, source: str = "") -> Optional[Dict[str, Any]]:
+        """Count one occurrence; returns the campaign entry if this payload is spiking, else None."""
+        normalized = normalize_for_fingerprint(canonical_text)
+        if len(normalized) < CAMPAIGN_MIN_CHARS:
+            self.stats["skipped_short"] += 1
+            return None
+        digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=32).digest()
+        fp = digest[:8].hex()
+        slots = self._slots(digest)
+        now = time.monotonic()
+        with self._lock:
+            weight = self._rotate(now)
+            cur, prev = self._current, self._previous
+            # Conservative update: only raise the counters holding the minimum
+            low = min(cur[s] for s in slots) + 1
+            for s in slots:
+                if cur[s] < low:
+                    cur[s] = low
+            rate = low + weight * min(prev[s] for s in slots)
+            self.stats["updates"] += 1
+            entry = self._track(fp, slots, rate, weight, now)
+            if entry is None:
+                return None
+            entry.count += 1
+            entry.last_seen = now
+            if source and len(entry.sources) < _MAX_SOURCES:
+                entry.sources.add(hash(source))
+            if rate < self.threshold:
+                return None
+            if len(entry.sources) < self.min_sources:
+                self.stats["below_min_sources"] += 1
+                return None
+            self.stats["spikes"] += 1
+            return self._entry_dict(entry, now)
+
+    def _track(self, fp: str, slots: List[int], rate: float, weight: float, now: float) -> Optional[_Heavy]:
+        entry = self._heavy.get(fp)
+        if entry is None:
+            if len(self._heavy) >= self.top_k:
+                # Refresh tracked rates at most once a second so idle campaigns decay and can be displaced
+                if now - self._refreshed >= 1.0:
+                    for e in self._heavy.values():
+                        e.rate = self._estimate(e.slots, weight)
+                    self._refreshed = now
+                    self._lightest = None
+                if self._lightest is None or self._lightest.fp not in self._heavy:
+                    self._lightest = min(self._heavy.values(), key=lambda e: e.rate)
+                # Most newcomers are one-offs: one comparison against the cached lightest entry
+                if rate <= self._lightest.rate:
+                    return None
+                del self._heavy[self._lightest.fp]
+                self._lightest = None
+                self.stats["topk_replacements"] += 1
+            entry = _Heavy(fp, slots, now)
+            self._heavy[fp] = entry
+        entry.rate = rate
+        return entry
+
+    def _entry_dict(self, entry: _Heavy, now: float) -> Dict[str, Any]:
+        return {
+            "id": f"cmp_{entry.fp[:12]}",
+            "rate": round(entry.rate, 1),
+            "window_s": self.window,
+            "count": entry.count,
+            "sources": len(entry.sources),
+            "sources_capped": len(entry.sources) >= _MAX_SOURCES,
+            "first_seen_s_ago": round(now - entry.first_seen, 1),
+            "last_seen_s_ago": round(now - entry.last_seen, 1),
+            "spiking": entry.rate >= self.threshold and len(entry.sources) >= self.min_sources,
+        }
+
+    def top(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Heaviest tracked fingerprints by current rate."""
+        now = time.monotonic()
+        with self._lock:
+            weight = self._rotate(now)
+            for e in self._heavy.values():
+                e.rate = self._estimate(e.slots, weight)
+            entries = sorted(self._heavy.values(), key=lambda e: e.rate, reverse=True)[:limit or self.top_k]
+            return [self._entry_dict(e, now) for e in entries]
+
+    def get_stats(self) -> Dict[str, Any]:
+        spiking = sum(e["spiking"] for e in self.top())
+        return {
+            **self.stats,
+            "tracked": len(self._heavy),
+            "spiking": spiking,
+            "threshold": self.threshold,
+            "min_sources": self.min_sources,
+            "window_s": self.window,
+            "sketch_counters": self.width * self.depth,
+        }
+
+
+def campaign_action(policy: Optional[Dict[str, Any]]) -> str:
+    """"contain" or "signal" for spiking payloads; the request policy's campaignAction overrides CAMPAIGN_ACTION."""
+    action = str((policy or {}).get("campaignAction") or CAMPAIGN_ACTION).strip().lower()
+    return "contain" if action == "contain" else "signal"
+
+
+campaign_sketch = CampaignSketch()
@@ -1,6 +1,13 @@
 import unicodedata
 import re
 
+from safe_regex import compile_pattern, compile_rules
+
+ZERO_WIDTH_PATTERN = compile_pattern(r'[\u200b\u200c\u200d\ufeff]')
+ZERO_WIDTH_SOFT_HYPHEN_PATTERN = compile_pattern(r'[\u200b\u200c\u200d\ufeff\u00ad]')
+BASE64_CANDIDATE_PATTERN = compile_pattern(r'[A-Za-z0-9+/=]{20,}')
+WHITESPACE_PATTERN = compile_pattern(r"\s+")
+
 def normalize_text(text: str) -> str:
     """
     Apply NFKC normalization to standard form.
@@ -11,7 +18,7 @@ def strip_zero_width(text: str) -> str:
     """
     Remove zero-width characters that might hide malicious content.
     """
-    return re.sub(r'[\u200b\u200c\u200d\ufeff]', '', text)
+    return ZERO_WIDTH_PATTERN.sub('', text)
 
 def fold_homoglyphs(text: str) -> str:
     """
@@ -34,7 +41,7 @@ def detect_base64(text: str) -> list[str]:
     Returns a list of detected suspicious substrings, but does NOT decode them to avoid executing payload.
     """
     matches = []
-    candidates = re.findall(r'[A-Za-z0-9+/=]{20,}', text)
+    candidates = BASE64_CANDIDATE_PATTERN.findall(text)
     
     for candidate in candidates:
         if len(candidate) % 4 == 0:
@@ -92,7 +99,7 @@ def detect_zero_width_chars(text: str) -> dict:
     """
     Check for zero-width characters, strip them, and return cleaned text.
     """
-    cleaned = re.sub(r'[\u200b\u200c\u200d\ufeff\u00ad]', '', text)
+    cleaned = ZERO_WIDTH_SOFT_HYPHEN_PATTERN.sub('', text)
     return {
         "detected": cleaned != text,
         "cleaned": cleaned,
@@ -127,10 +134,10 @@ MALICIOUS_PHRASES = [
     r"\bforget\s+(?:everything|all)\s+(?:above|prior)\b",
     r"\bshow\s+(?:me\s+)?(?:the\s+)?system\s+prompt\b",
     r"\breveal\s+(?:the\s+)?(?:system\s+)?(?:prompt|instructions?)\b",
-    r"\byou\s+are\s+now\s+[^.]*\.",  # role override
+    r"\byou\s+are\s+now\s+[^.]*\.?",  # role override, up to the next period or the end of the text
     r"decode\s*:\s*[A-Za-z0-9+/=]{20,}",  # decode: <base64>
 ]
-MALICIOUS_PHRASES_COMPILED = [re.compile(p, re.IGNORECASE) for p in MALICIOUS_PHRASES]
+MALICIOUS_RULES = compile_rules("malicious_spans", MALICIOUS_PHRASES, re.IGNORECASE)
 
 
 def remove_malicious_spans(text: str, signals: list[str]) -> str:
@@ -139,9 +146,8 @@ def remove_malicious_spans(text: str, signals: list[str]) -> str:
     Used when divergence exceeds threshold.
     """
     cleaned = text
-    for pat in MALICIOUS_PHRASES_COMPILED:
-        cleaned = pat.sub(" ", cleaned)
+    cleaned = MALICIOUS_RULES.sub(" ", cleaned)
     for b64 in detect_base64(cleaned):
         cleaned = cleaned.replace(b64, " ")
-    cleaned = re.sub(r"\s+", " ", cleaned).strip()
+    cleaned = WHITESPACE_PATTERN.sub(" ", cleaned).strip()
     return cleaned if cleaned else text
@@ -0,0 +1,194 @@
+"""
+Per-backend, per-role circuit breakers shared by all workers on the host.
+
+The old global CircuitBreaker wrapped all of /analyze: input validation errors, response-contract
+HTTPExceptions and heuristic-only turns counted as failures, and an open breaker returned 503 for
+every request. Breakers are now keyed by role and backend (e.g. "primary:groq:https://...") and only
+call_primary/call_shadow report to them, once per LLM call after retries. main.py answers a request
+whose breaker is open with a heuristic-only verdict (security_level "reduced") instead of failing.
+
+State lives in a small SQLite (WAL) table so every uvicorn worker sees the same breaker; reads use a
+per-process copy refreshed every CIRCUIT_SYNC_INTERVAL seconds, so a closed breaker costs no I/O.
+HALF-OPEN admits one probe per host, enforced by a lease row update. CIRCUIT_STATE_PATH="" keeps
+state per process (in-memory SQLite).
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_SUCCESS_THRESHOLD = int(os.environ.get("CIRCUIT_SUCCESS_THRESHOLD", "2"))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "300"))
+# A HALF-OPEN probe that never reports back frees its lease after this long
+CIRCUIT_PROBE_LEASE = float(os.environ.get("CIRCUIT_PROBE_LEASE", "60"))
+CIRCUIT_SYNC_INTERVAL = float(os.environ.get("CIRCUIT_SYNC_INTERVAL", "1.0"))
+CIRCUIT_STATE_PATH = os.environ.get(
+    "CIRCUIT_STATE_PATH", str(Path(__file__).resolve().parent / ".cache" / "circuit_breakers.sqlite3")
+).strip()
+
+CLOSED, OPEN, HALF_OPEN = "CLOSED", "OPEN", "HALF-OPEN"
+
+_COLUMNS = ("state", "failures", "successes", "opened_at", "probe_until")
+
+
+class CircuitBreakers:
+    def __init__(self, path: str = CIRCUIT_STATE_PATH, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 success_threshold: int = CIRCUIT_SUCCESS_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.path = path or ":memory:"
+        self.failure_threshold = failure_threshold
+        self.success_threshold = success_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # name -> (row dict, monotonic time read)
+        self._cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
+        self.stats = {"rejected": 0, "opened": 0, "probes": 0}
+
+    # --- storage ---
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.path != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS breakers (name TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                "failures INTEGER NOT NULL, successes INTEGER NOT NULL, opened_at REAL NOT NULL, "
+                "probe_until REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _read(self, name: str) -> Dict[str, Any]:
+        row = self._db().execute(
+            "SELECT state, failures, successes, opened_at, probe_until FROM breakers WHERE name = ?", (name,)
+        ).fetchone()
+        state = dict(zip(_COLUMNS, row)) if row else {"state": CLOSED, "failures": 0, "successes": 0,
+                                                       "opened_at": 0.0, "probe_until": 0.0}
+        self._cache[name] = (state, time.monotonic())
+        return state
+
+    def _write(self, name: str, state: Dict[str, Any]) -> None:
+        self._db().execute(
+            "INSERT OR REPLACE INTO breakers VALUES (?, ?, ?, ?, ?, ?)",
+            (name, *(state[c] for c in _COLUMNS)),
+        )
+        self._cache[name] = (state, time.monotonic())
+
+    def _cached(self, name: str) -> Optional[Dict[str, Any]]:
+        entry = self._cache.get(name)
+        if entry is not None and time.monotonic() - entry[1] < CIRCUIT_SYNC_INTERVAL:
+            return entry[0]
+        return None
+
+    # --- transitions (run in a worker thread; each is one IMMEDIATE transaction) ---
+
+    def _try_probe_sync(self, name: str, role: str) -> bool:
+        from health_prober import health_prober
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                state = self._read(name)
+                now = time.time()
+                allowed = False
+                if state["state"] == CLOSED:
+                    allowed = True
+                elif state["probe_until"] < now and health_prober.is_healthy(role) is not False:
+                    # Background prober: stay open while the backend is known down, probe early once it recovers
+                    due = (state["state"] == HALF_OPEN
+                           or now - state["opened_at"] >= self.reset_timeout
+                           or health_prober.recovered_since(role, state["opened_at"]))
+                    if due:
+                        if state["state"] == OPEN:
+                            state = {**state, "state": HALF_OPEN, "successes": 0}
+                        state = {**state, "probe_until": now + CIRCUIT_PROBE_LEASE}
+                        self._write(name, state)
+                        allowed = True
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return allowed
+
+    def _record_sync(self, name: str, ok: bool) -> None:
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                state = dict(self._read(name))
+                if ok:
+                    if state["state"] == HALF_OPEN:
+                        state["successes"] += 1
+                        state["probe_until"] = 0.0
+                        if state["successes"] >= self.success_threshold:
+                            state.update(state=CLOSED, failures=0, successes=0)
+                    else:
+                        state["failures"] = 0
+                else:
+                    state["failures"] += 1
+                    state["probe_until"] = 0.0
+                    if state["state"] == HALF_OPEN or (state["state"] == CLOSED and state["failures"] >= self.failure_threshold):
+                        state.update(state=OPEN, opened_at=time.time(), successes=0)
+                        self.stats["opened"] += 1
+                self._write(name, state)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    # --- public API ---
+
+    async def allow(self, name: str, role: str) -> bool:
+        """True if an LLM call to this breaker may proceed (CLOSED, or this caller won the probe lease)."""
+        state = self._cached(name)
+        if state is not None and state["state"] == CLOSED:
+            return True
+        if state is None:
+            state = await asyncio.to_thread(self._locked_read, name)
+            if state["state"] == CLOSED:
+                return True
+        allowed = await asyncio.to_thread(self._try_probe_sync, name, role)
+        if allowed:
+            self.stats["probes"] += 1
+        else:
+            self.stats["rejected"] += 1
+        return allowed
+
+    def _locked_read(self, name: str) -> Dict[str, Any]:
+        with self._lock:
+            return self._read(name)
+
+    async def record(self, name: str, ok: bool) -> None:
+        state = self._cached(name)
+        # Closed with a clean count: nothing to reset, skip the write
+        if ok and state is not None and state["state"] == CLOSED and state["failures"] == 0:
+            return
+        await asyncio.to_thread(self._record_sync, name, ok)
+
+    def state(self, name: str) -> str:
+        """Last known state (never blocks; CLOSED until the breaker has been used in this process)."""
+        entry = self._cache.get(name)
+        return entry[0]["state"] if entry else CLOSED
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "breakers": {name: dict(entry[0]) for name, entry in self._cache.items()},
+            **self.stats,
+            "shared_path": self.path,
+        }
+
+
+def breaker_name(role: str) -> str:
+    """Breaker key for a role's current backend, e.g. "primary:openai_compat:http://localhost:1234/v1"."""
+    from health_prober import backend_for
+    kind, base_url = backend_for(role)
+    return f"{role}:{kind}:{base_url}"
+
+
+circuit_breakers = CircuitBreakers()
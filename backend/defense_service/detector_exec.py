@@ -0,0 +1,160 @@
+"""
+Adaptive execution of CPU-bound detectors (canonicalization, sanitization, intent graph).
+
+Each detector used its own asyncio.to_thread hop. For typical inputs the detectors run in 10-100 us,
+less than the hop itself, while a 20k-character input still occupied the shared default executor.
+DetectorExecutor.run() picks a path per call from a per-detector cost model (fixed cost plus cost
+per input character, exponentially averaged over observed runs):
+
+- inline on the event loop when the predicted cost is under DETECTOR_INLINE_US;
+- a dedicated, bounded thread pool (DETECTOR_THREADS) otherwise;
+- a process pool (DETECTOR_PROCESSES, spawned lazily) for detectors marked heavy whose predicted
+  cost exceeds DETECTOR_PROCESS_US, so pathological inputs cannot hold the GIL for the whole service.
+
+Until a detector has been observed twice, inputs up to DETECTOR_INLINE_MAX_CHARS run inline. Dispatch counts
+and the cost model are exported via get_stats().
+
+The request's regex ScanBudget (safe_regex.py) follows the detector: threads run in a copy of the
+caller's context, and a process gets the remaining budget and hands back what it spent.
+"""
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from safe_regex import current_budget, run_budgeted
+from tracing import span
+
+DETECTOR_INLINE_US = float(os.environ.get("DETECTOR_INLINE_US", "200"))
+DETECTOR_PROCESS_US = float(os.environ.get("DETECTOR_PROCESS_US", "20000"))
+DETECTOR_INLINE_MAX_CHARS = int(os.environ.get("DETECTOR_INLINE_MAX_CHARS", "1000"))
+DETECTOR_THREADS = int(os.environ.get("DETECTOR_THREADS", "4"))
+DETECTOR_PROCESSES = int(os.environ.get("DETECTOR_PROCESSES", "1"))
+
+_EWMA_ALPHA = 0.2
+
+
+class _CostModel:
+    """cost_us ~= base_us + per_char_us * size, fitted with exponential averaging."""
+
+    __slots__ = ("base_us", "per_char_us", "samples")
+
+    def __init__(self):
+        self.base_us = 0.0
+        self.per_char_us = 0.0
+        self.samples = 0
+
+    def predict(self, size: int) -> Optional[float]:
+        if self.samples < 2:
+            return None
+        return self.base_us + self.per_char_us * size
+
+    def observe(self, size: int, cost_us: float) -> None:
+        if self.samples == 0:
+            # First run pays lazy imports and regex compilation; do not fit to it
+            pass
+        elif self.samples == 1:
+            self.base_us = min(cost_us, 10.0)
+            self.per_char_us = max(0.0, cost_us - self.base_us) / max(size, 1)
+        elif size <= 64:
+            # Small inputs are dominated by the fixed cost
+            self.base_us += _EWMA_ALPHA * (cost_us - self.base_us)
+        else:
+            per_char = max(0.0, cost_us - self.base_us) / size
+            self.per_char_us += _EWMA_ALPHA * (per_char - self.per_char_us)
+        self.samples += 1
+
+
+def _timed_call(func: Callable, args: tuple):
+    """Returns (result, cost_us). Cost is CPU time of the calling thread, so executor queueing and
+    GIL waits do not inflate the model."""
+    start = time.thread_time()
+    result = func(*args)
+    return result, (time.thread_time() - start) * 1e6
+
+
+class DetectorExecutor:
+    def __init__(self, threads: int = DETECTOR_THREADS, processes: int = DETECTOR_PROCESSES):
+        self._threads = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="detector")
+        # Bound queued work so a burst of large inputs waits here instead of growing the pool queue
+        self._thread_slots = asyncio.Semaphore(max(1, threads) * 4)
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._process_count = processes
+        self._models: Dict[str, _CostModel] = {}
+        self.dispatch: Dict[str, Dict[str, int]] = {}
+
+    def _process_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self._process_count <= 0:
+            return None
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(
+                max_workers=self._process_count, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._processes
+
+    def choose(self, name: str, size: int, heavy: bool) -> str:
+        model = self._models.get(name)
+        predicted = model.predict(size) if model else None
+        if predicted is None:
+            return "inline" if size <= DETECTOR_INLINE_MAX_CHARS else "thread"
+        if predicted < DETECTOR_INLINE_US:
+            return "inline"
+        if heavy and predicted >= DETECTOR_PROCESS_US and self._process_count > 0:
+            return "process"
+        return "thread"
+
+    async def run(self, func: Callable, *args: Any, size: Optional[int] = None, heavy: bool = False):
+        """Run func(*args) on the cheapest adequate path. size defaults to len() of the first argument."""
+        name = getattr(func, "__name__", "detector")
+        if size is None:
+            size = len(args[0]) if args and isinstance(args[0], str) else 0
+        mode = self.choose(name, size, heavy)
+        counts = self.dispatch.setdefault(name, {"inline": 0, "thread": 0, "process": 0})
+        counts[mode] += 1
+        model = self._models.setdefault(name, _CostModel())
+        with span(f"detector:{name}", mode=mode, size=size):
+            if mode == "inline":
+                result, cost_us = _timed_call(func, args)
+                model.observe(size, cost_us)
+            elif mode == "thread":
+                async with self._thread_slots:
+                    loop = asyncio.get_running_loop()
+                    ctx = contextvars.copy_context()
+                    result, cost_us = await loop.run_in_executor(self._threads, ctx.run, _timed_call, func, args)
+                model.observe(size, cost_us)
+            else:
+                # Process runs include IPC, so they do not update the model
+                loop = asyncio.get_running_loop()
+                budget = current_budget()
+                if budget is None:
+                    result = await loop.run_in_executor(self._process_pool(), func, *args)
+                else:
+                    result, spent = await loop.run_in_executor(
+                        self._process_pool(), run_budgeted, budget.remaining_s, func, *args
+                    )
+                    budget.absorb(spent)
+        return result
+
+    def shutdown(self) -> None:
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+            self._processes = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "dispatch": {k: dict(v) for k, v in self.dispatch.items()},
+            "cost_model": {
+                name: {"base_us": round(m.base_us, 2), "per_char_us": round(m.per_char_us, 4), "samples": m.samples}
+                for name, m in self._models.items()
+            },
+            "inline_us": DETECTOR_INLINE_US,
+            "process_us": DETECTOR_PROCESS_US,
+            "process_pool_started": self._processes is not None,
+        }
+
+
+detectors = DetectorExecutor()
@@ -1,6 +1,8 @@
 import re
 from typing import Dict, Any, Optional
 
+from safe_regex import compile_rules
+
 DEFAULT_THRESHOLDS = {
     "low": 10,
     "medium": 30,
@@ -24,7 +26,7 @@ INJECTION_INDICATOR_PATTERNS = [
     r"\brole\s+change\b",
     r"\bforget\s+(?:everything|all)\s+(?:above|prior)\b",
 ]
-INJECTION_COMPILED = [re.compile(p, re.IGNORECASE) for p in INJECTION_INDICATOR_PATTERNS]
+INJECTION_RULES = compile_rules("injection_indicators", INJECTION_INDICATOR_PATTERNS, re.IGNORECASE)
 # Obfuscation markers
 OBFUSCATION_MARKERS = ["base64", "decode:", "hex:", "\\u", "\\x", "&#"]
 
@@ -36,10 +38,7 @@ def injection_indicator_score(user_input: str) -> float:
     if not user_input or not user_input.strip():
         return 0.0
     text = user_input.lower()
-    score = 0
-    for pat in INJECTION_COMPILED:
-        if pat.search(user_input):
-            score += 25
+    score = 25 * INJECTION_RULES.count(user_input)
     for m in OBFUSCATION_MARKERS:
         if m in text:
             score += 30
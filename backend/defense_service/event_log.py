@@ -0,0 +1,151 @@
+"""
+Queue-backed structured logging for the request path.
+
+The pipeline used print() for breadcrumbs, the raw Groq response and the repr of the whole
+AnalysisResponse; those stdout writes block the event loop under load and copy large strings.
+configure_logging() attaches a bounded QueueHandler to the "shieldllm" logger tree and starts a
+QueueListener thread that writes one JSON object per line to stdout. Callers only pay for building a
+small dict and a non-blocking put; when the queue is full the record is dropped and counted.
+
+log_event(event, level, **fields):
+- LOG_LEVEL sets the threshold (default INFO); events below it cost one level check.
+- LOG_SAMPLE="event=rate,..." keeps only a fraction of chatty events (default: all).
+- string fields are truncated to LOG_FIELD_MAX_CHARS; small lists/dicts are clipped recursively and
+  any other object is logged as its type name, never its repr.
+The current request ID (tracing.py) is attached automatically.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from typing import Any, Dict, Optional
+
+from tracing import current_request_id
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").strip().upper()
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", "10000"))
+LOG_FIELD_MAX_CHARS = int(os.environ.get("LOG_FIELD_MAX_CHARS", "512"))
+
+
+def _parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+LOG_SAMPLE = _parse_sample_rates(os.environ.get("LOG_SAMPLE", ""))
+
+_root = logging.getLogger("shieldllm")
+_events = logging.getLogger("shieldllm.defense.events")
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[logging.Handler] = None
+stats = {"enqueued": 0, "dropped": 0, "sampled_out": 0}
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge args and render tracebacks here (they may reference live objects), but leave
+        # JSON serialization to the listener thread
+        record = copy.copy(record)
+        if record.args:
+            record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            stats["enqueued"] += 1
+        except queue.Full:
+            stats["dropped"] += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; structured fields from log_event are merged at top level."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+        }
+        fields = getattr(record, "fields", None)
+        if fields is not None:
+            out["event"] = record.msg
+            out.update(fields)
+        else:
+            out["msg"] = record.getMessage()
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, separators=(",", ":"), default=str)
+
+
+def _clip(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        if len(value) > LOG_FIELD_MAX_CHARS:
+            return f"{value[:LOG_FIELD_MAX_CHARS]}...[+{len(value) - LOG_FIELD_MAX_CHARS} chars]"
+        return value
+    if isinstance(value, (list, tuple)) and len(value) <= 32:
+        return [_clip(v) for v in value]
+    if isinstance(value, dict) and len(value) <= 32:
+        return {str(k): _clip(v) for k, v in value.items()}
+    # Never repr arbitrary objects (a pydantic response repr is the whole payload)
+    return f"<{type(value).__name__}>"
+
+
+def log_event(event: str, level: int = logging.INFO, exc_info: bool = False, **fields: Any) -> None:
+    """Log a structured event without blocking; see module docstring for level, sampling and truncation."""
+    if not _events.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLE.get(event)
+    if rate is not None and rate < 1.0 and random.random() >= rate:
+        stats["sampled_out"] += 1
+        return
+    clipped = {k: _clip(v) for k, v in fields.items()}
+    request_id = current_request_id()
+    if request_id and "request_id" not in clipped:
+        clipped["request_id"] = request_id
+    _events.log(level, event, exc_info=exc_info, extra={"fields": clipped})
+
+
+def configure_logging() -> None:
+    """Route the shieldllm logger tree through a bounded queue drained by a background thread."""
+    global _listener, _handler
+    if _listener is not None:
+        return
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_MAX)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    _root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    _handler = _DroppingQueueHandler(q)
+    _root.addHandler(_handler)
+    _root.propagate = False
+    _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    """Flush queued records (called from the app lifespan on shutdown)."""
+    global _listener, _handler
+    if _listener is not None:
+        _root.removeHandler(_handler)
+        _listener.stop()
+        _listener, _handler = None, None
+
+
+def get_stats() -> Dict[str, Any]:
+    return {**stats, "level": LOG_LEVEL, "queue_max": LOG_QUEUE_MAX}
@@ -0,0 +1,100 @@
+"""
+Text fingerprints for cache keys and payload matching.
+
+- normalize_for_fingerprint: lowercase, collapse whitespace (applied after progressive_canonicalize).
+- content_hash: exact hash of the normalized text.
+- simhash64: 64-bit SimHash over 4-byte shingles; near-duplicates differ in few bits.
+- BandedSimHashIndex: pigeonhole LSH. With max_distance=k the 64 bits are split into k+1 bands,
+  so any fingerprint within Hamming distance k shares at least one band exactly with the query.
+"""
+import hashlib
+import re
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+_SHINGLE = 4
+_WS_RE = re.compile(r"\s+")
+_MASK64 = (1 << 64) - 1
+
+
+def normalize_for_fingerprint(text: str) -> str:
+    return _WS_RE.sub(" ", (text or "").lower()).strip()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(normalize_for_fingerprint(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def simhash64(text: str) -> int:
+    """64-bit SimHash over 4-byte shingles of the normalized UTF-8 text. Empty text hashes to 0.
+
+    Shingling and hashing (splitmix64 finalizer) are vectorized with numpy, so a 20k-character input
+    costs about a millisecond.
+    """
+    data = normalize_for_fingerprint(text).encode("utf-8")
+    if not data:
+        return 0
+    import numpy as np
+
+    b = np.frombuffer(data.ljust(_SHINGLE, b" "), dtype=np.uint8).astype(np.uint64)
+    z = b[:-3] | (b[1:-2] << np.uint64(8)) | (b[2:-1] << np.uint64(16)) | (b[3:] << np.uint64(24))
+    z = z + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    bits = np.unpackbits(z.astype("<u8").view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    ones = bits.sum(axis=0, dtype=np.int64)
+    mask = ones * 2 > len(z)
+    return int(sum(1 << int(i) for i in np.nonzero(mask)[0]))
+
+
+def hamming64(a: int, b: int) -> int:
+    return bin((a ^ b) & _MASK64).count("1")
+
+
+class BandedSimHashIndex:
+    """Maps (scope, band, band value) -> ids for sub-linear near-duplicate candidate lookup."""
+
+    def __init__(self, max_distance: int = 3):
+        self.max_distance = max(0, min(max_distance, 15))
+        self.bands = self.max_distance + 1
+        self._widths = [64 // self.bands + (1 if i < 64 % self.bands else 0) for i in range(self.bands)]
+        self._buckets: Dict[Tuple[str, int, int], Set[str]] = {}
+
+    def _band_values(self, fp: int) -> Iterable[Tuple[int, int]]:
+        shift = 0
+        for i, width in enumerate(self._widths):
+            yield i, (fp >> shift) & ((1 << width) - 1)
+            shift += width
+
+    def add(self, scope: str, fp: int, item_id: str) -> None:
+        for band, value in self._band_values(fp):
+            self._buckets.setdefault((scope, band, value), set()).add(item_id)
+
+    def remove(self, scope: str, fp: int, item_id: str) -> None:
+        for band, value in self._band_values(fp):
+            key = (scope, band, value)
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(item_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def candidates(self, scope: str, fp: int) -> Set[str]:
+        out: Set[str] = set()
+        for band, value in self._band_values(fp):
+            bucket = self._buckets.get((scope, band, value))
+            if bucket:
+                out |= bucket
+        return out
+
+    def nearest(self, scope: str, fp: int, lookup) -> Optional[Tuple[str, int]]:
+        """Best candidate within max_distance. lookup(item_id) returns its fingerprint or None."""
+        best: Optional[Tuple[str, int]] = None
+        for item_id in self.candidates(scope, fp):
+            other = lookup(item_id)
+            if other is None:
+                continue
+            dist = hamming64(fp, other)
+            if dist <= self.max_distance and (best is None or dist < best[1]):
+                best = (item_id, dist)
+        return best
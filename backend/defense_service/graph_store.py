@@ -0,0 +1,344 @@
+"""
+Server-held intent graphs for the delta protocol (TurnRequest.graphMode = "server").
+
+By default the client sends the whole intentGraph with every turn and gets updatedGraph back one
+history node longer, and build_intent_graph deep-copies it on the way: O(n) per request and O(n^2)
+over a session of n turns. In server mode the service keeps each session's graph. A request carries
+only the new turn and the client's graphVersion; the response carries graphDelta = {"version",
+"baseVersion", "node", "changed"}: the new history node and any top-level fields that changed.
+The version goes up with every change. A client whose version is not the server's (a lost response,
+eviction, restart, another host) gets 409 and resyncs by sending its full intentGraph once, or reads
+GET /session/{id}/graph.
+
+Storage follows session_store.py (SESSION_STORE=memory|sqlite):
+
+- MemoryGraphStore: per-process LRU with idle TTL, capped by session count.
+- SQLiteGraphStore: same file as the session store. Graph fields live in one row and history nodes
+  in their own rows, so a turn inserts one node instead of rewriting the graph.
+
+Server mode needs every worker to see the same graphs. With the memory store each worker holds its
+own copy, so turns landing on different workers would 409 and resync the whole graph every time. The
+service therefore only serves graphMode "server" from a shared store (GraphStore.shared) and answers
+inline (updatedGraph) otherwise; responses carry graphStoreShared so clients know which mode to use.
+
+Each session keeps at most GRAPH_MAX_NODES history nodes; turn numbers keep counting.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from intent_graph import seed_graph
+from session_store import SESSION_MAX_COUNT, SESSION_STORE, SESSION_STORE_PATH, SESSION_TTL
+
+GRAPH_MAX_NODES = int(os.environ.get("GRAPH_MAX_NODES", "500"))
+
+
+class GraphState(NamedTuple):
+    version: int
+    # Graph fields besides history (goal, allowed, forbidden, ...)
+    fields: Dict[str, Any]
+    # Turns recorded so far, including nodes trimmed past GRAPH_MAX_NODES
+    turns: int
+
+
+def _split(intent_graph: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[Dict[str, Any]], Dict[str, Any]]:
+    """(fields, history, changed) for a client graph; changed = fields the builder filled in."""
+    graph = seed_graph(intent_graph)
+    history = graph.pop("history")
+    sent = intent_graph or {}
+    return graph, history, {k: v for k, v in graph.items() if sent.get(k) != v}
+
+
+class GraphStore(ABC):
+    """Interface. Versions start at 1 and go up by one with every reset and every appended node."""
+
+    # True when every worker on the host reads and writes the same graphs
+    shared = False
+
+    def __init__(self, max_nodes: int = GRAPH_MAX_NODES, max_sessions: int = SESSION_MAX_COUNT, ttl: int = SESSION_TTL):
+        self.max_nodes = max(1, max_nodes)
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.metrics = {"resets": 0, "appends": 0, "conflicts": 0, "misses": 0, "evicted_lru": 0, "evicted_ttl": 0,
+                        "inline_fallbacks": 0}
+
+    @abstractmethod
+    async def get_state(self, session_id: str) -> Optional[GraphState]:
+        ...
+
+    @abstractmethod
+    async def reset(self, session_id: str, intent_graph: Optional[Dict[str, Any]]) -> Tuple[GraphState, Dict[str, Any]]:
+        """Replaces the session's graph with the client's (resync); returns (state, fields the builder filled in)."""
+
+    @abstractmethod
+    async def append(self, session_id: str, base_version: int, node: Dict[str, Any]) -> Optional[int]:
+        """Appends a history node if the graph is still at base_version; the new version, or None on conflict."""
+
+    @abstractmethod
+    async def get_graph(self, session_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        ...
+
+    @abstractmethod
+    async def clear(self, session_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        ...
+
+
+class MemoryGraphStore(GraphStore):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # session id -> [version, fields, turns, nodes, last_access]
+        self._graphs: "OrderedDict[str, List[Any]]" = OrderedDict()
+
+    def _expire(self, now: float) -> None:
+        # Oldest-accessed first, so stop at the first live session
+        while self._graphs:
+            session_id, entry = next(iter(self._graphs.items()))
+            if now - entry[4] <= self.ttl:
+                break
+            del self._graphs[session_id]
+            self.metrics["evicted_ttl"] += 1
+
+    def _entry(self, session_id: str) -> Optional[List[Any]]:
+        now = time.time()
+        self._expire(now)
+        entry = self._graphs.get(session_id)
+        if entry is None:
+            self.metrics["misses"] += 1
+            return None
+        entry[4] = now
+        self._graphs.move_to_end(session_id)
+        return entry
+
+    async def get_state(self, session_id: str) -> Optional[GraphState]:
+        entry = self._entry(session_id)
+        return GraphState(entry[0], entry[1], entry[2]) if entry is not None else None
+
+    async def reset(self, session_id: str, intent_graph: Optional[Dict[str, Any]]) -> Tuple[GraphState, Dict[str, Any]]:
+        fields, history, changed = _split(intent_graph)
+        now = time.time()
+        self._expire(now)
+        old = self._graphs.pop(session_id, None)
+        version = (old[0] if old is not None else 0) + 1
+        self._graphs[session_id] = [version, fields, len(history), history[-self.max_nodes:], now]
+        self.metrics["resets"] += 1
+        while len(self._graphs) > self.max_sessions and len(self._graphs) > 1:
+            self._graphs.popitem(last=False)
+            self.metrics["evicted_lru"] += 1
+        return GraphState(version, fields, len(history)), changed
+
+    async def append(self, session_id: str, base_version: int, node: Dict[str, Any]) -> Optional[int]:
+        entry = self._entry(session_id)
+        if entry is None or entry[0] != base_version:
+            self.metrics["conflicts"] += 1
+            return None
+        entry[0] += 1
+        entry[2] += 1
+        entry[3].append(node)
+        if len(entry[3]) > self.max_nodes:
+            del entry[3][:len(entry[3]) - self.max_nodes]
+        self.metrics["appends"] += 1
+        return entry[0]
+
+    async def get_graph(self, session_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        entry = self._entry(session_id)
+        if entry is None:
+            return None
+        return entry[0], {**entry[1], "history": list(entry[3])}
+
+    async def clear(self, session_id: str) -> bool:
+        return self._graphs.pop(session_id, None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.metrics, "backend": "memory", "shared": self.shared, "sessions": len(self._graphs),
+                "max_nodes": self.max_nodes}
+
+
+class SQLiteGraphStore(GraphStore):
+    """Host-wide store in the session store's WAL-mode file. Calls run off the event loop."""
+
+    shared = True
+
+    def __init__(self, path: str = SESSION_STORE_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS intent_graphs (
+                session_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                fields TEXT NOT NULL,
+                turns INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS intent_graphs_last_access ON intent_graphs(last_access);
+            CREATE TABLE IF NOT EXISTS intent_graph_nodes (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                node TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            """
+        )
+        self._cached_count = 0
+
+    def _delete(self, ids: List[str]) -> None:
+        for session_id in ids:
+            self._conn.execute("DELETE FROM intent_graph_nodes WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM intent_graphs WHERE session_id = ?", (session_id,))
+
+    def _state_sync(self, session_id: str) -> Optional[GraphState]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, fields, turns, last_access FROM intent_graphs WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None or now - row[3] > self.ttl:
+                if row is not None:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    self._delete([session_id])
+                    self._conn.execute("COMMIT")
+                    self.metrics["evicted_ttl"] += 1
+                self.metrics["misses"] += 1
+                return None
+            self._conn.execute("UPDATE intent_graphs SET last_access = ? WHERE session_id = ?", (now, session_id))
+        return GraphState(row[0], json.loads(row[1]), row[2])
+
+    def _reset_sync(self, session_id: str, intent_graph: Optional[Dict[str, Any]]) -> Tuple[GraphState, Dict[str, Any]]:
+        fields, history, changed = _split(intent_graph)
+        now = time.time()
+        kept = history[-self.max_nodes:]
+        first = len(history) - len(kept) + 1
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT version FROM intent_graphs WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                version = (row[0] if row is not None else 0) + 1
+                self._delete([session_id])
+                self._conn.execute(
+                    "INSERT INTO intent_graphs VALUES (?, ?, ?, ?, ?)",
+                    (session_id, version, json.dumps(fields, default=str), len(history), now),
+                )
+                self._conn.executemany(
+                    "INSERT INTO intent_graph_nodes VALUES (?, ?, ?)",
+                    [(session_id, first + i, json.dumps(node, default=str)) for i, node in enumerate(kept)],
+                )
+                self._evict(now, session_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.metrics["resets"] += 1
+        return GraphState(version, fields, len(history)), changed
+
+    def _append_sync(self, session_id: str, base_version: int, node: Dict[str, Any]) -> Optional[int]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Compare-and-set on the version: a concurrent turn or resync makes this a conflict
+                updated = self._conn.execute(
+                    "UPDATE intent_graphs SET version = version + 1, turns = turns + 1, last_access = ? "
+                    "WHERE session_id = ? AND version = ?",
+                    (now, session_id, base_version),
+                ).rowcount
+                if not updated:
+                    self._conn.execute("ROLLBACK")
+                    self.metrics["conflicts"] += 1
+                    return None
+                turns = self._conn.execute(
+                    "SELECT turns FROM intent_graphs WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                self._conn.execute(
+                    "INSERT INTO intent_graph_nodes VALUES (?, ?, ?)", (session_id, turns, json.dumps(node, default=str))
+                )
+                self._conn.execute(
+                    "DELETE FROM intent_graph_nodes WHERE session_id = ? AND seq <= ?", (session_id, turns - self.max_nodes)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.metrics["appends"] += 1
+        return base_version + 1
+
+    def _evict(self, now: float, keep: str) -> None:
+        """TTL first, then least recently used until within the session cap. Caller holds the lock."""
+        expired = [r[0] for r in self._conn.execute(
+            "SELECT session_id FROM intent_graphs WHERE last_access < ?", (now - self.ttl,)
+        ).fetchall()]
+        self._delete(expired)
+        self.metrics["evicted_ttl"] += len(expired)
+        count = self._conn.execute("SELECT COUNT(*) FROM intent_graphs").fetchone()[0]
+        if count > self.max_sessions:
+            victims = [r[0] for r in self._conn.execute(
+                "SELECT session_id FROM intent_graphs WHERE session_id != ? ORDER BY last_access LIMIT ?",
+                (keep, count - self.max_sessions),
+            ).fetchall()]
+            self._delete(victims)
+            self.metrics["evicted_lru"] += len(victims)
+            count -= len(victims)
+        self._cached_count = count
+
+    def _graph_sync(self, session_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        state = self._state_sync(session_id)
+        if state is None:
+            return None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT node FROM intent_graph_nodes WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return state.version, {**state.fields, "history": [json.loads(r[0]) for r in rows]}
+
+    def _clear_sync(self, session_id: str) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            existed = self._conn.execute(
+                "SELECT 1 FROM intent_graphs WHERE session_id = ?", (session_id,)
+            ).fetchone() is not None
+            self._delete([session_id])
+            self._conn.execute("COMMIT")
+        return existed
+
+    async def get_state(self, session_id: str) -> Optional[GraphState]:
+        return await asyncio.to_thread(self._state_sync, session_id)
+
+    async def reset(self, session_id: str, intent_graph: Optional[Dict[str, Any]]) -> Tuple[GraphState, Dict[str, Any]]:
+        return await asyncio.to_thread(self._reset_sync, session_id, intent_graph)
+
+    async def append(self, session_id: str, base_version: int, node: Dict[str, Any]) -> Optional[int]:
+        return await asyncio.to_thread(self._append_sync, session_id, base_version, node)
+
+    async def get_graph(self, session_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        return await asyncio.to_thread(self._graph_sync, session_id)
+
+    async def clear(self, session_id: str) -> bool:
+        return await asyncio.to_thread(self._clear_sync, session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        # Session count as of the last reset from this worker; avoids a scan per /metrics call
+        return {**self.metrics, "backend": "sqlite", "shared": self.shared, "path": self.path,
+                "sessions": self._cached_count, "max_nodes": self.max_nodes}
+
+
+def create_graph_store() -> GraphStore:
+    if SESSION_STORE == "sqlite":
+        return SQLiteGraphStore()
+    return MemoryGraphStore()
@@ -0,0 +1,201 @@
+"""
+Background health prober for the primary and shadow LLM backends.
+
+check_primary_health/check_shadow_health used to run a real chat completion through call_primary,
+sharing llm_semaphore, counting toward llm_stats and making the caller wait a full LLM round-trip.
+The prober instead checks each backend on a schedule with the cheapest probe available and
+publishes the result in memory, so readers (routing, circuit breaker, /llm-status) never block:
+
+- OpenAI-compatible servers (LM Studio, Groq): GET /models on a dedicated client (no retries).
+- Hugging Face Inference: one-token chat completion on a dedicated client.
+- Transformers: worker liveness when INFERENCE_WORKERS > 0, otherwise torch/transformers importable.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from settings import settings
+
+logger = logging.getLogger("shieldllm.defense.health")
+
+HEALTH_PROBE_INTERVAL = float(os.environ.get("HEALTH_PROBE_INTERVAL", os.environ.get("HEALTH_CACHE_TTL", "30")))
+HEALTH_PROBE_DOWN_INTERVAL = float(os.environ.get("HEALTH_PROBE_DOWN_INTERVAL", "5"))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get("HEALTH_PROBE_TIMEOUT", "5"))
+
+ROLES = ("primary", "shadow")
+
+
+def _new_state() -> Dict[str, Any]:
+    return {
+        "status": "unknown",  # unknown | up | down
+        "backend": "",
+        "probe": "",
+        "latency_ms": 0.0,
+        "error": "",
+        "last_checked": 0.0,
+        "last_change": 0.0,
+        "consecutive_failures": 0,
+    }
+
+
+def backend_for(role: str) -> Tuple[str, str]:
+    """Return (backend kind, base_url) exactly as generate_primary/generate_shadow would route."""
+    import llm_client as lc
+
+    if role == "primary":
+        if lc.LLM_MODE == "lmstudio" or (lc.LLM_MODE == "" and lc.USE_PRIMARY_BASE_URL):
+            return "openai_compat", lc.PRIMARY_BASE_URL or "http://localhost:1234/v1"
+        if lc.LLM_MODE == "transformers":
+            return "transformers", "transformers"
+        if lc.USE_HF_PRIMARY:
+            return "huggingface", "huggingface"
+        return "groq", "https://api.groq.com/openai/v1"
+    if lc.LLM_MODE == "lmstudio" or (lc.LLM_MODE == "" and lc.USE_SHADOW_BASE_URL):
+        return "openai_compat", lc.SHADOW_BASE_URL or lc.PRIMARY_BASE_URL or "http://localhost:1234/v1"
+    if lc.LLM_MODE == "transformers":
+        return "transformers", "transformers"
+    return "groq", "https://api.groq.com/openai/v1"
+
+
+class HealthProber:
+    """Periodically probes each backend; get_status() and is_healthy() only read published state."""
+
+    def __init__(self, interval: float = HEALTH_PROBE_INTERVAL, down_interval: float = HEALTH_PROBE_DOWN_INTERVAL,
+                 timeout: float = HEALTH_PROBE_TIMEOUT):
+        self.interval = max(1.0, interval)
+        self.down_interval = max(0.5, min(down_interval, self.interval))
+        self.timeout = timeout
+        self._state: Dict[str, Dict[str, Any]] = {role: _new_state() for role in ROLES}
+        self._clients: Dict[str, Any] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    # --- readers (never block) ---
+
+    def get_status(self, role: str) -> Dict[str, Any]:
+        return dict(self._state[role])
+
+    def is_healthy(self, role: str) -> Optional[bool]:
+        """True/False once probed; None while the first probe has not completed."""
+        status = self._state[role]["status"]
+        if status == "unknown":
+            return None
+        return status == "up"
+
+    def recovered_since(self, role: str, ts: float) -> bool:
+        """True if the backend is up and was (re)confirmed up after ts."""
+        state = self._state[role]
+        return state["status"] == "up" and state["last_checked"] > ts
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {role: self.get_status(role) for role in ROLES}
+
+    # --- probing ---
+
+    def _probe_client(self, kind: str, base_url: str):
+        """Dedicated client per backend so probes never share connections with user requests."""
+        key = f"{kind}:{base_url}"
+        if key not in self._clients:
+            if kind == "huggingface":
+                from huggingface_hub import AsyncInferenceClient
+                self._clients[key] = AsyncInferenceClient(token=settings.hf_token or None, timeout=self.timeout)
+            else:
+                from openai import AsyncOpenAI
+                if kind == "groq":
+                    api_key = settings.groq_api_key
+                    if not api_key:
+                        raise ValueError("GROQ_API_KEY required or invalid.")
+                else:
+                    api_key = "EMPTY"
+                self._clients[key] = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0, timeout=self.timeout)
+        return self._clients[key]
+
+    async def _run_probe(self, role: str, kind: str, base_url: str) -> str:
+        """Execute one probe; raises on failure. Returns the probe name."""
+        import llm_client as lc
+
+        if kind == "transformers":
+            from inference_worker import get_inference_pool, inference_workers_enabled
+            if inference_workers_enabled():
+                pool = get_inference_pool()
+                if pool.started and not any(w["alive"] for w in pool.get_stats()["workers"]):
+                    raise ConnectionError("No inference worker alive")
+                return "worker_liveness"
+            import importlib.util
+            for mod in ("torch", "transformers"):
+                if importlib.util.find_spec(mod) is None:
+                    raise ImportError(f"{mod} not installed")
+            return "import_check"
+        client = self._probe_client(kind, base_url)
+        if kind == "huggingface":
+            await client.chat_completion(
+                model=lc.PRIMARY_MODEL,
+                messages=[{"role": "user", "content": "Hi"}],
+                max_tokens=1,
+            )
+            return "one_token_completion"
+        await client.models.list()
+        return "models_list"
+
+    async def probe_once(self, role: str) -> Dict[str, Any]:
+        kind, base_url = backend_for(role)
+        state = self._state[role]
+        start = time.perf_counter()
+        probe = state["probe"]
+        try:
+            probe = await asyncio.wait_for(self._run_probe(role, kind, base_url), timeout=self.timeout)
+            status, error = "up", ""
+            state["consecutive_failures"] = 0
+        except Exception as e:
+            status, error = "down", f"{type(e).__name__}: {str(e)[:200]}"
+            state["consecutive_failures"] += 1
+        now = time.time()
+        if status != state["status"]:
+            state["last_change"] = now
+            logger.info("LLM backend %s (%s) is %s %s", role, kind, status, error)
+        state.update({
+            "status": status,
+            "backend": kind,
+            "probe": probe,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+            "error": error,
+            "last_checked": now,
+        })
+        return dict(state)
+
+    async def _loop(self, role: str) -> None:
+        while True:
+            try:
+                state = await self.probe_once(role)
+            except Exception:
+                logger.exception("Health probe for %s crashed", role)
+                state = self._state[role]
+            await asyncio.sleep(self.interval if state["status"] == "up" else self.down_interval)
+
+    def start(self) -> None:
+        for role in ROLES:
+            task = self._tasks.get(role)
+            if task is None or task.done():
+                self._tasks[role] = asyncio.get_running_loop().create_task(self._loop(role), name=f"health-probe-{role}")
+
+    async def stop(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        for task in self._tasks.values():
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks.clear()
+        for client in self._clients.values():
+            close = getattr(client, "close", None)
+            if close is not None:
+                try:
+                    await close()
+                except Exception:
+                    pass
+        self._clients.clear()
+
+
+health_prober = HealthProber()
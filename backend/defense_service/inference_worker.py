@@ -0,0 +1,392 @@
+"""
+Out-of-process inference workers for LLM_MODE=transformers.
+
+Running model.generate via asyncio.to_thread inside the API process means GIL contention and
+tokenizer work slow down every other request (including /health). With INFERENCE_WORKERS > 0
+the transformers models are hosted in separate worker processes instead:
+
+- Requests travel over a multiprocessing Pipe per worker (messages in, text out).
+- Each worker owns a shared-memory block split into slots of two int32 cells: a cancel flag and a
+  generated-token counter. The worker bumps the counter on every generation step; the API process
+  reads it for in-flight progress (get_stats) and adds it to the token count when the slot is freed.
+  Cancellation is a single byte write from the API process, checked by the worker on every
+  generation step, so a timed-out request stops burning CPU/GPU without an IPC round-trip.
+- A reader thread per worker resolves futures on the event loop. If the worker dies, in-flight
+  requests fail with LLMConnectionError (retryable by call_primary/call_shadow) and the worker is
+  restarted in the background without restarting the API process.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("shieldllm.defense.inference")
+
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "0"))
+INFERENCE_SLOTS_PER_WORKER = int(os.environ.get("INFERENCE_SLOTS_PER_WORKER", "4"))
+INFERENCE_MAX_NEW_TOKENS = int(os.environ.get("INFERENCE_MAX_NEW_TOKENS", "2048"))
+INFERENCE_RESTART_BACKOFF = float(os.environ.get("INFERENCE_RESTART_BACKOFF", "2"))
+
+# Slot layout (int32 cells): [cancel, generated_tokens]
+_SLOT_CELLS = 2
+_CELL_BYTES = 4
+
+
+# --- Worker process side ---
+
+def _make_slot_criteria(cells, offset: int):
+    """StoppingCriteria that publishes the generated-token count to the slot and honours the cancel flag."""
+    from transformers import StoppingCriteria
+
+    class _SlotCriteria(StoppingCriteria):
+        prompt_len: Optional[int] = None
+
+        def __call__(self, input_ids, scores, **kwargs) -> bool:
+            # Called once per generated token, so the first call sees prompt + 1 token.
+            if self.prompt_len is None:
+                self.prompt_len = input_ids.shape[1] - 1
+            cells[offset + 1] = input_ids.shape[1] - self.prompt_len
+            return cells[offset] != 0
+
+    return _SlotCriteria()
+
+
+def _worker_main(worker_id: int, conn, shm_name: str, slots: int, max_new_tokens: int) -> None:
+    """Entry point of a worker process: load models lazily, serve generate requests until EOF."""
+    import llm_client
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    cells = shm.buf.cast("i")
+    models: Dict[str, Tuple[Any, Any, str]] = {}
+
+    def _model(role: str):
+        if role not in models:
+            if role == "shadow":
+                models[role] = llm_client._load_transformers_shadow()
+            else:
+                models[role] = llm_client._load_transformers_primary()
+        return models[role]
+
+    try:
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == "stop":
+                break
+            if msg[0] == "warmup":
+                for role in msg[1]:
+                    _model(role)
+                conn.send(("ready", None, None, None))
+                continue
+            _, req_id, slot, role, messages, max_tokens = msg
+            offset = slot * _SLOT_CELLS
+            if cells[offset] != 0:
+                conn.send(("cancelled", req_id, None, None))
+                continue
+            try:
+                model, tokenizer, device = _model(role)
+                criteria = _make_slot_criteria(cells, offset)
+                text = llm_client._transformers_generate(
+                    model, tokenizer, device, messages, min(max_tokens, max_new_tokens),
+                    stopping_criteria=[criteria],
+                )
+                kind = "cancelled" if cells[offset] != 0 else "result"
+                conn.send((kind, req_id, text, None))
+            except Exception as e:
+                conn.send(("error", req_id, None, f"{type(e).__name__}: {e}"))
+    finally:
+        cells.release()
+        shm.close()
+
+
+# --- API process side ---
+
+class _WorkerHandle:
+    def __init__(self, worker_id: int, slots: int, max_new_tokens: int):
+        self.worker_id = worker_id
+        self.slots = slots
+        self.max_new_tokens = max_new_tokens
+        self.shm: Optional[shared_memory.SharedMemory] = None
+        self.cells = None
+        self.process = None
+        self.conn = None
+        self.reader: Optional[threading.Thread] = None
+        self.free_slots: List[int] = []
+        self.slot_waiters: deque = deque()
+        # req_id -> (future, slot)
+        self.inflight: Dict[int, Tuple[asyncio.Future, int]] = {}
+        self.alive = False
+        self.restarts = 0
+
+
+class InferenceWorkerPool:
+    """Pool of model-hosting worker processes with shared-memory slots and crash recovery."""
+
+    def __init__(self, num_workers: int = INFERENCE_WORKERS, slots_per_worker: int = INFERENCE_SLOTS_PER_WORKER,
+                 max_new_tokens: int = INFERENCE_MAX_NEW_TOKENS):
+        self.num_workers = max(1, num_workers)
+        self.slots_per_worker = max(1, slots_per_worker)
+        self.max_new_tokens = max(1, max_new_tokens)
+        self._ctx = mp.get_context("spawn")
+        self._workers: List[_WorkerHandle] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._req_ids = itertools.count(1)
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._started = False
+        self._stopping = False
+        self.stats = {"requests": 0, "completed": 0, "cancelled": 0, "errors": 0, "crashes": 0,
+                      "generated_tokens": 0}
+
+    @property
+    def started(self) -> bool:
+        return self._started
+
+    async def start(self, warmup_roles: Tuple[str, ...] = ()) -> None:
+        """Spawn workers (idempotent). warmup_roles loads those models before returning."""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._started:
+                return
+            self._loop = asyncio.get_running_loop()
+            self._stopping = False
+            for i in range(self.num_workers):
+                handle = _WorkerHandle(i, self.slots_per_worker, self.max_new_tokens)
+                self._workers.append(handle)
+                self._spawn(handle)
+            self._started = True
+        if warmup_roles:
+            await asyncio.gather(*(self._warmup(w, warmup_roles) for w in self._workers))
+
+    def _spawn(self, handle: _WorkerHandle) -> None:
+        size = handle.slots * _SLOT_CELLS * _CELL_BYTES
+        handle.shm = shared_memory.SharedMemory(create=True, size=size)
+        handle.cells = handle.shm.buf.cast("i")
+        for i in range(handle.slots * _SLOT_CELLS):
+            handle.cells[i] = 0
+        handle.free_slots = list(range(handle.slots))
+        parent_conn, child_conn = self._ctx.Pipe()
+        handle.process = self._ctx.Process(
+            target=_worker_main,
+            args=(handle.worker_id, child_conn, handle.shm.name, handle.slots, handle.max_new_tokens),
+            name=f"shieldllm-inference-{handle.worker_id}",
+            daemon=True,
+        )
+        handle.process.start()
+        child_conn.close()
+        handle.conn = parent_conn
+        handle.alive = True
+        handle.reader = threading.Thread(
+            target=self._reader_loop, args=(handle, parent_conn, handle.process), name=f"inference-reader-{handle.worker_id}", daemon=True
+        )
+        handle.reader.start()
+        logger.info("Inference worker %d started (pid %s)", handle.worker_id, handle.process.pid)
+
+    async def _warmup(self, handle: _WorkerHandle, roles: Tuple[str, ...]) -> None:
+        fut = self._loop.create_future()
+        handle.inflight[0] = (fut, -1)
+        handle.conn.send(("warmup", tuple(roles)))
+        await fut
+
+    def _reader_loop(self, handle: _WorkerHandle, conn, process) -> None:
+        """Thread: receive worker replies and resolve futures on the event loop. Once the pipe closes
+        the worker process is reaped here, so the event loop never blocks in join()."""
+        while True:
+            try:
+                kind, req_id, text, error = conn.recv()
+            except (EOFError, OSError):
+                break
+            if not self._post(self._resolve, handle, kind, req_id, text, error):
+                return
+        process.join(timeout=1)
+        if process.is_alive():
+            process.kill()
+        self._post(self._on_worker_exit, handle, conn)
+
+    def _post(self, callback, *args) -> bool:
+        """call_soon_threadsafe from a reader thread; False once the event loop has been closed."""
+        if self._loop.is_closed():
+            return False
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Closed between the check and the call
+            return False
+        return True
+
+    def _resolve(self, handle: _WorkerHandle, kind: str, req_id: int, text: Optional[str], error: Optional[str]) -> None:
+        if kind == "ready":
+            req_id = 0
+        entry = handle.inflight.pop(req_id, None)
+        if entry is None:
+            return
+        fut, slot = entry
+        if slot >= 0:
+            self._release_slot(handle, slot)
+        if fut.done():
+            return
+        if kind == "ready":
+            fut.set_result(None)
+        elif kind == "result":
+            self.stats["completed"] += 1
+            fut.set_result(text)
+        elif kind == "cancelled":
+            self.stats["cancelled"] += 1
+            fut.cancel()
+        else:
+            self.stats["errors"] += 1
+            fut.set_exception(RuntimeError(f"Inference worker error: {error}"))
+
+    def _release_slot(self, handle: _WorkerHandle, slot: int) -> None:
+        base = slot * _SLOT_CELLS
+        self.stats["generated_tokens"] += handle.cells[base + 1]
+        handle.cells[base] = 0
+        handle.cells[base + 1] = 0
+        while handle.slot_waiters:
+            waiter = handle.slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(slot)
+                return
+        handle.free_slots.append(slot)
+
+    async def _acquire_slot(self, handle: _WorkerHandle) -> int:
+        if handle.free_slots:
+            return handle.free_slots.pop()
+        waiter = self._loop.create_future()
+        handle.slot_waiters.append(waiter)
+        return await waiter
+
+    def _on_worker_exit(self, handle: _WorkerHandle, conn) -> None:
+        if handle.conn is not conn:
+            return
+        handle.alive = False
+        from llm_client import LLMConnectionError
+        lost = LLMConnectionError(f"Inference worker {handle.worker_id} connection lost")
+        for fut, _slot in handle.inflight.values():
+            if not fut.done():
+                fut.set_exception(lost)
+        handle.inflight.clear()
+        while handle.slot_waiters:
+            waiter = handle.slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(lost)
+        handle.free_slots = []
+        # The reader thread already reaped the process
+        self._teardown(handle, reap=False)
+        if self._stopping:
+            return
+        self.stats["crashes"] += 1
+        logger.error("Inference worker %d exited unexpectedly; restarting", handle.worker_id)
+        self._loop.create_task(self._restart(handle))
+
+    async def _restart(self, handle: _WorkerHandle) -> None:
+        await asyncio.sleep(INFERENCE_RESTART_BACKOFF * min(handle.restarts + 1, 5))
+        if self._stopping:
+            return
+        handle.restarts += 1
+        self._spawn(handle)
+
+    def _teardown(self, handle: _WorkerHandle, reap: bool = True) -> None:
+        if reap and handle.process is not None:
+            handle.process.join(timeout=1)
+            if handle.process.is_alive():
+                handle.process.kill()
+        if handle.cells is not None:
+            handle.cells.release()
+            handle.cells = None
+        if handle.shm is not None:
+            handle.shm.close()
+            try:
+                handle.shm.unlink()
+            except FileNotFoundError:
+                pass
+            handle.shm = None
+
+    def _pick_worker(self) -> _WorkerHandle:
+        live = [w for w in self._workers if w.alive]
+        if not live:
+            from llm_client import LLMConnectionError
+            raise LLMConnectionError("No inference worker available (connection lost, restarting)")
+        return min(live, key=lambda w: len(w.inflight))
+
+    async def generate(self, role: str, messages: List[Dict[str, str]], max_tokens: int) -> str:
+        """Run one chat completion on a worker. Cancelling the awaiting task cancels generation."""
+        if not self._started:
+            await self.start()
+        self.stats["requests"] += 1
+        handle = self._pick_worker()
+        slot = await self._acquire_slot(handle)
+        req_id = next(self._req_ids)
+        fut = self._loop.create_future()
+        handle.inflight[req_id] = (fut, slot)
+        handle.conn.send(("generate", req_id, slot, role, messages, max_tokens))
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # Flag the slot; the worker stops at its next step and the reader releases the slot.
+            if handle.cells is not None and req_id in handle.inflight:
+                handle.cells[slot * _SLOT_CELLS] = 1
+            raise
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "workers": [
+                {
+                    "worker_id": w.worker_id,
+                    "alive": w.alive,
+                    "pid": w.process.pid if w.process is not None else None,
+                    "inflight": len(w.inflight),
+                    # Tokens generated so far by each in-flight request, read from its slot
+                    "inflight_tokens": [w.cells[slot * _SLOT_CELLS + 1] for _fut, slot in w.inflight.values()
+                                        if slot >= 0 and w.cells is not None],
+                    "restarts": w.restarts,
+                }
+                for w in self._workers
+            ],
+        }
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for handle in self._workers:
+            if handle.alive:
+                try:
+                    handle.conn.send(("stop",))
+                except (OSError, BrokenPipeError):
+                    pass
+        deadline = time.time() + 5
+        for handle in self._workers:
+            if handle.process is not None:
+                handle.process.join(timeout=max(0.1, deadline - time.time()))
+            if handle.conn is not None:
+                handle.conn.close()
+            self._teardown(handle)
+        self._workers.clear()
+        self._started = False
+
+
+_pool: Optional[InferenceWorkerPool] = None
+
+
+def inference_workers_enabled() -> bool:
+    return INFERENCE_WORKERS > 0
+
+
+def get_inference_pool() -> InferenceWorkerPool:
+    global _pool
+    if _pool is None:
+        _pool = InferenceWorkerPool()
+    return _pool
+
+
+async def shutdown_inference_pool() -> None:
+    if _pool is not None and _pool.started:
+        await _pool.stop()
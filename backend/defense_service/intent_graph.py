@@ -18,6 +18,27 @@ def build_intent_graph(conversation: Dict[str, Any]) -> Tuple[Dict[str, Any], Li
     return updated_graph, violations
 
 
+def build_turn_node(conversation: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Next history node for a server-held graph (graph_store.py), without copying the graph's history.
+    conversation: as for build_intent_graph, with "intent_graph" holding the graph's fields besides
+                  history and "turn" the new node's turn number.
+    Returns (node, violations).
+    """
+    builder = IntentGraphBuilder(conversation.get("intent_graph") or {})
+    return builder.next_node(
+        conversation.get("turn") or 1,
+        conversation.get("user_text") or "",
+        conversation.get("signals") or [],
+        conversation.get("history") or [],
+    )
+
+
+def seed_graph(intent_graph: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """A client's graph as the builder would start from it (minimal structure filled in)."""
+    return IntentGraphBuilder(copy.deepcopy(intent_graph or {})).graph
+
+
 class IntentGraphBuilder:
     def __init__(self, initial_graph: Dict[str, Any]):
         self.graph = dict(initial_graph) if initial_graph else {}
@@ -37,7 +58,17 @@ class IntentGraphBuilder:
         Update the intent graph based on new user input, signals, and conversation history.
         """
         current_turn = len(self.graph.get("history", [])) + 1
+        new_node, violations = self.next_node(current_turn, user_text, signals, history)
+        self.graph["history"].append(new_node)
+        
+        # Update dynamic "allowed" list if it's a natural progression (Placeholder for real logic)
+        # e.g., if intent is "read_code", maybe add "explain_code" to allowed if not present
         
+        return self.graph, violations
+
+    def next_node(self, current_turn: int, user_text: str, signals: List[str],
+                  history: Optional[List[Dict[str, str]]] = None) -> Tuple[Dict[str, Any], List[str]]:
+        """History node for this turn and the violations it raises; the graph is not modified."""
         # 1. Simple Keyword Intent Extraction (MVP)
         extracted_intent = self._extract_intent(user_text)
         
@@ -81,13 +112,7 @@ class IntentGraphBuilder:
             "suspicion": suspicion_level,
             "violations": violations
         }
-        
-        self.graph["history"].append(new_node)
-        
-        # Update dynamic "allowed" list if it's a natural progression (Placeholder for real logic)
-        # e.g., if intent is "read_code", maybe add "explain_code" to allowed if not present
-        
-        return self.graph, violations
+        return new_node, violations
 
     def _extract_intent(self, text: str) -> str:
         text_lower = text.lower()
@@ -13,19 +13,11 @@ Robust fallback: call_primary/call_shadow return (text, meta) and never raise; m
 """
 import asyncio
 import logging
-import os
 import time
 import hashlib
-from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
-try:
-    from dotenv import load_dotenv
-    _root = Path(__file__).resolve().parent.parent
-    load_dotenv(_root / ".env")
-    load_dotenv(_root / ".env.local")
-except Exception:
-    pass
+from settings import settings
 
 logger = logging.getLogger("shieldllm.defense.llm")
 
@@ -42,14 +34,18 @@ class LLMBadResponseError(Exception):
     """LLM returned invalid or empty response."""
     pass
 
-from cachetools import TTLCache
+from inference_worker import get_inference_pool, inference_workers_enabled
+from response_cache import TieredCache, compute_rules_version
+from semantic_cache import SEMANTIC_CACHE_ENABLED, semantic_cache, semantic_scope
+from circuit_breaker import breaker_name, circuit_breakers
+from event_log import log_event
+from tracing import annotate, span
 
-# In-memory TTL cache to prevent memory leaks, with maxsize constraint
-llm_cache = TTLCache(maxsize=1000, ttl=3600)
+# Tiered response cache: byte-bounded memory LRU + SQLite shared by all workers on the host.
+# The disk tier is opened (and stale rules versions purged) by init_backends() at startup.
+llm_cache = TieredCache()
 
-import asyncio
 from functools import wraps
-from typing import Dict, Any
 
 llm_stats = {
     "total_calls": 0,
@@ -67,6 +63,8 @@ def get_llm_metrics() -> Dict[str, Any]:
         "cache_hits": llm_stats["cache_hits"],
         "cache_misses": llm_stats["cache_misses"],
         "cache_size": size,
+        "cache_tiers": llm_cache.get_stats(),
+        "semantic_cache": semantic_cache.get_stats(),
         "llm_total_calls": llm_stats["total_calls"],
         "llm_failed_calls": llm_stats["failed_calls"],
         "llm_failure_rate": round(fr, 4)
@@ -74,42 +72,25 @@ def get_llm_metrics() -> Dict[str, Any]:
 
 # Retry logic moved to call_primary and call_shadow
 
-# --- Config from env ---
-LLM_MODE = (os.environ.get("LLM_MODE", "") or "").strip().lower()
-if LLM_MODE not in ("lmstudio", "transformers"):
-    LLM_MODE = ""
-
-PRIMARY_MODEL = os.environ.get("PRIMARY_MODEL", "llama3-8b-8192").strip()
-SHADOW_MODEL = os.environ.get("SHADOW_MODEL", "llama3-8b-8192").strip()
-PRIMARY_BASE_URL = os.environ.get("PRIMARY_BASE_URL", "").strip()
-SHADOW_BASE_URL = os.environ.get("SHADOW_BASE_URL", "").strip()
-MODEL_DEVICE = (os.environ.get("MODEL_DEVICE", "cpu")).strip().lower()
-if MODEL_DEVICE not in ("cuda", "cpu"):
-    MODEL_DEVICE = "cpu"
+# --- Config (parsed once in settings.py) ---
+LLM_MODE = settings.llm_mode
+PRIMARY_MODEL = settings.primary_model
+SHADOW_MODEL = settings.shadow_model
+PRIMARY_BASE_URL = settings.primary_base_url
+SHADOW_BASE_URL = settings.shadow_base_url
+MODEL_DEVICE = settings.model_device
 
-DEFAULT_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", "512"))
+DEFAULT_MAX_TOKENS = settings.default_max_tokens
 EMPTY_KEY = "EMPTY"
 # Timeouts (seconds); 0 = no timeout
-LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "15"))
-LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "120"))
-HEALTH_CACHE_TTL = int(os.environ.get("HEALTH_CACHE_TTL", "30"))
-
-# Health check cache: { "primary": (ok: bool, ts: float), "shadow": ... }
-_health_cache: Dict[str, Tuple[bool, float]] = {}
+LLM_CONNECT_TIMEOUT = settings.llm_connect_timeout
+LLM_READ_TIMEOUT = settings.llm_read_timeout
 
 # LM Studio: when mode=lmstudio, use PRIMARY_BASE_URL (default 1234), SHADOW_BASE_URL (default 1235)
 # If only one LM Studio server, use same base_url with different models
-USE_SINGLE_LM_STUDIO = False
-USE_PRIMARY_BASE_URL = bool(PRIMARY_BASE_URL)
-USE_SHADOW_BASE_URL = bool(SHADOW_BASE_URL)
-if LLM_MODE == "lmstudio":
-    if not PRIMARY_BASE_URL:
-        PRIMARY_BASE_URL = "http://localhost:1234/v1"
-    if not SHADOW_BASE_URL or SHADOW_BASE_URL == PRIMARY_BASE_URL:
-        SHADOW_BASE_URL = PRIMARY_BASE_URL
-        USE_SINGLE_LM_STUDIO = True
-    USE_PRIMARY_BASE_URL = True
-    USE_SHADOW_BASE_URL = True
+USE_SINGLE_LM_STUDIO = settings.use_single_lm_studio
+USE_PRIMARY_BASE_URL = settings.use_primary_base_url
+USE_SHADOW_BASE_URL = settings.use_shadow_base_url
 
 # --- Client singletons ---
 _primary_client: Optional[Any] = None
@@ -139,33 +120,25 @@ def _get_lmstudio_shadow_client():
 
 
 # --- Hugging Face primary (legacy when LLM_MODE empty and PRIMARY_MODEL has /, no PRIMARY_BASE_URL) ---
-USE_HF_PRIMARY = "/" in PRIMARY_MODEL and LLM_MODE != "lmstudio" and LLM_MODE != "transformers" and not USE_PRIMARY_BASE_URL
+USE_HF_PRIMARY = settings.use_hf_primary
 _hf_client = None
 
-if USE_HF_PRIMARY:
-    try:
-        from huggingface_hub import login
-        token = os.environ.get("HF_TOKEN", "").strip()
-        login(token=token if token else None, new_session=False)
-    except Exception as e:
-        logger.warning("Hugging Face login skipped or failed: %s", e)
-
 
 def _get_hf_client():
     global _hf_client
     if _hf_client is None:
         from huggingface_hub import AsyncInferenceClient
-        token = os.environ.get("HF_TOKEN", "").strip()
-        _hf_client = AsyncInferenceClient(token=token if token else None)
+        _hf_client = AsyncInferenceClient(token=settings.hf_token or None)
     return _hf_client
 
 
 # --- Cloud backend (Groq only) ---
+_cloud_clients: Dict[str, Any] = {}
+
+
 def _get_cloud_client(model_type: str, requested_model: str):
-    from openai import AsyncOpenAI
-    
     if model_type == "groq":
-        api_key = os.environ.get("GROQ_API_KEY", "").strip()
+        api_key = settings.groq_api_key
         base_url = "https://api.groq.com/openai/v1"
         provider = "groq"
         model = requested_model
@@ -175,7 +148,40 @@ def _get_cloud_client(model_type: str, requested_model: str):
     if not api_key or "xxxx" in api_key.lower() or len(api_key) < 10 or api_key.startswith("sk-proj-"):
         raise ValueError(f"GROQ_API_KEY required or invalid.")
 
-    return AsyncOpenAI(api_key=api_key, base_url=base_url), provider, base_url, model
+    # One client (and connection pool) per provider, built by init_backends() at startup
+    client = _cloud_clients.get(provider)
+    if client is None:
+        from openai import AsyncOpenAI
+        client = _cloud_clients[provider] = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    return client, provider, base_url, model
+
+
+def init_backends() -> Dict[str, float]:
+    """Open the LLM response cache and build the clients the configured backends need, so neither
+    import nor the first request pays for SQLite setup, imports, Hugging Face login or client construction. Called from the app lifespan before serving (in a thread);
+    failures are logged and left to the request path and health prober. Returns per-step timings in ms."""
+    from health_prober import backend_for
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    llm_cache.open(compute_rules_version())
+    timings["llm_cache"] = round((time.perf_counter() - start) * 1000, 2)
+    for role in ("primary", "shadow"):
+        kind = backend_for(role)[0]
+        start = time.perf_counter()
+        try:
+            if kind == "openai_compat":
+                _get_lmstudio_primary_client() if role == "primary" else _get_lmstudio_shadow_client()
+            elif kind == "huggingface":
+                from huggingface_hub import login
+                login(token=settings.hf_token or None, new_session=False)
+                _get_hf_client()
+            elif kind == "groq":
+                _get_cloud_client(settings.model_type, PRIMARY_MODEL if role == "primary" else SHADOW_MODEL)
+            # transformers: models load in inference workers (or on first in-process use)
+        except Exception as e:
+            logger.warning("Backend setup for %s (%s) skipped or failed: %s", role, kind, e)
+        timings[f"{role}:{kind}"] = round((time.perf_counter() - start) * 1000, 2)
+    return timings
 
 
 # --- Transformers backend (in-process) ---
@@ -235,10 +241,11 @@ def _load_transformers_shadow():
     return _transformer_shadow
 
 
-def _transformers_generate(model, tokenizer, device: str, messages: List[Dict[str, str]], max_tokens: int = 512) -> str:
-    """Run chat completion with transformers."""
+def _transformers_generate(model, tokenizer, device: str, messages: List[Dict[str, str]], max_tokens: int = 512,
+                           stopping_criteria: Optional[List[Any]] = None) -> str:
+    """Run chat completion with transformers. stopping_criteria is used by inference workers for cancellation."""
     import torch
-    from transformers import TextIteratorStreamer
+    from transformers import StoppingCriteriaList
     prompt_parts = []
     for m in messages:
         role = (m.get("role") or "user").lower()
@@ -251,6 +258,9 @@ def _transformers_generate(model, tokenizer, device: str, messages: List[Dict[st
             prompt_parts.append(f"Assistant: {content}\n\n")
     prompt_parts.append("Assistant: ")
     prompt = "".join(prompt_parts)
+    # prompt_assembly fits the budget; if anything still overflows, cut from the left so the
+    # current user message and the "Assistant: " cue survive
+    tokenizer.truncation_side = "left"
     inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=4096).to(
         model.device if hasattr(model, "device") else next(model.parameters()).device
     )
@@ -261,62 +271,24 @@ def _transformers_generate(model, tokenizer, device: str, messages: List[Dict[st
             do_sample=False,
             temperature=0,
             pad_token_id=tokenizer.eos_token_id,
+            stopping_criteria=StoppingCriteriaList(stopping_criteria) if stopping_criteria else None,
         )
     response = tokenizer.decode(out[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True).strip()
     return response
 
 
-# --- Health checks (with caching) ---
-
-def _health_cache_valid(key: str) -> Optional[bool]:
-    """Return cached health result if still valid; else None."""
-    entry = _health_cache.get(key)
-    if not entry:
-        return None
-    ok, ts = entry
-    if time.time() - ts > HEALTH_CACHE_TTL:
-        return None
-    return ok
-
-
-def _health_cache_set(key: str, ok: bool) -> None:
-    _health_cache[key] = (ok, time.time())
-
+# --- Health checks (published by the background prober; never block) ---
 
 async def check_primary_health() -> bool:
-    """Probe primary endpoint; cache result for HEALTH_CACHE_TTL seconds."""
-    cached = _health_cache_valid("primary")
-    if cached is not None:
-        return cached
-    try:
-        text, meta = await call_primary(
-            [{"role": "user", "content": "Hi"}],
-            max_tokens=5,
-        )
-        ok = meta.get("ok", False)
-        _health_cache_set("primary", ok)
-        return ok
-    except Exception:
-        _health_cache_set("primary", False)
-        return False
+    """Last primary status from health_prober. Optimistic (True) until the first probe completes."""
+    from health_prober import health_prober
+    return health_prober.is_healthy("primary") is not False
 
 
 async def check_shadow_health() -> bool:
-    """Probe shadow endpoint; cache result for HEALTH_CACHE_TTL seconds."""
-    cached = _health_cache_valid("shadow")
-    if cached is not None:
-        return cached
-    try:
-        text, meta = await call_shadow(
-            [{"role": "user", "content": "Hi"}],
-            max_tokens=5,
-        )
-        ok = meta.get("ok", False)
-        _health_cache_set("shadow", ok)
-        return ok
-    except Exception:
-        _health_cache_set("shadow", False)
-        return False
+    """Last shadow status from health_prober. Optimistic (True) until the first probe completes."""
+    from health_prober import health_prober
+    return health_prober.is_healthy("shadow") is not False
 
 
 # --- Public API: call_primary / call_shadow return (text, meta), never raise ---
@@ -346,13 +318,15 @@ async def call_primary(
     max_tokens: Optional[int] = None,
     retry_budget: Optional[Dict[str, int]] = None,
     model_type: str = "groq",
-    policy: Optional[Dict[str, Any]] = None,
+    policy_id: str = "",
     intent_graph: Optional[Dict[str, Any]] = None,
     session_id: str = "",
-    disable_cache: bool = False
+    disable_cache: bool = False,
+    semantic_text: Optional[str] = None
 ) -> Tuple[Optional[str], Dict[str, Any]]:
     """
     Primary LLM call. Returns (text, meta). Never raises.
+    semantic_text: canonicalized single-turn input; enables the canonical-text cache when set.
     On failure: text=None, meta.ok=False, meta.error_type, meta.error_message.
     """
     max_tok = max_tokens or DEFAULT_MAX_TOKENS
@@ -364,25 +338,42 @@ async def call_primary(
         base_url = "huggingface"
     elif LLM_MODE == "transformers":
         base_url = "transformers"
+    # Canonical-text lookup first: exact text, no full-graph serialization
+    scope = ""
+    if semantic_text is not None and SEMANTIC_CACHE_ENABLED and not disable_cache:
+        scope = semantic_scope(policy_id, intent_graph, model_type)
+        cached = semantic_cache.lookup("primary", semantic_text, scope)
+        if cached:
+            llm_stats["cache_hits"] += 1
+            annotate(cache="semantic")
+            return cached[0], {**cached[1], "cache": "semantic"}
+
     # Cache Isolation Fix: Include context in key
     import json
     cache_key = "disabled"
-    if not disable_cache and intent_graph and policy and session_id:
+    if not disable_cache and intent_graph and policy_id and session_id:
         cache_data = {
             "messages": messages,
             "model": model_type,
-            "policy": policy,
+            "policy": policy_id,
             "intent": intent_graph,
             "user_id": session_id
         }
         cache_key = hashlib.sha256(json.dumps(cache_data, sort_keys=True).encode()).hexdigest()
-        cached = llm_cache.get(f"primary_{cache_key}")
+        cached = await llm_cache.get(f"primary_{cache_key}")
         if cached:
             llm_stats["cache_hits"] += 1
-            return cached
+            annotate(cache="exact")
+            return cached[0], {**cached[1], "cache": "exact"}
     
     llm_stats["cache_misses"] += 1
 
+    # Per-backend breaker: only real calls report to it, once per call after retries
+    breaker = breaker_name("primary")
+    if not await circuit_breakers.allow(breaker, "primary"):
+        annotate(circuit="open")
+        return (None, _meta(False, "primary", model, base_url, 0.0, "CircuitOpen", f"Circuit breaker open for primary", provider=model_type, model_type=model_type))
+
     budget = retry_budget if retry_budget is not None else {"remaining": 3}
     start = time.perf_counter()
     
@@ -390,16 +381,21 @@ async def call_primary(
         llm_stats["total_calls"] += 1
         try:
             t = LLM_READ_TIMEOUT if LLM_READ_TIMEOUT > 0 else None
-            if t:
-                text, used_provider, used_model, used_base_url = await asyncio.wait_for(
-                    _generate_primary_impl(messages, max_tok, model_type),
-                    timeout=t,
-                )
-            else:
-                text, used_provider, used_model, used_base_url = await _generate_primary_impl(messages, max_tok, model_type)
+            with span("primary.attempt", attempt=attempt):
+                if t:
+                    text, used_provider, used_model, used_base_url = await asyncio.wait_for(
+                        _generate_primary_impl(messages, max_tok, model_type),
+                        timeout=t,
+                    )
+                else:
+                    text, used_provider, used_model, used_base_url = await _generate_primary_impl(messages, max_tok, model_type)
             elapsed = (time.perf_counter() - start) * 1000
             res = (text, _meta(True, "primary", used_model, used_base_url, elapsed, provider=used_provider, model_type=model_type))
-            llm_cache[f"primary_{cache_key}"] = res
+            await circuit_breakers.record(breaker, True)
+            if cache_key != "disabled":
+                await llm_cache.set(f"primary_{cache_key}", res, session=session_id, policy=policy_id)
+            if scope:
+                semantic_cache.store("primary", semantic_text, scope, res)
             return res
         except Exception as e:
             llm_stats["failed_calls"] += 1
@@ -412,14 +408,17 @@ async def call_primary(
                     err_type = "LLMTimeoutError"
                 elif isinstance(e, (ConnectionError, OSError)):
                     err_type = "LLMConnectionError"
+                await circuit_breakers.record(breaker, False)
                 return (None, _meta(False, "primary", model, base_url, elapsed, err_type, str(e), provider=model_type, model_type=model_type))
             
             budget["remaining"] -= 1
             delay = min(2 ** (3 - budget["remaining"]), 8) # max 8s backoff
-            logger.warning(f"Retry primary after {delay}s. Remaining budget: {budget['remaining']}")
-            await asyncio.sleep(delay)
+            log_event("llm.retry", logging.WARNING, role="primary", delay_s=delay, remaining=budget["remaining"], error=str(e))
+            with span("primary.retry_backoff", delay_s=delay):
+                await asyncio.sleep(delay)
             
     elapsed = (time.perf_counter() - start) * 1000
+    await circuit_breakers.record(breaker, False)
     return (None, _meta(False, "primary", model, base_url, elapsed, "MaxRetriesExceeded", "Retries exhausted", provider=model_type, model_type=model_type))
 
 
@@ -428,13 +427,15 @@ async def call_shadow(
     max_tokens: Optional[int] = None,
     retry_budget: Optional[Dict[str, int]] = None,
     model_type: str = "groq",
-    policy: Optional[Dict[str, Any]] = None,
+    policy_id: str = "",
     intent_graph: Optional[Dict[str, Any]] = None,
     session_id: str = "",
-    disable_cache: bool = False
+    disable_cache: bool = False,
+    semantic_text: Optional[str] = None
 ) -> Tuple[Optional[str], Dict[str, Any]]:
     """
     Shadow LLM call. Returns (text, meta). Never raises.
+    semantic_text: canonicalized single-turn input; enables the canonical-text cache when set.
     """
     max_tok = max_tokens or DEFAULT_MAX_TOKENS
     model = SHADOW_MODEL
@@ -445,25 +446,42 @@ async def call_shadow(
         base_url = "transformers"
     elif not USE_SHADOW_BASE_URL and not LLM_MODE:
         base_url = "groq"
+    # Canonical-text lookup first: exact text, no full-graph serialization
+    scope = ""
+    if semantic_text is not None and SEMANTIC_CACHE_ENABLED and not disable_cache:
+        scope = semantic_scope(policy_id, intent_graph, model_type)
+        cached = semantic_cache.lookup("shadow", semantic_text, scope)
+        if cached:
+            llm_stats["cache_hits"] += 1
+            annotate(cache="semantic")
+            return cached[0], {**cached[1], "cache": "semantic"}
+
     # Cache Isolation Fix: Include context in key
     import json
     cache_key = "disabled"
-    if not disable_cache and intent_graph and policy and session_id:
+    if not disable_cache and intent_graph and policy_id and session_id:
         cache_data = {
             "messages": messages,
             "model": model_type,
-            "policy": policy,
+            "policy": policy_id,
             "intent": intent_graph,
             "user_id": session_id
         }
         cache_key = hashlib.sha256(json.dumps(cache_data, sort_keys=True).encode()).hexdigest()
-        cached = llm_cache.get(f"shadow_{cache_key}")
+        cached = await llm_cache.get(f"shadow_{cache_key}")
         if cached:
             llm_stats["cache_hits"] += 1
-            return cached
+            annotate(cache="exact")
+            return cached[0], {**cached[1], "cache": "exact"}
     
     llm_stats["cache_misses"] += 1
 
+    # Per-backend breaker: only real calls report to it, once per call after retries
+    breaker = breaker_name("shadow")
+    if not await circuit_breakers.allow(breaker, "shadow"):
+        annotate(circuit="open")
+        return (None, _meta(False, "shadow", model, base_url, 0.0, "CircuitOpen", f"Circuit breaker open for shadow", provider=model_type, model_type=model_type))
+
     budget = retry_budget if retry_budget is not None else {"remaining": 3}
     start = time.perf_counter()
     
@@ -471,16 +489,21 @@ async def call_shadow(
         llm_stats["total_calls"] += 1
         try:
             t = LLM_READ_TIMEOUT if LLM_READ_TIMEOUT > 0 else None
-            if t:
-                text, used_provider, used_model, used_base_url = await asyncio.wait_for(
-                    _generate_shadow_impl(messages, max_tok, model_type),
-                    timeout=t,
-                )
-            else:
-                text, used_provider, used_model, used_base_url = await _generate_shadow_impl(messages, max_tok, model_type)
+            with span("shadow.attempt", attempt=attempt):
+                if t:
+                    text, used_provider, used_model, used_base_url = await asyncio.wait_for(
+                        _generate_shadow_impl(messages, max_tok, model_type),
+                        timeout=t,
+                    )
+                else:
+                    text, used_provider, used_model, used_base_url = await _generate_shadow_impl(messages, max_tok, model_type)
             elapsed = (time.perf_counter() - start) * 1000
             res = (text, _meta(True, "shadow", used_model, used_base_url, elapsed, provider=used_provider, model_type=model_type))
-            llm_cache[f"shadow_{cache_key}"] = res
+            await circuit_breakers.record(breaker, True)
+            if cache_key != "disabled":
+                await llm_cache.set(f"shadow_{cache_key}", res, session=session_id, policy=policy_id)
+            if scope:
+                semantic_cache.store("shadow", semantic_text, scope, res)
             return res
         except Exception as e:
             llm_stats["failed_calls"] += 1
@@ -493,25 +516,38 @@ async def call_shadow(
                     err_type = "LLMTimeoutError"
                 elif isinstance(e, (ConnectionError, OSError)):
                     err_type = "LLMConnectionError"
+                await circuit_breakers.record(breaker, False)
                 return (None, _meta(False, "shadow", model, base_url, elapsed, err_type, str(e), provider=model_type, model_type=model_type))
             
             budget["remaining"] -= 1
             delay = min(2 ** (3 - budget["remaining"]), 8) # max 8s backoff
-            logger.warning(f"Retry shadow after {delay}s. Remaining budget: {budget['remaining']}")
-            await asyncio.sleep(delay)
+            log_event("llm.retry", logging.WARNING, role="shadow", delay_s=delay, remaining=budget["remaining"], error=str(e))
+            with span("shadow.retry_backoff", delay_s=delay):
+                await asyncio.sleep(delay)
             
     elapsed = (time.perf_counter() - start) * 1000
+    await circuit_breakers.record(breaker, False)
     return (None, _meta(False, "shadow", model, base_url, elapsed, "MaxRetriesExceeded", "Retries exhausted", provider=model_type, model_type=model_type))
 
 
 async def _generate_primary_impl(messages: List[Dict[str, str]], max_tokens: int, model_type: str) -> Tuple[str, str, str, str]:
     """Internal: can raise. Used by call_primary which catches."""
-    async with llm_semaphore:
-        return await generate_primary(messages, max_tokens, model_type)
+    with span("llm_semaphore_wait"):
+        await llm_semaphore.acquire()
+    try:
+        with span("primary.generate"):
+            return await generate_primary(messages, max_tokens, model_type)
+    finally:
+        llm_semaphore.release()
 
 async def _generate_shadow_impl(messages: List[Dict[str, str]], max_tokens: int, model_type: str) -> Tuple[str, str, str, str]:
-    async with llm_semaphore:
-        return await generate_shadow(messages, max_tokens, model_type)
+    with span("llm_semaphore_wait"):
+        await llm_semaphore.acquire()
+    try:
+        with span("shadow.generate"):
+            return await generate_shadow(messages, max_tokens, model_type)
+    finally:
+        llm_semaphore.release()
 
 
 # --- Public API ---
@@ -536,6 +572,9 @@ async def generate_primary(messages: List[Dict[str, str]], max_tokens: Optional[
         return (choice.message.content or "").strip(), "lmstudio", PRIMARY_MODEL, PRIMARY_BASE_URL or "http://localhost:1234/v1"
 
     if LLM_MODE == "transformers":
+        if inference_workers_enabled():
+            text = await get_inference_pool().generate("primary", messages, mt)
+            return text, "transformers", PRIMARY_MODEL, "transformers-worker"
         model, tokenizer, device = _load_transformers_primary()
         text = await asyncio.to_thread(
             _transformers_generate, model, tokenizer, device, messages, mt
@@ -555,9 +594,7 @@ async def generate_primary(messages: List[Dict[str, str]], max_tokens: Optional[
         return (choice.message.content or "").strip(), "huggingface", PRIMARY_MODEL, "huggingface"
 
     client, provider, base_url, used_model = _get_cloud_client(model_type, PRIMARY_MODEL)
-    print(">>> CALLING GROQ LLM")
-    print("model:", used_model)
-    print("base_url:", base_url)
+    log_event("llm.request", logging.DEBUG, role="primary", provider=provider, model=used_model, base_url=base_url)
     resp = await client.chat.completions.create(
         model=used_model,
         messages=messages,
@@ -569,7 +606,7 @@ async def generate_primary(messages: List[Dict[str, str]], max_tokens: Optional[
     if not choice or not getattr(choice, "message", None):
         raise RuntimeError("Primary model returned no message")
     response = (choice.message.content or "").strip()
-    print(">>> LLM RAW RESPONSE:", response)
+    log_event("llm.response", logging.DEBUG, role="primary", model=used_model, response=response)
     return response, provider, used_model, base_url
 
 
@@ -593,6 +630,9 @@ async def generate_shadow(messages: List[Dict[str, str]], max_tokens: Optional[i
         return (choice.message.content or "").strip(), "lmstudio", SHADOW_MODEL, SHADOW_BASE_URL or PRIMARY_BASE_URL or "http://localhost:1234/v1"
 
     if LLM_MODE == "transformers":
+        if inference_workers_enabled():
+            text = await get_inference_pool().generate("shadow", messages, mt)
+            return text, "transformers", SHADOW_MODEL, "transformers-worker"
         model, tokenizer, device = _load_transformers_shadow()
         text = await asyncio.to_thread(
             _transformers_generate, model, tokenizer, device, messages, mt
@@ -600,10 +640,7 @@ async def generate_shadow(messages: List[Dict[str, str]], max_tokens: Optional[i
         return text, "transformers", SHADOW_MODEL, "transformers"
 
     client, provider, base_url, used_model = _get_cloud_client(model_type, SHADOW_MODEL)
-
-    print(">>> CALLING GROQ LLM (Shadow)")
-    print("model:", used_model)
-    print("base_url:", base_url)
+    log_event("llm.request", logging.DEBUG, role="shadow", provider=provider, model=used_model, base_url=base_url)
     resp = await client.chat.completions.create(
         model=used_model,
         messages=messages,
@@ -615,7 +652,7 @@ async def generate_shadow(messages: List[Dict[str, str]], max_tokens: Optional[i
     if not choice or not getattr(choice, "message", None):
         raise RuntimeError("Shadow model returned no message")
     response = (choice.message.content or "").strip()
-    print(">>> LLM RAW RESPONSE (Shadow):", response)
+    log_event("llm.response", logging.DEBUG, role="shadow", model=used_model, response=response)
     return response, provider, used_model, base_url
 
 
@@ -652,10 +689,12 @@ def get_llm_status() -> dict:
     elif LLM_MODE == "transformers":
         parts.append(f"Transformers: Primary {PRIMARY_MODEL}, Shadow {SHADOW_MODEL}")
         parts.append(f"Device: {MODEL_DEVICE}")
+        if inference_workers_enabled():
+            parts.append(f"Inference workers: {get_inference_pool().num_workers}")
     elif USE_HF_PRIMARY:
         parts.append(f"Hugging Face primary: {PRIMARY_MODEL}")
-        if bool(os.environ.get("SHADOW_BASE_URL", "").strip()):
-            parts.append(f"Shadow: {os.environ.get('SHADOW_BASE_URL')} ({SHADOW_MODEL})")
+        if settings.shadow_base_url_env:
+            parts.append(f"Shadow: {settings.shadow_base_url_env} ({SHADOW_MODEL})")
         else:
             parts.append(f"Shadow: OpenAI ({SHADOW_MODEL})")
     else:
@@ -667,9 +706,9 @@ def get_llm_status() -> dict:
         and not USE_HF_PRIMARY
     ) or (
         LLM_MODE not in ("lmstudio", "transformers")
-        and not bool(os.environ.get("SHADOW_BASE_URL", "").strip())
+        and not settings.shadow_base_url_env
     )
-    api_key = os.environ.get("GROQ_API_KEY", "").strip() or os.environ.get("OPENAI_API_KEY", "").strip()
+    api_key = settings.groq_api_key or settings.openai_api_key
     if need_groq and (not api_key or "xxxx" in api_key.lower() or len(api_key) < 10 or api_key.startswith("sk-proj-")):
         return {"usingRealLLM": False, "reason": "GROQ_API_KEY not set"}
 
@@ -689,8 +728,8 @@ def get_debug_llm_info() -> dict:
         (LLM_MODE == "lmstudio") or
         (LLM_MODE == "" and USE_SHADOW_BASE_URL) or
         (LLM_MODE == "transformers") or
-        bool(os.environ.get("SHADOW_BASE_URL", "").strip()) or
-        bool(os.environ.get("OPENAI_API_KEY", "").strip())
+        bool(settings.shadow_base_url_env) or
+        bool(settings.openai_api_key)
     )
     return {
         "llm_mode": mode,
@@ -700,5 +739,6 @@ def get_debug_llm_info() -> dict:
         "shadow_configured": shadow_ok,
         "single_lm_studio": USE_SINGLE_LM_STUDIO if LLM_MODE == "lmstudio" else False,
         "device": MODEL_DEVICE if LLM_MODE == "transformers" else None,
+        "inference_workers": get_inference_pool().get_stats() if LLM_MODE == "transformers" and inference_workers_enabled() else None,
         "message": "Both primary and shadow inference paths are available." if get_llm_status().get("usingRealLLM") else "LLM not fully configured.",
     }
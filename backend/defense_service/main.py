@@ -3,42 +3,95 @@ Dual-LLM Prompt Injection Defense System using OpenAI API.
 Pipeline: User Input -> Intent Graph -> Sanitize -> Dual LLM -> Divergence -> Defense Controller.
 Detection from intent graph + output divergence only; no reliance on OpenAI safety filters.
 """
-from pathlib import Path
-from dotenv import load_dotenv
+import time
+
+_import_start = time.perf_counter()
 
-_backend_root = Path(__file__).resolve().parent.parent
-load_dotenv(_backend_root / ".env")       # backend defaults
-load_dotenv(_backend_root / ".env.local") # backend secrets
-_workspace_root = _backend_root.parent
-load_dotenv(_workspace_root / ".env")       # fallback for legacy root env
-load_dotenv(_workspace_root / ".env.local") # fallback for legacy root secrets
+# Loads the dotenv files once and parses config; must precede modules that read os.environ at import
+from settings import settings
 
-from fastapi import FastAPI, HTTPException, Body, Header
+from fastapi import FastAPI, HTTPException, Body, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import asyncio
 import logging
-import uvicorn
 import json
-import os
 
 from canonicalize import progressive_canonicalize
-from intent_graph import build_intent_graph
+from intent_graph import build_intent_graph, build_turn_node
 from sanitize import sanitize_input
 from divergence import compute_divergence, compute_divergence_degraded, injection_indicator_score
-from policy import decide_defense_action
-from llm_client import call_primary, call_shadow, get_llm_status, get_debug_llm_info, LLM_MODE as LLM_MODE_VAL, PRIMARY_MODEL
-from system_prompt import build_system_prompt
+from llm_client import call_primary, call_shadow, get_llm_status, get_debug_llm_info, init_backends, LLM_MODE as LLM_MODE_VAL, PRIMARY_MODEL, DEFAULT_MAX_TOKENS
+from prompt_assembly import prompt_assembler
+from session_store import create_session_store
+from graph_store import create_graph_store
+from rate_limiter import rate_limiter, retry_after_header
+from telemetry import StageTimer, telemetry
+from event_log import configure_logging, get_stats as get_logging_stats, log_event, shutdown_logging
+from tracing import TracingMiddleware, current_request_id, get_stats as get_tracing_stats
+from detector_exec import detectors
+from batch_analysis import BATCH_CONCURRENCY, BATCH_MAX_TURNS, batch_key_valid, get_stats as get_batch_stats, stream_batch
 from defense_controller import apply_defense
+from inference_worker import get_inference_pool, inference_workers_enabled, shutdown_inference_pool
+from health_prober import backend_for, health_prober
+from attack_index import ATTACK_INDEX_ENABLED, attack_index
+from circuit_breaker import breaker_name, circuit_breakers
+from campaign_sketch import CAMPAIGN_ENABLED, campaign_action, campaign_sketch
+from response_shapes import compact_view, encode as encode_compact, parse_fields, wants_compact
+from safe_regex import begin_request_budget, compile_rules, get_stats as get_regex_stats
+from audit_sink import audit_sink, turn_record
+from turn_analytics import ANALYTICS_ENABLED, turn_analytics
+from policy_registry import CompiledPolicy, PolicyError, policy_registry
+from transport import MSGPACK_TYPE, MsgpackRoute, encode_msgpack, get_stats as get_transport_stats, serve, wants_msgpack
+from contextlib import asynccontextmanager
 import base64
 import urllib.parse
 import binascii
 import re
 
-app = FastAPI(title="ShieldLLM Defense Service", description="Dual-LLM Prompt Injection Defense")
-
-allowed_origin = os.getenv("ALLOWED_ORIGIN", "*")
+# Request-path logging goes through a queue drained by a background thread (see event_log.py)
+configure_logging()
+
+# Startup phase timings (ms), exported under /metrics "startup"
+startup_timings: Dict[str, Any] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup/shutdown hooks: build backend clients, spawn inference workers and the health prober before serving."""
+    configure_logging()
+    phase = time.perf_counter()
+    startup_timings["backends"] = await asyncio.to_thread(init_backends)
+    startup_timings["backends_ms"] = round((time.perf_counter() - phase) * 1000, 2)
+    if LLM_MODE_VAL == "transformers" and inference_workers_enabled():
+        phase = time.perf_counter()
+        await get_inference_pool().start(warmup_roles=("primary", "shadow"))
+        startup_timings["inference_workers_ms"] = round((time.perf_counter() - phase) * 1000, 2)
+    await asyncio.to_thread(policy_registry.load)
+    health_prober.start()
+    audit_sink.start()
+    if ANALYTICS_ENABLED:
+        await turn_analytics.start()
+    if ATTACK_INDEX_ENABLED:
+        phase = time.perf_counter()
+        attack_index.start()
+        startup_timings["attack_index_ms"] = round((time.perf_counter() - phase) * 1000, 2)
+    startup_timings["ready_after_import_ms"] = round((time.perf_counter() - _import_start) * 1000, 2)
+    yield
+    await attack_index.stop()
+    await health_prober.stop()
+    await shutdown_inference_pool()
+    detectors.shutdown()
+    await audit_sink.stop()
+    await turn_analytics.stop()
+    shutdown_logging()
+
+
+app = FastAPI(title="ShieldLLM Defense Service", description="Dual-LLM Prompt Injection Defense", lifespan=lifespan)
+# Routes below also accept MessagePack bodies (Content-Type application/msgpack, see transport.py)
+app.router.route_class = MsgpackRoute
+
+allowed_origin = settings.allowed_origin
 origins = [allowed_origin, "http://localhost:3000", "http://localhost:3001"] if allowed_origin != "*" else ["*"]
 
 app.add_middleware(
@@ -48,29 +101,25 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Request IDs (X-Request-ID) and sampled span traces for /analyze; slow requests go to a rotating log
+app.add_middleware(TracingMiddleware)
 
 logger = logging.getLogger("shieldllm.defense")
 
+# Shown to the user when the primary LLM is unavailable and the verdict is heuristic-only
+PRIMARY_UNAVAILABLE_MESSAGE = "The analysis service is temporarily unavailable. Please try again in a moment."
+
+def _circuit_state() -> str:
+    """State of the current primary backend's breaker (logs, cache bypass, /metrics)."""
+    return circuit_breakers.state(breaker_name("primary"))
+
 # --- Multi-turn Conversation Store (FIX 3) ---
-conversation_store: Dict[str, List[Dict[str, str]]] = {}
-MAX_SESSIONS = 1000
+# Stored history is trimmed in chunks (down to MAX_HISTORY_TURNS once it exceeds twice that) so the
+# prompt prefix stays stable between trims; the prompt assembler then fits it into the token budget.
 MAX_HISTORY_TURNS = 10
-
-def _get_history(session_id: str) -> List[Dict[str, str]]:
-    return conversation_store.get(session_id, [])
-
-def _append_history(session_id: str, user_msg: str, assistant_msg: str):
-    if session_id not in conversation_store:
-        # Memory cap: evict oldest sessions if over limit
-        if len(conversation_store) >= MAX_SESSIONS:
-            keys_to_remove = list(conversation_store.keys())[:100]
-            for k in keys_to_remove:
-                conversation_store.pop(k, None)
-        conversation_store[session_id] = []
-    conversation_store[session_id].append({"role": "user", "content": user_msg})
-    conversation_store[session_id].append({"role": "assistant", "content": assistant_msg})
-    # Trim to last MAX_HISTORY_TURNS pairs (20 messages)
-    conversation_store[session_id] = conversation_store[session_id][-(MAX_HISTORY_TURNS * 2):]
+session_store = create_session_store(MAX_HISTORY_TURNS)
+# Session intent graphs for graphMode="server" (delta protocol, see graph_store.py)
+graph_store = create_graph_store()
 
 def try_decode(user_input: str) -> str:
     """Attempt to decode base64, hex, or url-encoded payloads."""
@@ -116,136 +165,6 @@ from collections import defaultdict
 import time
 import uuid
 
-import collections
-
-class RateLimiter:
-    def __init__(self, requests_per_minute=20, max_clients=10000):
-        self.requests_per_minute = requests_per_minute
-        self.requests = {}
-        self.locks = {}
-        self.max_clients = max_clients
-        
-    def _get_lock(self, client_id: str):
-        if client_id not in self.locks:
-            self.locks[client_id] = asyncio.Lock()
-        return self.locks[client_id]
-
-    async def is_allowed(self, client_id: str) -> bool:
-        now = time.time()
-        lock = self._get_lock(client_id)
-        
-        async with lock:
-            if client_id not in self.requests:
-                if len(self.requests) >= self.max_clients:
-                    # Fairness fix: TTL-based cleanup to prioritize inactive clients
-                    cutoff = now - 60
-                    inactive = [k for k, v in self.requests.items() if not v or v[-1] < cutoff]
-                    if inactive:
-                        for k in inactive[:50]:
-                            self.requests.pop(k, None)
-                            self.locks.pop(k, None)
-                    else:
-                        # Fallback to oldest active if no inactive found
-                        oldest = min(self.requests.keys(), key=lambda k: self.requests[k][-1] if self.requests[k] else 0)
-                        self.requests.pop(oldest, None)
-                        self.locks.pop(oldest, None)
-                self.requests[client_id] = []
-                
-            # Sliding window cleanup
-            self.requests[client_id] = [r for r in self.requests[client_id] if now - r < 60]
-            
-            if len(self.requests[client_id]) < self.requests_per_minute:
-                self.requests[client_id].append(now)
-                return True
-            return False
-
-rate_limiter = RateLimiter(requests_per_minute=20)
-
-class MetricsTracker:
-    def __init__(self):
-        self.total_requests = 0
-        self.total_failures = 0
-        self.request_timestamps = collections.deque()
-        self._lock = asyncio.Lock()
-        
-    async def record_request(self):
-        async with self._lock:
-            self.total_requests += 1
-            now = time.time()
-            self.request_timestamps.append(now)
-            while self.request_timestamps and now - self.request_timestamps[0] > 60:
-                self.request_timestamps.popleft()
-                
-    async def record_failure(self):
-        async with self._lock:
-            self.total_failures += 1
-            
-    async def get_metrics_snapshot(self):
-        async with self._lock:
-            now = time.time()
-            while self.request_timestamps and now - self.request_timestamps[0] > 60:
-                self.request_timestamps.popleft()
-            return {
-                "requests_per_minute": len(self.request_timestamps),
-                "total_requests": self.total_requests,
-                "total_failures": self.total_failures
-            }
-
-metrics = MetricsTracker()
-
-class CircuitBreaker:
-    def __init__(self, failure_threshold=5, success_threshold=2, reset_timeout=300):
-        self.failure_threshold = failure_threshold
-        self.success_threshold = success_threshold
-        self.reset_timeout = reset_timeout
-        self.failures = 0
-        self.successes = 0
-        self.last_failure_time = 0
-        self.state = "CLOSED"
-        self.half_open_probes = 0
-        self.lock = asyncio.Lock()
-
-    async def acquire(self) -> bool:
-        async with self.lock:
-            if self.state == "CLOSED":
-                return True
-            if self.state == "OPEN":
-                if time.time() - self.last_failure_time >= self.reset_timeout:
-                    self.state = "HALF-OPEN"
-                    self.successes = 0
-                    self.probe_in_progress = True # HALF_OPEN allows ONLY ONE request
-                    return True
-                return False
-            if self.state == "HALF-OPEN":
-                # Only allow one probe at a time
-                if getattr(self, "probe_in_progress", False):
-                    return False
-                self.probe_in_progress = True
-                return True
-            return False
-
-    async def record_success(self):
-        async with self.lock:
-            if self.state == "HALF-OPEN":
-                self.successes += 1
-                self.probe_in_progress = False
-                if self.successes >= self.success_threshold:
-                    self.state = "CLOSED"
-                    self.failures = 0
-                    self.successes = 0
-            elif self.state == "CLOSED":
-                self.failures = 0
-
-    async def record_failure(self):
-        async with self.lock:
-            self.failures += 1
-            self.last_failure_time = time.time()
-            self.probe_in_progress = False
-            if self.state == "HALF-OPEN" or self.failures >= self.failure_threshold:
-                self.state = "OPEN"
-
-circuit_breaker = CircuitBreaker()
-
 def compute_advanced_divergence(p_data: dict, s_data: dict) -> dict:
     """Weighted divergence scoring based on intent and risk gaps."""
     level_map = {"low": 10, "medium": 45, "high": 75, "critical": 95}
@@ -284,33 +203,155 @@ def compute_advanced_divergence(p_data: dict, s_data: dict) -> dict:
 @app.get("/")
 def root():
     """Root endpoint so GET http://localhost:8000 returns a valid response."""
-    print("[defense/root] GET / called")
     return {
         "service": "ShieldLLM Defense",
         "status": "running",
         "docs": "/docs",
         "health": "/health",
         "metrics": "/metrics",
+        "metrics_prometheus": "/metrics/prometheus",
+        "metrics_campaigns": "/metrics/campaigns",
         "llm_status": "/llm-status",
         "debug_llm": "GET /debug/llm",
         "analyze": "POST /analyze",
+        "analyze_batch": "POST /analyze/batch",
     }
 
+telemetry.register_gauge("circuit_open", "Circuit breakers (per role and backend) not CLOSED.",
+                         lambda: sum(b["state"] != "CLOSED" for b in circuit_breakers.snapshot()["breakers"].values()))
+telemetry.register_gauge("session_store_bytes", "Bytes of conversation history held by the session store.",
+                         lambda: session_store.stats()["bytes"])
+telemetry.register_gauge("campaigns_spiking", "Payload fingerprints above the campaign rate threshold.",
+                         lambda: campaign_sketch.get_stats()["spiking"])
+telemetry.register_gauge("rate_limiter_clients", "Clients tracked by the rate limiter.",
+                         lambda: rate_limiter.get_stats()["clients"])
+
 @app.get("/metrics")
 async def get_metrics():
     from llm_client import get_llm_metrics
-    stats = await metrics.get_metrics_snapshot()
+    stats = telemetry.snapshot()
     stats.update(get_llm_metrics())
-    stats["circuit_state"] = circuit_breaker.state
+    stats["circuit_state"] = _circuit_state()
+    stats["circuit_breakers"] = circuit_breakers.snapshot()
+    stats["attack_index"] = attack_index.get_stats()
+    stats["prompt_assembly"] = prompt_assembler.get_stats()
+    stats["sessions"] = session_store.stats()
+    stats["intent_graphs"] = graph_store.stats()
+    stats["rate_limiter"] = rate_limiter.get_stats()
+    stats["stage_latency"] = telemetry.stage_latency.snapshot()
+    stats["tracing"] = get_tracing_stats()
+    stats["logging"] = get_logging_stats()
+    stats["detectors"] = detectors.get_stats()
+    stats["batch"] = get_batch_stats()
+    stats["campaigns"] = campaign_sketch.get_stats()
+    stats["regex"] = get_regex_stats()
+    stats["audit"] = audit_sink.get_stats()
+    stats["analytics"] = turn_analytics.get_stats()
+    stats["policies"] = policy_registry.get_stats()
+    stats["transport"] = get_transport_stats()
+    stats["startup"] = startup_timings
     return stats
 
 
+@app.get("/metrics/prometheus")
+def get_metrics_prometheus():
+    """Counters and per-stage latency histograms in Prometheus text exposition format."""
+    from fastapi.responses import PlainTextResponse
+    return PlainTextResponse(telemetry.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/metrics/campaigns")
+def get_metrics_campaigns(limit: int = 20):
+    """Heaviest canonical-payload fingerprints across all clients (hashes only) and which are spiking."""
+    return {"campaigns": campaign_sketch.top(max(1, min(limit, 1000))), **campaign_sketch.get_stats()}
+
+
+@app.get("/attack-index")
+def list_attack_index(policy_id: Optional[str] = None, limit: int = 100):
+    """Learned known-attack entries (hashes and counters only), most recently seen first."""
+    return {"known_attacks": attack_index.list(policy_id, max(1, min(limit, 1000))), **attack_index.get_stats()}
+
+
+@app.delete("/attack-index/{entry_id}")
+def remove_attack_index_entry(entry_id: str):
+    """Forgets a learned entry (e.g. a false positive reported as known_attack:<id>). Other workers drop it
+    within ATTACK_INDEX_SAVE_INTERVAL; "held" says whether this worker had it."""
+    held = attack_index.remove(entry_id)
+    return {"status": "ok", "removed": entry_id, "held": held}
+
+
+def _analytics_query(query, *args):
+    """Runs a turn_analytics query; unknown metric/flag/column names are a 400."""
+    start = time.perf_counter()
+    try:
+        result = query(*args)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+
+@app.get("/stats/summary")
+def stats_summary(window: float = 3600):
+    """Turn count, action mix, flag rates and divergence/latency percentiles over the last window seconds (0 = all)."""
+    return _analytics_query(turn_analytics.summary, window)
+
+
+@app.get("/stats/percentiles")
+def stats_percentiles(metric: str = "divergence", by: Optional[str] = None, window: float = 3600, q: str = "50,95,99"):
+    """e.g. ?metric=divergence&by=defense_mode&window=3600&q=50,99"""
+    try:
+        quantiles = [max(0.0, min(100.0, float(x))) for x in q.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(400, "q must be comma-separated percentiles")
+    return _analytics_query(turn_analytics.percentiles, metric, by, window, quantiles)
+
+
+@app.get("/stats/rates")
+def stats_rates(flag: str = "shadow_disagree", by: Optional[str] = None, window: float = 3600):
+    """Share of turns with a flag (or category=value, e.g. action=contain), e.g. ?flag=shadow_disagree&by=model"""
+    return _analytics_query(turn_analytics.rates, flag, by, window)
+
+
+@app.post("/policies", status_code=201)
+def register_policy(response: Response, policy: Dict[str, Any] = Body(...)):
+    """Validates and compiles a policy; turns then send {"policyId": ...} instead of the policy.
+    The ID is a content hash: re-registering the same policy returns 200 with the existing entry."""
+    try:
+        compiled, created = policy_registry.register(policy)
+    except PolicyError as e:
+        raise HTTPException(400, f"Invalid policy: {e}")
+    if not created:
+        response.status_code = 200
+    return compiled.describe()
+
+
+@app.get("/policies")
+def list_policies():
+    return {"policies": [p.describe() for p in policy_registry.list()], **policy_registry.get_stats()}
+
+
+@app.get("/policies/{policy_id}")
+async def get_policy(policy_id: str):
+    compiled = await policy_registry.get(policy_id)
+    if compiled is None:
+        raise HTTPException(404, f"Unknown policyId {policy_id!r}")
+    return compiled.describe()
+
+
 # --- Request / Response models (keep API shape for frontend) ---
 class TurnRequest(BaseModel):
     userText: str
-    intentGraph: Dict[str, Any]
+    # Required unless graphMode is "server" and the service already holds the session's graph
+    intentGraph: Optional[Dict[str, Any]] = None
     defenseMode: str
-    policy: Dict[str, Any]
+    # Inline policy, or the ID of one registered with POST /policies (policyId wins)
+    policy: Dict[str, Any] = {}
+    policyId: Optional[str] = None
+    # "server": the service keeps the intent graph and returns graphDelta (graph_store.py); only honoured
+    # when the graph store is shared by all workers, otherwise the turn is answered inline
+    graphMode: Optional[str] = None
+    graphVersion: Optional[int] = None
     modelType: Optional[str] = None
     sessionId: Optional[str] = None
 
@@ -334,7 +375,10 @@ class AnalysisResponse(BaseModel):
     message: str = "OK"
     canonicalText: str
     signals: List[str]
-    updatedGraph: Dict[str, Any]
+    updatedGraph: Optional[Dict[str, Any]] = None
+    graphDelta: Optional[Dict[str, Any]] = None
+    # Whether graphMode "server" is available (the graph store is shared by all workers)
+    graphStoreShared: bool = False
     scores: Dict[str, float]
     riskLevel: str
     action: str
@@ -359,58 +403,72 @@ class AnalysisResponse(BaseModel):
 @app.post("/analyze", response_model_exclude_none=False)
 async def analyze_turn(
     req: TurnRequest, 
-    x_forwarded_for: Optional[str] = Header(None, alias="X-Forwarded-For")
+    x_forwarded_for: Optional[str] = Header(None, alias="X-Forwarded-For"),
+    x_response_shape: Optional[str] = Header(None, alias="X-Response-Shape"),
+    x_response_fields: Optional[str] = Header(None, alias="X-Response-Fields"),
+    accept: Optional[str] = Header(None),
+    shape: Optional[str] = None,
+    fields: Optional[str] = None,
 ):
-    print(">>> ENTERED FASTAPI /analyze")
-    print("modelType:", req.modelType)
-    print("circuit_state:", circuit_breaker.state)
-    
+    """Full AnalysisResponse by default; "compact" shape (header or ?shape=) per response_shapes.py.
+    Either shape is MessagePack-encoded when Accept asks for application/msgpack (transport.py)."""
+    log_event("analyze.start", logging.DEBUG, model_type=req.modelType, circuit_state=_circuit_state())
+
     from fastapi.responses import JSONResponse
-    req_id = str(uuid.uuid4())
+    req_id = current_request_id() or str(uuid.uuid4())
     client_ip = (x_forwarded_for or "unknown").split(",")[0].strip()
     
-    await metrics.record_request()
+    telemetry.record_request()
     
-    if not await rate_limiter.is_allowed(client_ip):
-        logger.warning(json.dumps({
-            "request_id": req_id, "client_id": client_ip, "rate_limited": True, "error": "Rate limit exceeded",
-            "model_type": req.modelType or "groq", "llm_called": False, "circuit_state": circuit_breaker.state,
-            "status": "degraded", "latency_ms": 0
-        }))
-        return JSONResponse(status_code=429, content={"status": "error", "message": "Too many requests. Please wait a minute."})
-
-    # Circuit Breaker check
-    if not await circuit_breaker.acquire():
-        logger.warning(json.dumps({
-            "request_id": req_id, "client_id": client_ip, "circuit_state": circuit_breaker.state, "error": "Circuit breaker OPEN",
-            "model_type": req.modelType or "groq", "llm_called": False, "rate_limited": False,
-            "status": "degraded", "latency_ms": 0
-        }))
-        return JSONResponse(status_code=503, content={
-            "status": "degraded",
-            "reason": "llm_unavailable",
-            "llm_called": False
-        })
+    allowed, retry_after = rate_limiter.allow(client_ip, rate_limiter.cost_for(req.userText))
+    if not allowed:
+        log_event(
+            "analyze.rate_limited", logging.WARNING,
+            request_id=req_id, client_id=client_ip, rate_limited=True, error="Rate limit exceeded",
+            model_type=req.modelType or "groq", llm_called=False, circuit_state=_circuit_state(),
+            status="degraded", latency_ms=0,
+        )
+        return JSONResponse(
+            status_code=429,
+            content={"status": "error", "message": "Too many requests. Please wait a minute."},
+            headers={"Retry-After": retry_after_header(retry_after)},
+        )
 
+    timer = StageTimer()
+    backend = backend_for("primary")[0]
     try:
         # Prevent queue DoS by adding a timeout for execution
         try:
             async with asyncio.timeout(30.0): # Python 3.11+ 
                 start_total = time.perf_counter()
-                res = await _analyze_turn_impl(req, req_id, client_ip, start_total)
+                res = await _analyze_turn_impl(req, req_id, client_ip, start_total, timer)
+                # Breakers are fed by call_primary/call_shadow only; validation errors are not LLM failures
                 if isinstance(res, JSONResponse):
-                    # Indicates LLM failure after retries
-                    await circuit_breaker.record_failure()
-                    await metrics.record_failure()
+                    telemetry.record_failure()
+                    telemetry.observe_pipeline(timer, backend, "error")
+                    return res
+                if audit_sink.enabled:
+                    audit_sink.record(turn_record(res, req.userText, req_id, client_ip, req.sessionId, req.defenseMode, "analyze"))
+                if ANALYTICS_ENABLED:
+                    turn_analytics.record(res, req.defenseMode, backend, "analyze")
+                build_start = time.perf_counter()
+                if wants_compact(x_response_shape, shape):
+                    body = compact_view(res, parse_fields(x_response_fields, fields))
+                    if wants_msgpack(accept):
+                        response = Response(content=encode_msgpack(body), media_type=MSGPACK_TYPE)
+                    else:
+                        response = Response(content=encode_compact(body), media_type="application/json")
+                elif wants_msgpack(accept):
+                    response = Response(content=encode_msgpack(_full_response(res).model_dump()), media_type=MSGPACK_TYPE)
                 else:
-                    await circuit_breaker.record_success()
-                return res
+                    response = _full_response(res)
+                timer.since("response_build", build_start)
+                telemetry.observe_pipeline(timer, backend, res["action"])
+                return response
         except (asyncio.TimeoutError, TimeoutError):
-            logger.error(json.dumps({
-                "request_id": req_id, "client_id": client_ip, "error": "Timeout executing LLM"
-            }))
-            await circuit_breaker.record_failure()
-            await metrics.record_failure()
+            telemetry.observe_pipeline(timer, backend, "timeout")
+            log_event("analyze.timeout", logging.ERROR, request_id=req_id, client_id=client_ip, error="Timeout executing LLM")
+            telemetry.record_failure()
             return JSONResponse(status_code=503, content={
                 "status": "degraded",
                 "reason": "llm_unavailable",
@@ -419,16 +477,16 @@ async def analyze_turn(
             
     except HTTPException:
         # Proper HTTP exceptions
-        await circuit_breaker.record_failure()
-        await metrics.record_failure()
+        telemetry.record_failure()
         raise
     except Exception as e:
-        # ALL other generic internal exceptions MUST increment circuit breaker and raise 503
-        logger.exception(json.dumps({
-            "request_id": req_id, "client_id": client_ip, "error": f"Unhandled analyze error: {str(e)}"
-        }))
-        await circuit_breaker.record_failure()
-        await metrics.record_failure()
+        # Unexpected errors in the pipeline itself are a 503; LLM failures never get here (they degrade
+        # the turn and are counted by that backend's circuit breaker in llm_client)
+        log_event(
+            "analyze.unhandled_error", logging.ERROR, exc_info=True,
+            request_id=req_id, client_id=client_ip, error=f"Unhandled analyze error: {str(e)}",
+        )
+        telemetry.record_failure()
         raise HTTPException(status_code=503, detail="Internal Defense Error")
 
 def parse_llm_json(text: str) -> Dict[str, Any]:
@@ -516,66 +574,159 @@ def _make_containment_response(
     }
 
 
-async def _analyze_turn_impl(req: TurnRequest, req_id: str, client_ip: str, start_total: float):
-    print(">>> Pipeline started")
+# Tier 4 output rules: weaponized content in the primary answer blocks it
+# primary's input_threat values that name an attack on the instructions (attack index learning)
+INPUT_THREAT_TERMS = ("inject", "override", "bypass", "poison", "jailbreak")
+
+WEAPON_RULES = compile_rules("weapon_output", [
+    r"\\x[0-9a-fA-F]{2}", # Hex shellcode
+    r"(?:exec|system|spawn|eval|open)\s*\(", # Process execution in code
+    r"(?:base64 -d|sh -c|bash -i|/dev/tcp/)", # Linux shell tricks
+    r"powershell\s+(?:-enc|-Command)", # PowerShell tricks
+    r"(?:DROP|DELETE|UPDATE|TRUNCATE)\s+(?:TABLE|FROM|DATABASE)", # Destructive SQL
+], re.IGNORECASE)
+
+
+async def _resolve_policy(req: TurnRequest) -> CompiledPolicy:
+    """The turn's compiled policy; 404 for an unknown policyId (register it again), 400 if invalid."""
+    try:
+        return await policy_registry.resolve(req.policyId, req.policy)
+    except KeyError:
+        raise HTTPException(404, f"Unknown policyId {req.policyId!r}; register the policy with POST /policies")
+    except PolicyError as e:
+        raise HTTPException(400, f"Invalid policy: {e}")
+
+
+async def _server_graph_turn(req: TurnRequest, session_id: str, user_input: str, signals: List[str],
+                             history: List[Dict[str, str]]) -> tuple:
+    """Delta protocol: builds and stores the next history node of the session's server-held graph.
+    Returns (graph fields without history, violations, graph_delta); 409 when the client must resync."""
+    changed: Dict[str, Any] = {}
+    if not req.sessionId:
+        raise HTTPException(400, 'graphMode "server" needs a sessionId')
+    if req.intentGraph is not None:
+        state, changed = await graph_store.reset(session_id, req.intentGraph)
+    else:
+        state = await graph_store.get_state(session_id)
+        if state is None or (req.graphVersion is not None and req.graphVersion != state.version):
+            raise HTTPException(409, f"Intent graph version mismatch (server version {state.version if state else None}); "
+                                     "resend the full intentGraph")
+    conversation = {"intent_graph": state.fields, "turn": state.turns + 1, "user_text": user_input,
+                    "signals": signals, "history": history}
+    node, violations = await detectors.run(build_turn_node, conversation, size=len(user_input))
+    version = await graph_store.append(session_id, state.version, node)
+    if version is None:
+        raise HTTPException(409, "Intent graph version mismatch (concurrent update); resend the full intentGraph")
+    return state.fields, violations, {"version": version, "baseVersion": state.version, "node": node, "changed": changed}
+
+
+async def _analyze_turn_impl(req: TurnRequest, req_id: str, client_ip: str, start_total: float, timer: StageTimer,
+                             preprocessed: Optional[tuple] = None):
+    """preprocessed: ((canonical_text, canonical_signals), sanitized_text) computed by the batch path.
+    Batch turns (replays, evaluations) are not counted towards live attack campaigns."""
     from fastapi.responses import JSONResponse
     user_input = req.userText or ""
+    # One regex scan budget for every rule set this turn runs (safe_regex.py)
+    scan_budget = begin_request_budget()
 
     # Enforce input length limit
-    max_chars = int(os.getenv("INPUT_MAX_CHARS", "20000"))
+    max_chars = settings.input_max_chars
     if len(user_input) > max_chars:
         return JSONResponse(status_code=400, content={
             "status": "error",
             "message": f"Input too long. Maximum {max_chars} characters allowed."
         })
+    policy = await _resolve_policy(req)
 
     # 1. Preprocessing (Non-blocking)
-    print(">>> Before heuristics")
     prep_start = time.perf_counter()
-    canonical_res = await asyncio.to_thread(progressive_canonicalize, user_input)
-    canonical_text, canonical_signals = canonical_res
-    sanitized_user = await asyncio.to_thread(sanitize_input, user_input)
+    with timer.stage("canonicalize"):
+        if preprocessed is not None:
+            canonical_res, sanitized_user = preprocessed
+        else:
+            canonical_res = await detectors.run(progressive_canonicalize, user_input, heavy=True)
+            sanitized_user = await detectors.run(sanitize_input, user_input, heavy=True)
+        canonical_text, canonical_signals = canonical_res
     # Use canonicalized text for injection detection (fixes Unicode bypass)
     effective_input = canonical_text if canonical_text else user_input
 
     # 2. Intent Graph Builder (Non-blocking)
     session_id = req.sessionId or "unknown"
-    history = _get_history(session_id)
-    conversation_for_graph = {
-        "intent_graph": req.intentGraph,
-        "user_text": user_input,
-        "signals": canonical_signals,
-        "history": history,
-    }
-    graph_res = await asyncio.to_thread(build_intent_graph, conversation_for_graph)
-    updated_graph, violations = graph_res
+    graph_delta = None
+    with timer.stage("intent_graph"):
+        history = await session_store.get_history(session_id)
+        server_graph = req.graphMode == "server" and graph_store.shared
+        if req.graphMode == "server" and not graph_store.shared:
+            # A per-worker store would hold this session's graph on one worker only: answer inline
+            graph_store.metrics["inline_fallbacks"] += 1
+            if req.intentGraph is None:
+                raise HTTPException(409, "Intent graph store is not shared between workers; "
+                                         "resend the full intentGraph")
+        if server_graph:
+            updated_graph, violations, graph_delta = await _server_graph_turn(
+                req, session_id, user_input, canonical_signals, history
+            )
+            # Cache keys see the graph's fields and version instead of its whole history
+            cache_graph = {**updated_graph, "version": graph_delta["baseVersion"]}
+        else:
+            conversation_for_graph = {
+                "intent_graph": req.intentGraph,
+                "user_text": user_input,
+                "signals": canonical_signals,
+                "history": history,
+            }
+            graph_res = await detectors.run(build_intent_graph, conversation_for_graph, size=len(user_input))
+            updated_graph, violations = graph_res
+            cache_graph = req.intentGraph
     all_signals = canonical_signals + violations
     
     preprocessing_latency_ms = (time.perf_counter() - prep_start) * 1000
 
-    # 3. Prepare prompts with conversation history
-    system_prompt = build_system_prompt(updated_graph)
-    primary_messages = [
-        {"role": "system", "content": system_prompt},
-        *history[-(MAX_HISTORY_TURNS * 2):],
-        {"role": "user", "content": user_input},
-    ]
+    # 3. Prepare prompts with conversation history (token-budgeted, prefix-stable)
+    with timer.stage("prompt_assembly"):
+        primary_messages, prompt_info = prompt_assembler.assemble(
+            session_id, backend_for("primary")[0], updated_graph, history, user_input, DEFAULT_MAX_TOKENS
+        )
+    system_prompt = primary_messages[0]["content"]
+    # The primary only sees the middle-elided input: the shadow (full input) must confirm the turn
+    input_truncated = prompt_info["user_truncated"]
+    if input_truncated:
+        all_signals.append("prompt_input_truncated")
 
     # 4. Hybrid Confidence-Based Execution
     # PROVIDER ENFORCEMENT: Ignore client request, enforce server-side only
-    model_type = os.getenv("MODEL_TYPE", "groq").strip().lower()
+    model_type = settings.model_type
     if model_type != "groq":
         raise HTTPException(500, "Invalid server configuration")
     
     # ENCODED INJECTION DEFENSE
-    decoded = try_decode(user_input)
-    force_contain = False
-    if decoded:
-        # Re-run heuristics on BOTH original + decoded
-        canonical_res_dec = await asyncio.to_thread(progressive_canonicalize, decoded)
-        all_signals.extend(canonical_res_dec[1])
-        if any(word in decoded.lower() for word in ["ignore", "bypass", "override"]):
-            force_contain = True
+    force_contain = decoded_injection = campaign_contain = False
+    with timer.stage("decode"):
+        decoded = try_decode(user_input)
+        if decoded:
+            # Re-run heuristics on BOTH original + decoded
+            canonical_res_dec = await detectors.run(progressive_canonicalize, decoded, heavy=True)
+            all_signals.extend(canonical_res_dec[1])
+            if any(word in decoded.lower() for word in ["ignore", "bypass", "override"]):
+                decoded_injection = force_contain = True
+
+    # KNOWN-ATTACK INDEX: previously contained payloads skip every LLM call
+    known_attack = attack_index.match(effective_input, policy.policy_id) if ATTACK_INDEX_ENABLED else None
+    if known_attack:
+        all_signals.append(f"known_attack:{known_attack['id']}")
+        all_signals.append(f"known_attack_match_{known_attack['match']}")
+        force_contain = True
+
+    # CAMPAIGN SKETCH: the same payload spiking across clients. Sources are client addresses only;
+    # sessionId is chosen by the caller, so one client could otherwise pose as many sources.
+    campaign = None
+    if CAMPAIGN_ENABLED and preprocessed is None:
+        campaign = campaign_sketch.observe(effective_input, source=client_ip)
+    if campaign:
+        all_signals.append("campaign_spike")
+        all_signals.append(f"campaign:{campaign['id']}")
+        if campaign_action(policy.policy) == "contain":
+            campaign_contain = force_contain = True
 
     retry_budget = {"remaining": 3}
     primary_meta = {}
@@ -590,85 +741,101 @@ async def _analyze_turn_impl(req: TurnRequest, req_id: str, client_ip: str, star
         inj_score = max(inj_score, injection_indicator_score(decoded))
     
     shadow_failed = False
-    disable_cache = (circuit_breaker.state != "CLOSED" or not req.intentGraph or not req.policy)
+    # Set when the primary LLM is unavailable; the turn then gets a heuristic-only verdict
+    primary_degraded = ""
+    disable_cache = (_circuit_state() != "CLOSED" or not cache_graph or not (req.policyId or req.policy))
 
     if force_contain or inj_score >= 70:
         primary_data = {"intent": "attack", "risk_score": 95, "action": "block", "answer": "Request blocked by safety filters."}
         primary_ok, shadow_ok = True, False
         primary_output, shadow_output, shadow_data = primary_data["answer"], "", {}
+    elif health_prober.is_healthy("primary") is False:
+        # Prober reports primary down: don't spend the retry budget
+        primary_degraded = "primary_unhealthy"
     else:
         # Tier 2: Primary LLM Evaluation
-        print(">>> Before LLM call")
-        primary_text, primary_meta = await call_primary(
-            primary_messages, 
-            retry_budget=retry_budget, 
-            model_type=model_type,
-            policy=req.policy,
-            intent_graph=req.intentGraph,
-            session_id=req.sessionId or "unknown",
-            disable_cache=disable_cache
-        )
-        if not primary_meta.get("ok"):
-            # Return explicit degraded response if LLM fails after retries
-            return JSONResponse(status_code=503, content={
-                "status": "degraded",
-                "llm_called": False
-            })
-        
-        primary_ok = True
-        primary_data = parse_llm_json(primary_text)
-        primary_output = primary_data.get("response") or primary_data.get("answer") or primary_text
-        
-        # Determine risk score from level or score
-        level_map = {"low": 10, "medium": 45, "high": 75, "critical": 95}
-        risk_score = level_map.get(str(primary_data.get("risk_level", "")).lower(), float(primary_data.get("risk_score", 0)))
-        
-        shadow_ok = False
-        shadow_output, shadow_data = "", {}
-        
-        # Tier 3: Conditional Shadow Validation (Ambiguous Risk)
-        if 30 <= risk_score <= 80 or (risk_score < 30 and inj_score > 40):
-            shadow_messages = [{"role": "user", "content": sanitized_user or user_input}]
-            s_text, shadow_meta = await call_shadow(
-                shadow_messages, 
+        with timer.stage("primary"):
+            primary_text, primary_meta = await call_primary(
+                primary_messages, 
                 retry_budget=retry_budget, 
                 model_type=model_type,
-                policy=req.policy,
-                intent_graph=req.intentGraph,
+                policy_id=policy.policy_id,
+                intent_graph=cache_graph,
                 session_id=req.sessionId or "unknown",
-                disable_cache=disable_cache
+                disable_cache=disable_cache,
+                semantic_text=None if history else effective_input
+            )
+        if not primary_meta.get("ok"):
+            # Breaker open or call failed after retries: heuristic-only verdict instead of a 503
+            primary_degraded = "primary_circuit_open" if primary_meta.get("error_type") == "CircuitOpen" else "primary_unavailable"
+        else:
+            primary_ok = True
+            primary_data = parse_llm_json(primary_text)
+            primary_output = primary_data.get("response") or primary_data.get("answer") or primary_text
+
+            # Determine risk score from level or score
+            level_map = {"low": 10, "medium": 45, "high": 75, "critical": 95}
+            risk_score = level_map.get(str(primary_data.get("risk_level", "")).lower(), float(primary_data.get("risk_score", 0)))
+
+            shadow_ok = False
+            shadow_output, shadow_data = "", {}
+
+            # Tier 3: Conditional Shadow Validation (Ambiguous Risk, or input the primary only saw in part)
+            needs_shadow = input_truncated or (
+                policy.shadow_enabled and (30 <= risk_score <= 80 or (risk_score < 30 and inj_score > 40))
             )
-            if shadow_meta.get("ok"):
-                shadow_ok = True
-                shadow_data = parse_llm_json(s_text)
-                shadow_output = shadow_data.get("response") or shadow_data.get("answer") or s_text
-            else:
+            if needs_shadow and health_prober.is_healthy("shadow") is False:
                 shadow_failed = True
+            elif needs_shadow:
+                shadow_messages = [{"role": "user", "content": sanitized_user or user_input}]
+                with timer.stage("shadow"):
+                    s_text, shadow_meta = await call_shadow(
+                        shadow_messages, 
+                        retry_budget=retry_budget, 
+                        model_type=model_type,
+                        policy_id=policy.policy_id,
+                        intent_graph=cache_graph,
+                        session_id=req.sessionId or "unknown",
+                        disable_cache=disable_cache,
+                        semantic_text=None if history else (sanitized_user or user_input)
+                    )
+                if shadow_meta.get("ok"):
+                    shadow_ok = True
+                    shadow_data = parse_llm_json(s_text)
+                    shadow_output = shadow_data.get("response") or shadow_data.get("answer") or s_text
+                else:
+                    shadow_failed = True
+
+    if primary_degraded:
+        primary_data, shadow_data = {}, {}
+        primary_ok, shadow_ok = False, False
+        primary_output, shadow_output = PRIMARY_UNAVAILABLE_MESSAGE, ""
 
     # 5. Advanced Divergence & Decision Logic
-    thresholds = (req.policy or {}).get("divergenceThresholds") or {"low": 10, "medium": 30, "high": 60, "critical": 85}
+    divergence_start = time.perf_counter()
+    thresholds = policy.thresholds
     div_results = compute_advanced_divergence(primary_data, shadow_data)
     divergence_score = div_results["divergence_score"]
+    if primary_degraded or shadow_failed:
+        # An LLM is unavailable: score from heuristics (plus primary output if any), security_level "reduced"
+        degraded = compute_divergence_degraded(
+            primary_output if primary_ok else "", effective_input, updated_graph, thresholds
+        )
+        divergence_score = max(divergence_score, degraded["total"])
+        all_signals.append(primary_degraded or "shadow_unavailable")
     
     # Intent Graph Boost: If we detected forbidden intent, override risk to critical
     if violations:
-        print(f">>> Intent Graph VIOLATION: {violations}")
+        log_event("analyze.intent_violation", violations=violations)
         divergence_score = max(divergence_score, 95.0)
     
     if force_contain:
         defense_action = "contain"
     else:
-        defense_action = decide_defense_action(divergence_score, thresholds, req.defenseMode or "active")
+        defense_action = policy.decide(divergence_score, req.defenseMode or policy.defense_mode_default)
     
     # Tier 4: Blocking Overrides (New Hardening Rules)
-    weapon_patterns = [
-        r"\\x[0-9a-fA-F]{2}", # Hex shellcode
-        r"(?:exec|system|spawn|eval|open)\s*\(", # Process execution in code
-        r"(?:base64 -d|sh -c|bash -i|/dev/tcp/)", # Linux shell tricks
-        r"powershell\s+(?:-enc|-Command)", # PowerShell tricks
-        r"(?:DROP|DELETE|UPDATE|TRUNCATE)\s+(?:TABLE|FROM|DATABASE)", # Destructive SQL
-    ]
-    output_weaponized = any(re.search(p, primary_output, re.IGNORECASE) for p in weapon_patterns)
+    output_weaponized = WEAPON_RULES.any(primary_output)
 
     is_blocked = (
         primary_data.get("action") == "block" or 
@@ -679,6 +846,18 @@ async def _analyze_turn_impl(req: TurnRequest, req_id: str, client_ip: str, star
     )
     if is_blocked and divergence_score > thresholds["low"]:
         defense_action = "contain"
+    if input_truncated and not shadow_ok and defense_action == "allow":
+        # Nothing compared the elided span against a model: ask for a shorter message instead
+        # (at the score where validate_response_contract stops requiring "low" risk)
+        all_signals.append("truncated_input_unverified")
+        divergence_score = max(divergence_score, 30.0)
+        defense_action = "clarify"
+    if scan_budget.skipped and defense_action == "allow":
+        # The regex budget ran out and rules without a linear-time matcher were not evaluated: the
+        # heuristics are incomplete, so do not allow the turn unverified
+        all_signals.append("regex_budget_exhausted")
+        divergence_score = max(divergence_score, 30.0)
+        defense_action = "clarify"
 
     risk_map = {"allow": "low", "clarify": "medium", "sanitize_rerun": "high", "contain": "critical"}
     risk_level = risk_map.get(defense_action, "medium")
@@ -693,22 +872,26 @@ async def _analyze_turn_impl(req: TurnRequest, req_id: str, client_ip: str, star
         "signals": all_signals + [div_results["reason"]] if div_results.get("reason") and div_results["reason"] != "none" else all_signals,
         "weaponized": output_weaponized
     })
+    timer.since("divergence", divergence_start)
 
     sanitized_text = final_answer if defense_action == "contain" else None
     defense_action_taken = defense_action in ("sanitize_rerun", "contain")
     rerun_with_cleaned = defense_action == "sanitize_rerun"
 
-    response_status = "partial_validation" if shadow_failed else "ok"
-    security_level = "reduced" if shadow_failed else "full"
+    response_status = "degraded" if primary_degraded else "partial_validation" if shadow_failed else "ok"
+    security_level = "reduced" if (primary_degraded or shadow_failed) else "full"
     
-    llm_called = not (inj_score >= 80 or force_contain)
+    # Whether the primary backend was invoked, even if the call then failed; cache hits and an open
+    # breaker never reach it
+    llm_called = (bool(primary_meta) and not primary_meta.get("cache")
+                  and primary_meta.get("error_type") != "CircuitOpen")
     llm_latency_ms = primary_meta.get("latency_ms", 0.0) + shadow_meta.get("latency_ms", 0.0)
     total_latency_ms = (time.perf_counter() - start_total) * 1000
 
     log_data = {
         "request_id": req_id,
         "client_id": client_ip,
-        "circuit_state": circuit_breaker.state,
+        "circuit_state": _circuit_state(),
         "rate_limited": False,
         "status": response_status,
         "llm_called": llm_called,
@@ -718,80 +901,229 @@ async def _analyze_turn_impl(req: TurnRequest, req_id: str, client_ip: str, star
         "model": primary_meta.get("model", "llama3-8b-8192"),
         "decision": defense_action,
         "risk_score": risk_score,
-        "divergence_score": divergence_score
+        "divergence_score": divergence_score,
+        "policy_id": policy.policy_id,
+    }
+    log_event("analyze.completed", **log_data)
+
+    # Plain values; the caller builds the full AnalysisResponse or the compact shape from them
+    values = {
+        "status": response_status,
+        "canonical_text": canonical_text,
+        "signals": all_signals,
+        "updated_graph": None if graph_delta else updated_graph,
+        "graph_delta": graph_delta,
+        "graph_store_shared": graph_store.shared,
+        "divergence_score": divergence_score,
+        "risk_level": risk_level,
+        "action": defense_action,
+        "sanitized_text": sanitized_text,
+        "final_answer": final_answer,
+        "shadow_output": shadow_output,
+        "user_input": user_input,
+        "sanitized_input": sanitized_user,
+        "primary_output": primary_output,
+        "primary_ok": primary_ok,
+        "shadow_ok": shadow_ok,
+        "llm_mode": LLM_MODE_VAL or "legacy",
+        "defense_action_taken": defense_action_taken,
+        "rerun_with_cleaned": rerun_with_cleaned,
+        "log": log_data,
+        "llm_called": llm_called,
+        "provider": primary_meta.get("provider", "groq"),
+        "model": primary_meta.get("model", "llama3-8b-8192"),
+        "llm_latency_ms": llm_latency_ms,
+        "preprocessing_latency_ms": preprocessing_latency_ms,
+        "total_latency_ms": total_latency_ms,
+        "security_level": security_level,
+        "divergence_reason": div_results["reason"],
+        "cache_hit": bool(primary_meta.get("cache")),
     }
-    logger.info(json.dumps(log_data))
+    # Learn contained payloads the input itself earned, confirmed by its injection score, a decoded
+    # injection or the primary flagging an input threat. Intent-graph violations, output scans,
+    # degraded heuristics and campaign spikes are not properties of the text under other policies.
+    if (ATTACK_INDEX_ENABLED and defense_action == "contain" and not known_attack
+            and not primary_degraded and not campaign_contain):
+        input_threat = str(primary_data.get("input_threat") or "").lower()
+        llm_confirmed = (primary_ok and not violations and not output_weaponized and risk_score >= 75
+                         and any(term in input_threat for term in INPUT_THREAT_TERMS))
+        if decoded_injection or inj_score >= 70 or llm_confirmed:
+            source = "decoded" if decoded_injection else "injection_score" if inj_score >= 70 else "primary"
+            attack_index.add(effective_input, policy.policy_id, source=source)
+    # Store conversation turn for multi-turn history
+    await session_store.append(session_id, user_input, final_answer)
+    log_event("analyze.response", logging.DEBUG, action=defense_action, final_answer=final_answer)
+    return values
+
 
+def _full_response(v: Dict[str, Any]) -> AnalysisResponse:
+    """The original (validated) response shape."""
     divergence_log = DivergenceLog(
-        divergenceScore=divergence_score,
-        action=defense_action,
-        defenseActionTaken=defense_action_taken,
-        rerunWithCleaned=rerun_with_cleaned,
-        user_input=user_input,
-        sanitized_input=sanitized_user,
-        primary_output=primary_output,
-        shadow_output=shadow_output,
-        primary_ok=primary_ok,
-        shadow_ok=shadow_ok,
-        llm_mode=LLM_MODE_VAL or "legacy",
+        divergenceScore=v["divergence_score"],
+        action=v["action"],
+        defenseActionTaken=v["defense_action_taken"],
+        rerunWithCleaned=v["rerun_with_cleaned"],
+        user_input=v["user_input"],
+        sanitized_input=v["sanitized_input"],
+        primary_output=v["primary_output"],
+        shadow_output=v["shadow_output"],
+        primary_ok=v["primary_ok"],
+        shadow_ok=v["shadow_ok"],
+        llm_mode=v["llm_mode"],
     )
-
-    result = AnalysisResponse(
-        status=response_status,
+    return AnalysisResponse(
+        status=v["status"],
         message="OK",
-        canonicalText=canonical_text,
-        signals=all_signals,
-        updatedGraph=updated_graph,
-        scores={"total": divergence_score},
-        riskLevel=risk_level,
-        action=defense_action,
-        sanitizedText=sanitized_text,
-        primaryOutput=final_answer,
-        shadowOutput=shadow_output,
+        canonicalText=v["canonical_text"],
+        signals=v["signals"],
+        updatedGraph=v["updated_graph"],
+        graphDelta=v["graph_delta"],
+        graphStoreShared=v["graph_store_shared"],
+        scores={"total": v["divergence_score"]},
+        riskLevel=v["risk_level"],
+        action=v["action"],
+        sanitizedText=v["sanitized_text"],
+        primaryOutput=v["final_answer"],
+        shadowOutput=v["shadow_output"],
         divergenceLog=divergence_log,
-        final_answer=final_answer,
-        divergence_score=divergence_score,
-        divergence=divergence_score,
-        defense_action=defense_action,
-        log=log_data,
-        llm_called=llm_called,
-        provider=primary_meta.get("provider", "groq"),
-        model=primary_meta.get("model", "llama3-8b-8192"),
-        llm_latency_ms=llm_latency_ms,
-        preprocessing_latency_ms=preprocessing_latency_ms,
-        total_latency_ms=total_latency_ms,
-        security_level=security_level
+        final_answer=v["final_answer"],
+        divergence_score=v["divergence_score"],
+        divergence=v["divergence_score"],
+        defense_action=v["action"],
+        log=v["log"],
+        llm_called=v["llm_called"],
+        provider=v["provider"],
+        model=v["model"],
+        llm_latency_ms=v["llm_latency_ms"],
+        preprocessing_latency_ms=v["preprocessing_latency_ms"],
+        total_latency_ms=v["total_latency_ms"],
+        security_level=v["security_level"]
     )
-    # Store conversation turn for multi-turn history
-    _append_history(session_id, user_input, final_answer)
-    print(">>> FINAL RESPONSE:", result)
-    return result
+
+
+class BatchRequest(BaseModel):
+    turns: List[TurnRequest]
+    # Optional lower in-flight limit; capped at BATCH_CONCURRENCY
+    concurrency: Optional[int] = None
+
+
+async def _run_batch_turn(req: TurnRequest, req_id: str, client_id: str, preprocessed, view) -> tuple:
+    """One batch turn through the /analyze pipeline; returns (http_status, view(values)) and never raises."""
+    from fastapi.responses import JSONResponse
+    telemetry.record_request()
+    timer = StageTimer()
+    backend = backend_for("primary")[0]
+    try:
+        async with asyncio.timeout(30.0):
+            res = await _analyze_turn_impl(req, req_id, client_id, time.perf_counter(), timer, preprocessed)
+    except (asyncio.TimeoutError, TimeoutError):
+        telemetry.observe_pipeline(timer, backend, "timeout")
+        telemetry.record_failure()
+        return 503, {"status": "degraded", "reason": "llm_unavailable", "llm_called": False}
+    except HTTPException as e:
+        telemetry.record_failure()
+        return e.status_code, {"status": "error", "message": e.detail}
+    except Exception as e:
+        log_event(
+            "analyze.unhandled_error", logging.ERROR, exc_info=True,
+            request_id=req_id, client_id=client_id, error=f"Unhandled analyze error: {str(e)}",
+        )
+        telemetry.record_failure()
+        return 503, {"status": "error", "message": "Internal Defense Error"}
+    if isinstance(res, JSONResponse):
+        telemetry.record_failure()
+        telemetry.observe_pipeline(timer, backend, "error")
+        return res.status_code, json.loads(res.body)
+    if audit_sink.enabled:
+        audit_sink.record(turn_record(res, req.userText, req_id, client_id, req.sessionId, req.defenseMode, "batch"))
+    if ANALYTICS_ENABLED:
+        turn_analytics.record(res, req.defenseMode, backend, "batch")
+    build_start = time.perf_counter()
+    body = view(res)
+    timer.since("response_build", build_start)
+    telemetry.observe_pipeline(timer, backend, res["action"])
+    return 200, body
+
+
+@app.post("/analyze/batch")
+async def analyze_batch(
+    batch: BatchRequest,
+    x_batch_key: Optional[str] = Header(None, alias="X-Batch-Key"),
+    x_forwarded_for: Optional[str] = Header(None, alias="X-Forwarded-For"),
+    x_response_shape: Optional[str] = Header(None, alias="X-Response-Shape"),
+    x_response_fields: Optional[str] = Header(None, alias="X-Response-Fields"),
+    shape: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """Analyze many turns; streams NDJSON lines {"index", "status", "result"|"error"} in completion order.
+    Requires X-Batch-Key matching BATCH_API_KEY and is not subject to the per-client rate limit.
+    Results use the full or compact shape as negotiated for /analyze."""
+    from fastapi.responses import StreamingResponse
+    if not batch_key_valid(x_batch_key):
+        raise HTTPException(status_code=403, detail="Invalid or missing X-Batch-Key header")
+    if not batch.turns or len(batch.turns) > BATCH_MAX_TURNS:
+        raise HTTPException(status_code=400, detail=f"Batch must contain 1-{BATCH_MAX_TURNS} turns")
+    batch_id = current_request_id() or str(uuid.uuid4())
+    client_id = "batch:" + (x_forwarded_for or "unknown").split(",")[0].strip()
+    turns = batch.turns
+    log_event("analyze.batch_start", request_id=batch_id, client_id=client_id, turns=len(turns))
+
+    if wants_compact(x_response_shape, shape):
+        selected = parse_fields(x_response_fields, fields)
+        view = lambda values: compact_view(values, selected)
+    else:
+        view = lambda values: _full_response(values).model_dump()
+
+    def run_turn(index: int, preprocessed):
+        return _run_batch_turn(turns[index], f"{batch_id}:{index}", client_id, preprocessed, view)
+
+    lines = stream_batch(
+        [t.userText or "" for t in turns],
+        [t.sessionId for t in turns],
+        run_turn,
+        max_chars=settings.input_max_chars,
+        concurrency=min(batch.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY),
+    )
+    return StreamingResponse(lines, media_type="application/x-ndjson")
 
 
 @app.get("/health")
 def health_check():
-    print("[defense/health] GET /health called")
     return {"status": "ok"}
 
 
 @app.get("/llm-status")
 def llm_status():
-    return get_llm_status()
+    status = get_llm_status()
+    status["health"] = health_prober.snapshot()
+    return status
 
 
 @app.delete("/session/{session_id}/history")
-def clear_session_history(session_id: str):
-    """Clear conversation history for a session to prevent memory leaks."""
-    removed = conversation_store.pop(session_id, None)
-    return {"status": "ok", "cleared": removed is not None}
+async def clear_session_history(session_id: str):
+    """Clear conversation history for a session to prevent memory leaks; also evicts its cached LLM responses."""
+    from llm_client import llm_cache
+    removed = await session_store.clear(session_id)
+    graph_removed = await graph_store.clear(session_id)
+    prompt_assembler.forget(session_id)
+    evicted = await llm_cache.invalidate(session=session_id)
+    return {"status": "ok", "cleared": removed, "graph_cleared": graph_removed, "cache_evicted": evicted}
+
+
+@app.get("/session/{session_id}/graph")
+async def get_session_graph(session_id: str):
+    """Full server-held intent graph and its version (graphMode "server"), e.g. to resync a client."""
+    held = await graph_store.get_graph(session_id)
+    if held is None:
+        raise HTTPException(404, "No server-held intent graph for this session")
+    return {"version": held[0], "graph": held[1]}
 
 
 @app.get("/debug/llm")
 def debug_llm(x_debug_key: Optional[str] = Header(None, alias="X-Debug-Key")):
     """Protected debug endpoint: returns active mode and confirms both Primary+Shadow paths (no secrets).
     Set DEBUG_LLM_KEY in env to require X-Debug-Key header; otherwise open for local dev."""
-    import os
-    debug_key = os.environ.get("DEBUG_LLM_KEY", "").strip()
+    debug_key = settings.debug_llm_key
     if debug_key and (not x_debug_key or x_debug_key != debug_key):
         raise HTTPException(status_code=403, detail="Invalid or missing X-Debug-Key header")
     return get_debug_llm_info()
@@ -800,4 +1132,5 @@ def debug_llm(x_debug_key: Optional[str] = Header(None, alias="X-Debug-Key")):
 if __name__ == "__main__":
     # Use port 5000 to match DEFENSE_SERVICE_URL and npm run dev:defense
     # trigger reload 2
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    # Also listens on DEFENSE_UDS_PATH when set (transport.py)
+    serve(app, host="0.0.0.0", port=5000)
@@ -8,6 +8,35 @@ DEFAULT_THRESHOLDS = {
     "critical": 85,
 }
 
+# Per-mode threshold multipliers: strict lowers every threshold, passive raises all but critical
+MODE_SCALING = {
+    "strict": {"low": 0.8, "medium": 0.8, "high": 0.8, "critical": 0.8},
+    "passive": {"low": 1.5, "medium": 1.5, "high": 1.5},
+}
+DEFENSE_MODES = ("passive", "active", "strict")
+
+
+def effective_thresholds(thresholds: Dict[str, float], defense_mode: str) -> Dict[str, float]:
+    """Thresholds with missing levels defaulted and the defense mode's scaling applied."""
+    # Use defaults when thresholds missing or empty
+    if not thresholds or not isinstance(thresholds, dict):
+        thresholds = DEFAULT_THRESHOLDS
+    scaling = MODE_SCALING.get(defense_mode, {})
+    return {k: thresholds.get(k, DEFAULT_THRESHOLDS[k]) * scaling.get(k, 1) for k in DEFAULT_THRESHOLDS}
+
+
+def action_for_score(total_score: float, effective: Dict[str, float]) -> str:
+    """Action for a score against already-scaled thresholds (see effective_thresholds)."""
+    if total_score >= effective['critical']:
+        return "contain"
+    elif total_score >= effective['high']:
+        return "sanitize_rerun"
+    elif total_score >= effective['medium']:
+        return "clarify"
+    else:
+        return "allow"
+
+
 def decide_defense_action(total_score: float, thresholds: Dict[str, float], defense_mode: str) -> str:
     """
     Decide the action based on score, thresholds, and mode.
@@ -15,29 +44,6 @@ def decide_defense_action(total_score: float, thresholds: Dict[str, float], defe
       - passive: only log, barely block (unless critical)
       - active: standard blocking
       - strict: lower thresholds
+    Registered policies precompute effective_thresholds per mode (policy_registry.py).
     """
-    
-    # Use defaults when thresholds missing or empty
-    if not thresholds or not isinstance(thresholds, dict):
-        thresholds = DEFAULT_THRESHOLDS.copy()
-    effective_thresholds = {k: thresholds.get(k, DEFAULT_THRESHOLDS[k]) for k in DEFAULT_THRESHOLDS}
-    
-    if defense_mode == 'strict':
-        effective_thresholds['low'] *= 0.8
-        effective_thresholds['medium'] *= 0.8
-        effective_thresholds['high'] *= 0.8
-        effective_thresholds['critical'] *= 0.8
-    elif defense_mode == 'passive':
-        effective_thresholds['low'] *= 1.5
-        effective_thresholds['medium'] *= 1.5
-        effective_thresholds['high'] *= 1.5
-    
-    # Determine Level
-    if total_score >= effective_thresholds['critical']:
-        return "contain"
-    elif total_score >= effective_thresholds['high']:
-        return "sanitize_rerun"
-    elif total_score >= effective_thresholds['medium']:
-        return "clarify"
-    else:
-        return "allow"
+    return action_for_score(total_score, effective_thresholds(thresholds, defense_mode))
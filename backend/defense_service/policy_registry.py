@@ -0,0 +1,342 @@
+"""
+Versioned policy registry: policies are uploaded once and turns reference them by ID.
+
+Every /analyze request carried the full policy document, which was serialized again into the exact
+LLM cache key, the semantic cache scope and the cache invalidation tag, and its thresholds were
+re-scaled for the defense mode on every decision. POST /policies validates a policy once and
+compiles it into an immutable CompiledPolicy: divergence thresholds with defaults filled in, the
+scaled thresholds for each defense mode, the shadow and campaign settings. Its policy_id is a hash of
+the canonical JSON of the normalized policy, so the same content always gets the same ID and an ID
+always names the same content. Turns send "policyId" instead of "policy"; cache keys use the ID.
+
+Inline policies still work and go through the same compile step, memoized by content
+(POLICY_INLINE_CACHE entries). Registered policies live in a SQLite (WAL) table at
+POLICY_REGISTRY_PATH shared by every uvicorn worker on the host, so an ID registered through one
+worker resolves on all of them and survives restarts; each worker keeps compiled policies in a
+per-process cache and only reads the table on a miss, off the event loop. The table holds up to POLICY_REGISTRY_MAX
+policies (least recently registered or loaded evicted); a client that gets 404 for an unknown ID
+registers the policy again. POLICY_REGISTRY_PATH="" keeps the registry per process (in-memory SQLite).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from policy import DEFAULT_THRESHOLDS, DEFENSE_MODES, action_for_score, effective_thresholds
+
+logger = logging.getLogger("shieldllm.defense.policies")
+
+POLICY_REGISTRY_MAX = int(os.environ.get("POLICY_REGISTRY_MAX", "1000"))
+POLICY_INLINE_CACHE = int(os.environ.get("POLICY_INLINE_CACHE", "256"))
+POLICY_REGISTRY_PATH = os.environ.get(
+    "POLICY_REGISTRY_PATH", str(Path(__file__).resolve().parent / ".cache" / "policies.sqlite3")
+).strip()
+
+CAMPAIGN_ACTIONS = ("signal", "contain")
+
+
+class PolicyError(ValueError):
+    """A policy document that does not validate."""
+
+
+@dataclass(frozen=True)
+class CompiledPolicy:
+    policy_id: str
+    # Normalized document (hashed for policy_id); campaign_action() and /policies read it
+    policy: Dict[str, Any]
+    thresholds: Dict[str, float]
+    mode_thresholds: Dict[str, Dict[str, float]]
+    shadow_enabled: bool = True
+    campaign_action: Optional[str] = None
+    defense_mode_default: str = "active"
+    version: int = 0
+    created_at: float = field(default_factory=time.time)
+
+    def decide(self, total_score: float, defense_mode: str) -> str:
+        """decide_defense_action() against the precomputed thresholds (unknown modes scale like active)."""
+        return action_for_score(total_score, self.mode_thresholds.get(defense_mode) or self.mode_thresholds["active"])
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "policyId": self.policy_id,
+            "version": self.version,
+            "createdAt": round(self.created_at, 3),
+            "policy": self.policy,
+            "modeThresholds": self.mode_thresholds,
+        }
+
+
+def _number(value: Any, name: str) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise PolicyError(f"{name} must be a number")
+    return float(value)
+
+
+def normalize_policy(raw: Any) -> Dict[str, Any]:
+    """Validated policy with defaults filled in; storage metadata (_id, __v) is dropped."""
+    if not isinstance(raw, dict):
+        raise PolicyError("policy must be an object")
+    policy = {k: v for k, v in raw.items() if not str(k).startswith("_")}
+
+    given = policy.get("divergenceThresholds") or {}
+    if not isinstance(given, dict):
+        raise PolicyError("divergenceThresholds must be an object")
+    given = {k: v for k, v in given.items() if not str(k).startswith("_")}
+    unknown = set(given) - set(DEFAULT_THRESHOLDS)
+    if unknown:
+        raise PolicyError(f"unknown divergenceThresholds levels: {', '.join(sorted(map(str, unknown)))}")
+    thresholds = {
+        level: _number(given[level], f"divergenceThresholds.{level}") if given.get(level) is not None else float(default)
+        for level, default in DEFAULT_THRESHOLDS.items()
+    }
+    levels = list(thresholds.values())
+    if min(levels) < 0 or levels != sorted(levels):
+        raise PolicyError("divergenceThresholds must be non-negative and ordered low <= medium <= high <= critical")
+    policy["divergenceThresholds"] = thresholds
+
+    mode = policy.get("defenseModeDefault") or "active"
+    if mode not in DEFENSE_MODES:
+        raise PolicyError(f"defenseModeDefault must be one of {', '.join(DEFENSE_MODES)}")
+    policy["defenseModeDefault"] = mode
+
+    shadow = policy.get("shadowEnabled", True)
+    if not isinstance(shadow, bool):
+        raise PolicyError("shadowEnabled must be a boolean")
+    policy["shadowEnabled"] = shadow
+
+    if policy.get("campaignAction") is not None:
+        action = str(policy["campaignAction"]).strip().lower()
+        if action not in CAMPAIGN_ACTIONS:
+            raise PolicyError(f"campaignAction must be one of {', '.join(CAMPAIGN_ACTIONS)}")
+        policy["campaignAction"] = action
+    if policy.get("trustDecay") is not None:
+        policy["trustDecay"] = _number(policy["trustDecay"], "trustDecay")
+    return policy
+
+
+def _canonical(policy: Dict[str, Any]) -> str:
+    try:
+        return json.dumps(policy, sort_keys=True, separators=(",", ":"), allow_nan=False)
+    except (TypeError, ValueError) as e:
+        raise PolicyError(f"policy is not plain JSON: {e}")
+
+
+def compile_policy(raw: Any, version: int = 0) -> CompiledPolicy:
+    policy = normalize_policy(raw)
+    thresholds = policy["divergenceThresholds"]
+    return CompiledPolicy(
+        policy_id=hashlib.sha256(_canonical(policy).encode("utf-8")).hexdigest()[:16],
+        policy=policy,
+        thresholds=thresholds,
+        mode_thresholds={mode: effective_thresholds(thresholds, mode) for mode in DEFENSE_MODES},
+        shadow_enabled=policy["shadowEnabled"],
+        campaign_action=policy.get("campaignAction"),
+        defense_mode_default=policy["defenseModeDefault"],
+        version=version,
+    )
+
+
+DEFAULT_POLICY = compile_policy({})
+
+
+class PolicyRegistry:
+    def __init__(self, max_policies: int = POLICY_REGISTRY_MAX, inline_cache: int = POLICY_INLINE_CACHE,
+                 path: str = POLICY_REGISTRY_PATH):
+        self.max_policies = max(1, max_policies)
+        self.inline_cache = max(0, inline_cache)
+        self.path = path or ":memory:"
+        self._conn: Optional[sqlite3.Connection] = None
+        # policy_id -> compiled, for policies read from the table (this process only)
+        self._policies: "OrderedDict[str, CompiledPolicy]" = OrderedDict()
+        # Raw inline policy JSON -> compiled (skips validation for repeated inline policies)
+        self._inline: "OrderedDict[str, CompiledPolicy]" = OrderedDict()
+        # _lock serializes the connection; _cache_lock only guards the two dicts, so cache hits on the
+        # event loop never wait behind a table read in a worker thread
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        # Table row count as of this process's last register/load/list
+        self._cached_size: Optional[int] = None
+        self.stats = {"registered": 0, "lookups": 0, "unknown": 0, "inline_hits": 0, "inline_compiles": 0,
+                      "table_reads": 0, "evicted": 0, "invalid": 0}
+
+    # --- storage (caller holds _lock) ---
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.path != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS policies (version INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "policy_id TEXT NOT NULL UNIQUE, policy TEXT NOT NULL, created_at REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _cache(self, compiled: CompiledPolicy) -> CompiledPolicy:
+        with self._cache_lock:
+            self._policies[compiled.policy_id] = compiled
+            self._policies.move_to_end(compiled.policy_id)
+            while len(self._policies) > self.max_policies:
+                self._policies.popitem(last=False)
+        return compiled
+
+    def _cached(self, policy_id: str) -> Optional[CompiledPolicy]:
+        with self._cache_lock:
+            compiled = self._policies.get(policy_id)
+            if compiled is not None:
+                self._policies.move_to_end(policy_id)
+            return compiled
+
+    def _count(self) -> None:
+        self._cached_size = self._db().execute("SELECT COUNT(*) FROM policies").fetchone()[0]
+
+    def _from_row(self, row: Tuple[int, str, str, float]) -> CompiledPolicy:
+        version, _policy_id, policy, created_at = row
+        return replace(compile_policy(json.loads(policy), version), created_at=created_at)
+
+    def _read(self, policy_id: str) -> Optional[CompiledPolicy]:
+        db = self._db()
+        row = db.execute(
+            "SELECT version, policy_id, policy, created_at FROM policies WHERE policy_id = ?", (policy_id,)
+        ).fetchone()
+        self.stats["table_reads"] += 1
+        if row is None:
+            return None
+        db.execute("UPDATE policies SET last_used = ? WHERE policy_id = ?", (time.time(), policy_id))
+        return self._cache(self._from_row(row))
+
+    def register(self, raw: Any) -> Tuple[CompiledPolicy, bool]:
+        """(compiled policy, created); registering known content returns the existing entry."""
+        try:
+            compiled = compile_policy(raw)
+        except PolicyError:
+            self.stats["invalid"] += 1
+            raise
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                created = db.execute(
+                    "INSERT OR IGNORE INTO policies (policy_id, policy, created_at, last_used) VALUES (?, ?, ?, ?)",
+                    (compiled.policy_id, _canonical(compiled.policy), now, now),
+                ).rowcount == 1
+                if not created:
+                    db.execute("UPDATE policies SET last_used = ? WHERE policy_id = ?", (now, compiled.policy_id))
+                evicted = db.execute(
+                    "DELETE FROM policies WHERE policy_id IN (SELECT policy_id FROM policies "
+                    "ORDER BY last_used DESC, version DESC LIMIT -1 OFFSET ?)", (self.max_policies,)
+                ).rowcount
+                row = db.execute(
+                    "SELECT version, policy_id, policy, created_at FROM policies WHERE policy_id = ?",
+                    (compiled.policy_id,),
+                ).fetchone()
+                self._count()
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self.stats["evicted"] += evicted
+            if created:
+                self.stats["registered"] += 1
+            return self._cache(self._from_row(row)), created
+
+    def _get_sync(self, policy_id: str) -> Optional[CompiledPolicy]:
+        with self._lock:
+            compiled = self._cached(policy_id)
+            if compiled is not None:
+                return compiled
+            try:
+                return self._read(policy_id)
+            except sqlite3.Error as e:
+                logger.warning("policy registry read failed (%s): %s", self.path, e)
+                return None
+
+    async def get(self, policy_id: str) -> Optional[CompiledPolicy]:
+        """From this process's cache, else from the shared table (registered through another worker)."""
+        compiled = self._cached(policy_id)
+        if compiled is not None:
+            return compiled
+        return await asyncio.to_thread(self._get_sync, policy_id)
+
+    async def resolve(self, policy_id: Optional[str], inline: Optional[Dict[str, Any]]) -> CompiledPolicy:
+        """The turn's policy: registered by ID (KeyError if unknown), else the inline one, else defaults."""
+        if policy_id:
+            self.stats["lookups"] += 1
+            compiled = await self.get(policy_id)
+            if compiled is None:
+                self.stats["unknown"] += 1
+                raise KeyError(policy_id)
+            return compiled
+        if not inline:
+            return DEFAULT_POLICY
+        key = json.dumps(inline, sort_keys=True, default=str)
+        with self._cache_lock:
+            compiled = self._inline.get(key)
+            if compiled is not None:
+                self._inline.move_to_end(key)
+                self.stats["inline_hits"] += 1
+                return compiled
+        try:
+            compiled = compile_policy(inline)
+        except PolicyError:
+            self.stats["invalid"] += 1
+            raise
+        self.stats["inline_compiles"] += 1
+        if self.inline_cache:
+            with self._cache_lock:
+                self._inline[key] = compiled
+                while len(self._inline) > self.inline_cache:
+                    self._inline.popitem(last=False)
+        return compiled
+
+    def list(self) -> List[CompiledPolicy]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT version, policy_id, policy, created_at FROM policies ORDER BY version"
+            ).fetchall()
+            self._cached_size = len(rows)
+        with self._cache_lock:
+            cached = dict(self._policies)
+        return [cached.get(row[1]) or self._from_row(row) for row in rows]
+
+    def load(self) -> None:
+        """Opens the table and warms this process's cache with the most recently used policies."""
+        try:
+            with self._lock:
+                rows = self._db().execute(
+                    "SELECT version, policy_id, policy, created_at FROM policies "
+                    "ORDER BY last_used DESC, version DESC LIMIT ?",
+                    (self.max_policies,),
+                ).fetchall()
+                for row in reversed(rows):
+                    self._cache(self._from_row(row))
+                self._count()
+        except Exception as e:
+            logger.warning("policy registry not opened at %s: %s", self.path, e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        # Row count as of this worker's last register/load/list; avoids a table scan per /metrics call
+        return {
+            **self.stats,
+            "size": self._cached_size,
+            "cached": len(self._policies),
+            "max_policies": self.max_policies,
+            "inline_cached": len(self._inline),
+            "path": self.path,
+        }
+
+
+policy_registry = PolicyRegistry()
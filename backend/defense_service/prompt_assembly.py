@@ -0,0 +1,175 @@
+"""
+Token-budgeted, prefix-stable assembly of the primary prompt.
+
+_analyze_turn_impl used to keep the last MAX_HISTORY_TURNS turns regardless of size, and
+_transformers_generate then truncated at 4096 tokens from the right, which could drop the user's
+current message. The assembler instead:
+
+- fits [system, history..., current user] into a per-backend token budget (minus the output
+  reservation), using token counts cached per message content;
+- never drops the current message; if it alone cannot fit, its middle is elided (head and tail
+  kept) and the turn is flagged;
+- keeps the message prefix byte-for-byte stable within a session: the first history message kept
+  (the anchor) only moves when the budget overflows, and then jumps forward far enough
+  (PROMPT_COMPACT_TARGET of the budget) that the next several turns append without moving it.
+  Sliding the window by one turn every request would defeat server-side prompt caching
+  (LM Studio and other OpenAI-compatible backends).
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from system_prompt import build_system_prompt
+
+# Context windows per backend kind (see health_prober.backend_for); PROMPT_TOKEN_BUDGET overrides all
+_DEFAULT_BUDGETS = {"groq": 8192, "huggingface": 8192, "openai_compat": 4096, "transformers": 4096}
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "0"))
+# After an overflow, history is cut down to this fraction of the space left for history
+PROMPT_COMPACT_TARGET = float(os.environ.get("PROMPT_COMPACT_TARGET", "0.5"))
+# Per-message framing overhead (role markers, separators)
+_MESSAGE_OVERHEAD_TOKENS = 4
+_TOKEN_CACHE_MAX = 20000
+_SESSION_STATE_MAX = 5000
+
+
+def token_budget(backend: str) -> int:
+    if PROMPT_TOKEN_BUDGET > 0:
+        return PROMPT_TOKEN_BUDGET
+    override = os.environ.get(f"PROMPT_TOKEN_BUDGET_{backend.upper()}", "").strip()
+    if override:
+        return int(override)
+    return _DEFAULT_BUDGETS.get(backend, 4096)
+
+
+def _content_key(content: str) -> bytes:
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+
+class PromptAssembler:
+    def __init__(self):
+        # (backend, content digest) -> token count
+        self._token_cache: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+        # session id -> digest of the first history message in the prompt
+        self._anchors: "OrderedDict[str, bytes]" = OrderedDict()
+        self.stats = {"token_cache_hits": 0, "token_cache_misses": 0, "compactions": 0, "truncated_inputs": 0}
+
+    # --- token counting ---
+
+    def _tokenizer_for(self, backend: str):
+        """In-process tokenizer when the transformers model is already loaded here; else None."""
+        if backend != "transformers":
+            return None
+        import llm_client
+        loaded = llm_client._transformer_primary
+        return loaded[1] if loaded else None
+
+    def count_tokens(self, backend: str, content: str) -> int:
+        key = (backend, _content_key(content))
+        cached = self._token_cache.get(key)
+        if cached is not None:
+            self._token_cache.move_to_end(key)
+            self.stats["token_cache_hits"] += 1
+            return cached
+        self.stats["token_cache_misses"] += 1
+        tokenizer = self._tokenizer_for(backend)
+        if tokenizer is not None:
+            count = len(tokenizer(content, add_special_tokens=False)["input_ids"])
+        else:
+            # Conservative estimate for BPE vocabularies: ~3.5 UTF-8 bytes per token
+            count = int(len(content.encode("utf-8")) / 3.5) + 1
+        count += _MESSAGE_OVERHEAD_TOKENS
+        self._token_cache[key] = count
+        if len(self._token_cache) > _TOKEN_CACHE_MAX:
+            self._token_cache.popitem(last=False)
+        return count
+
+    # --- assembly ---
+
+    def _truncate_middle(self, backend: str, text: str, max_tokens: int) -> str:
+        """Keep head and tail of text within max_tokens; instructions often sit at either end."""
+        marker = "\n[... {} characters elided ...]\n"
+        lo, hi = 0, len(text)
+        best = ""
+        # Binary search on kept characters; a handful of counts, each cached
+        while lo <= hi:
+            keep = (lo + hi) // 2
+            head, tail = text[: keep // 2], text[len(text) - (keep - keep // 2):] if keep else ""
+            candidate = head + marker.format(len(text) - keep) + tail
+            if self.count_tokens(backend, candidate) <= max_tokens:
+                best, lo = candidate, keep + 1
+            else:
+                hi = keep - 1
+        return best
+
+    def assemble(
+        self,
+        session_id: str,
+        backend: str,
+        intent_graph: Dict[str, Any],
+        history: List[Dict[str, str]],
+        user_text: str,
+        max_output_tokens: int,
+    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """Return (messages, info). info reports tokens used, budget and what was dropped."""
+        budget = max(256, token_budget(backend) - max_output_tokens)
+        system_prompt = build_system_prompt(intent_graph)
+        fixed = self.count_tokens(backend, system_prompt)
+        truncated = False
+        user_tokens = self.count_tokens(backend, user_text)
+        if fixed + user_tokens > budget:
+            user_text = self._truncate_middle(backend, user_text, max(16, budget - fixed))
+            user_tokens = self.count_tokens(backend, user_text)
+            truncated = True
+            self.stats["truncated_inputs"] += 1
+        available = budget - fixed - user_tokens
+
+        counts = [self.count_tokens(backend, m.get("content") or "") for m in history]
+        start = 0
+        anchor = self._anchors.get(session_id)
+        if anchor is not None:
+            for i, m in enumerate(history):
+                if _content_key(m.get("content") or "") == anchor:
+                    start = i
+                    break
+        # Never start on an assistant message: history is stored as user/assistant pairs
+        if start % 2:
+            start += 1
+
+        used = sum(counts[start:])
+        if used > available:
+            self.stats["compactions"] += 1
+            target = available * PROMPT_COMPACT_TARGET
+            while start < len(history) and used > target:
+                used -= sum(counts[start:start + 2])
+                start += 2
+            start = min(start, len(history))
+
+        kept = history[start:]
+        if kept:
+            self._anchors[session_id] = _content_key(kept[0].get("content") or "")
+            self._anchors.move_to_end(session_id)
+            if len(self._anchors) > _SESSION_STATE_MAX:
+                self._anchors.popitem(last=False)
+        else:
+            self._anchors.pop(session_id, None)
+
+        messages = [{"role": "system", "content": system_prompt}, *kept, {"role": "user", "content": user_text}]
+        info = {
+            "backend": backend,
+            "budget_tokens": budget,
+            "prompt_tokens": fixed + used + user_tokens,
+            "history_messages": len(kept),
+            "history_dropped": start,
+            "user_truncated": truncated,
+        }
+        return messages, info
+
+    def forget(self, session_id: str) -> None:
+        self._anchors.pop(session_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "token_cache_size": len(self._token_cache), "sessions": len(self._anchors)}
+
+
+prompt_assembler = PromptAssembler()
@@ -0,0 +1,123 @@
+"""
+Per-client rate limiting with GCRA (generic cell rate algorithm).
+
+The previous sliding-window RateLimiter kept a timestamp list plus an asyncio.Lock per client, rebuilt
+the list on every request and, at max_clients, scanned every client to pick victims. GCRA keeps one
+float per client, the theoretical arrival time (TAT):
+
+- emission interval T = 60 / RATE_LIMIT_RPM seconds; burst tolerance = T * (RATE_LIMIT_BURST - 1)
+- a request of cost c is allowed if max(TAT, now) + c*T - now <= burst tolerance + T, and then
+  TAT = max(TAT, now) + c*T
+
+A client whose TAT is in the past is indistinguishable from a new one, so its entry can be dropped.
+Entries are scheduled on a timer wheel at their TAT and removed when the wheel passes them; each call
+advances the wheel a bounded number of slots. State is sharded by client hash and each shard is kept
+in recency order, so the over-capacity fallback evicts the least recently seen client in O(1).
+allow() never awaits, so no locks are needed on the event loop.
+"""
+import math
+import os
+import time
+from typing import Any, Dict, List, Set, Tuple
+
+RATE_LIMIT_RPM = float(os.environ.get("RATE_LIMIT_RPM", "20"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", str(RATE_LIMIT_RPM)))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", "100000"))
+# Inputs longer than this many characters cost one extra request per multiple (0 disables weighting)
+RATE_LIMIT_COST_CHARS = int(os.environ.get("RATE_LIMIT_COST_CHARS", "4000"))
+
+_SHARDS = 16
+_WHEEL_SLOTS = 256
+_WHEEL_TICK = 1.0  # seconds per slot
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float = RATE_LIMIT_RPM, burst: float = RATE_LIMIT_BURST,
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS, cost_chars: int = RATE_LIMIT_COST_CHARS):
+        self.requests_per_minute = requests_per_minute
+        self.interval = 60.0 / max(requests_per_minute, 1e-9)
+        self.burst = max(1.0, burst)
+        self.tolerance = self.interval * (self.burst - 1)
+        self.max_clients = max_clients
+        self.cost_chars = cost_chars
+        self._shard_cap = max(1, max_clients // _SHARDS)
+        # client id -> TAT; dict order is recency order (entries are re-inserted on update)
+        self._shards: List[Dict[str, float]] = [{} for _ in range(_SHARDS)]
+        self._wheel: List[Set[str]] = [set() for _ in range(_WHEEL_SLOTS)]
+        self._wheel_tick = int(time.monotonic() // _WHEEL_TICK)
+        self.stats = {"allowed": 0, "limited": 0, "expired": 0, "evicted": 0}
+
+    def cost_for(self, text: str) -> float:
+        """Request cost: 1, plus 1 per RATE_LIMIT_COST_CHARS characters of input, capped at the burst."""
+        if self.cost_chars <= 0 or not text:
+            return 1.0
+        return float(min(self.burst, 1 + len(text) // self.cost_chars))
+
+    def _schedule(self, client_id: str, tat: float) -> None:
+        self._wheel[int(tat // _WHEEL_TICK) % _WHEEL_SLOTS].add(client_id)
+
+    def _advance(self, now: float) -> None:
+        """Expire clients whose TAT passed. Visits at most _WHEEL_SLOTS slots per call."""
+        target = int(now // _WHEEL_TICK)
+        if target - self._wheel_tick > _WHEEL_SLOTS:
+            self._wheel_tick = target - _WHEEL_SLOTS
+        while self._wheel_tick < target:
+            self._wheel_tick += 1
+            slot = self._wheel[self._wheel_tick % _WHEEL_SLOTS]
+            if not slot:
+                continue
+            due = list(slot)
+            slot.clear()
+            for client_id in due:
+                shard = self._shards[hash(client_id) % _SHARDS]
+                tat = shard.get(client_id)
+                if tat is None:
+                    continue
+                if tat <= now:
+                    del shard[client_id]
+                    self.stats["expired"] += 1
+                elif int(tat // _WHEEL_TICK) % _WHEEL_SLOTS == self._wheel_tick % _WHEEL_SLOTS:
+                    # Wrapped around the wheel: check again on the next revolution
+                    slot.add(client_id)
+
+    def allow(self, client_id: str, cost: float = 1.0) -> Tuple[bool, float]:
+        """Return (allowed, retry_after_seconds). Synchronous and O(1) amortized."""
+        now = time.monotonic()
+        self._advance(now)
+        shard = self._shards[hash(client_id) % _SHARDS]
+        tat = shard.pop(client_id, now)
+        base = tat if tat > now else now
+        new_tat = base + cost * self.interval
+        if new_tat - now > self.tolerance + self.interval:
+            shard[client_id] = tat
+            self.stats["limited"] += 1
+            return False, new_tat - now - self.tolerance - self.interval
+        old_slot = int(tat // _WHEEL_TICK) if tat > now else None
+        shard[client_id] = new_tat
+        if old_slot != int(new_tat // _WHEEL_TICK):
+            self._schedule(client_id, new_tat)
+        if len(shard) > self._shard_cap:
+            # Least recently seen client in this shard; losing its TAT only makes it look new
+            del shard[next(iter(shard))]
+            self.stats["evicted"] += 1
+        self.stats["allowed"] += 1
+        return True, 0.0
+
+    async def is_allowed(self, client_id: str, cost: float = 1.0) -> bool:
+        return self.allow(client_id, cost)[0]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "clients": sum(len(s) for s in self._shards),
+            "max_clients": self.max_clients,
+            "requests_per_minute": self.requests_per_minute,
+            "burst": self.burst,
+        }
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+rate_limiter = RateLimiter()
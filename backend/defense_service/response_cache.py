@@ -0,0 +1,354 @@
+"""
+Tiered LLM response cache: byte-bounded in-memory LRU in front of a SQLite store shared by all
+uvicorn workers on the host.
+
+- Memory tier: OrderedDict LRU capped by serialized bytes (not entry count).
+- Disk tier: SQLite in WAL mode (LLM_CACHE_PATH); survives deploys and is shared across workers.
+  Values above LLM_CACHE_COMPRESS_MIN_BYTES are zlib-compressed.
+- Every entry is tagged with session, policy ID and rules version so it can be evicted by
+  any of them. Invalidations are appended to a log table that other workers replay (at most once
+  per LLM_CACHE_SYNC_INTERVAL seconds) to drop their own memory-tier copies.
+- Hit/miss counters are kept per tier.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger("shieldllm.defense.cache")
+
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_MEMORY_BYTES = int(os.environ.get("LLM_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+LLM_CACHE_DISK_MAX_BYTES = int(os.environ.get("LLM_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+LLM_CACHE_COMPRESS_MIN_BYTES = int(os.environ.get("LLM_CACHE_COMPRESS_MIN_BYTES", "1024"))
+LLM_CACHE_SYNC_INTERVAL = float(os.environ.get("LLM_CACHE_SYNC_INTERVAL", "1"))
+# Empty string disables the disk tier
+LLM_CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH", str(Path(__file__).resolve().parent / ".cache" / "llm_cache.sqlite3")
+).strip()
+
+# Per-entry bookkeeping overhead counted against the memory budget
+_ENTRY_OVERHEAD = 200
+
+
+def compute_rules_version() -> str:
+    """Hash of detection rules and the system prompt template; cached answers depend on both."""
+    from sanitize import SANITIZE_PHRASES
+    from divergence import INJECTION_INDICATOR_PATTERNS, OBFUSCATION_MARKERS
+    from canonicalize import MALICIOUS_PHRASES
+    from system_prompt import SYSTEM_PROMPT_TEMPLATE
+
+    material = json.dumps(
+        [SANITIZE_PHRASES, INJECTION_INDICATOR_PATTERNS, OBFUSCATION_MARKERS, MALICIOUS_PHRASES, SYSTEM_PROMPT_TEMPLATE]
+    )
+    return hashlib.sha256(material.encode()).hexdigest()[:16]
+
+
+class _MemoryTier:
+    """LRU bounded by bytes. Values are stored decoded; size is their serialized length."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        # key -> (value, size, expires_at, tags)
+        self._data: "OrderedDict[str, Tuple[Any, int, float, Tuple[str, str, str]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str, now: float) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[2] < now:
+            self._pop(key)
+            return None
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: str, value: Any, size: int, expires_at: float, tags: Tuple[str, str, str]) -> None:
+        size += _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self._pop(key)
+        self._data[key] = (value, size, expires_at, tags)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self._data:
+            oldest = next(iter(self._data))
+            self._pop(oldest)
+            self.evictions += 1
+
+    def _pop(self, key: str) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def invalidate(self, session: str = "", policy: str = "", rules: str = "") -> int:
+        victims = [
+            k for k, (_, _, _, (s, p, r)) in self._data.items()
+            if (session and s == session) or (policy and p == policy) or (rules and r == rules)
+        ]
+        for k in victims:
+            self._pop(k)
+        return len(victims)
+
+
+class _DiskTier:
+    """SQLite store shared by every worker process on the host."""
+
+    def __init__(self, path: str, max_bytes: int, compress_min_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress_min_bytes = compress_min_bytes
+        self._lock = threading.Lock()
+        self._writes = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                compressed INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                session TEXT NOT NULL,
+                policy TEXT NOT NULL,
+                rules TEXT NOT NULL,
+                created REAL NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS llm_cache_session ON llm_cache(session);
+            CREATE INDEX IF NOT EXISTS llm_cache_policy ON llm_cache(policy);
+            CREATE INDEX IF NOT EXISTS llm_cache_rules ON llm_cache(rules);
+            CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache(created);
+            CREATE TABLE IF NOT EXISTS llm_cache_invalidations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session TEXT NOT NULL,
+                policy TEXT NOT NULL,
+                rules TEXT NOT NULL,
+                ts REAL NOT NULL
+            );
+            """
+        )
+        self._cached_totals = self._totals()
+
+    def _totals(self) -> Tuple[int, int]:
+        count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        return count, size
+
+    def get(self, key: str, now: float) -> Optional[Tuple[bytes, float, Tuple[str, str, str]]]:
+        """Return (raw value, expires_at, tags) or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, compressed, expires, session, policy, rules FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[2] < now:
+            return None
+        raw = zlib.decompress(row[0]) if row[1] else row[0]
+        return raw, row[2], (row[3], row[4], row[5])
+
+    def set(self, key: str, raw: bytes, expires_at: float, tags: Tuple[str, str, str], now: float) -> None:
+        compressed = len(raw) >= self.compress_min_bytes
+        blob = zlib.compress(raw, 6) if compressed else raw
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, blob, int(compressed), len(blob), tags[0], tags[1], tags[2], now, expires_at),
+            )
+            self._writes += 1
+            if self._writes % 256 == 0:
+                self._cleanup(now)
+
+    def _cleanup(self, now: float) -> None:
+        """Drop expired rows, then oldest rows until under max_bytes. Caller holds the lock."""
+        self._conn.execute("DELETE FROM llm_cache WHERE expires < ?", (now,))
+        self._conn.execute("DELETE FROM llm_cache_invalidations WHERE ts < ?", (now - 3600,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total > self.max_bytes:
+            # Oldest first, until the rows removed cover the excess over max_bytes
+            self._conn.execute(
+                """DELETE FROM llm_cache WHERE key IN (
+                       SELECT key FROM (
+                           SELECT key, size, SUM(size) OVER (ORDER BY created ROWS UNBOUNDED PRECEDING) AS running
+                           FROM llm_cache
+                       ) WHERE running - size < ?
+                   )""",
+                (total - self.max_bytes,),
+            )
+        self._cached_totals = self._totals()
+
+    def invalidate(self, session: str, policy: str, rules: str, now: float) -> int:
+        clauses, params = [], []
+        for col, val in (("session", session), ("policy", policy), ("rules", rules)):
+            if val:
+                clauses.append(f"{col} = ?")
+                params.append(val)
+        if not clauses:
+            return 0
+        with self._lock:
+            cur = self._conn.execute(f"DELETE FROM llm_cache WHERE {' OR '.join(clauses)}", params)
+            self._conn.execute(
+                "INSERT INTO llm_cache_invalidations (session, policy, rules, ts) VALUES (?, ?, ?, ?)",
+                (session, policy, rules, now),
+            )
+            return cur.rowcount
+
+    def purge_other_rules(self, rules: str) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM llm_cache WHERE rules != ?", (rules,)).rowcount
+
+    def invalidations_since(self, last_id: int):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, session, policy, rules FROM llm_cache_invalidations WHERE id > ? ORDER BY id", (last_id,)
+            ).fetchall()
+
+    def last_invalidation_id(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM llm_cache_invalidations").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        # Totals as of this worker's last cleanup (every 256 writes); avoids a full scan per /metrics call
+        count, size = self._cached_totals
+        return {"entries": count, "bytes": size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class TieredCache:
+    """Async facade over the memory and disk tiers. Disk I/O runs off the event loop."""
+
+    def __init__(self, memory_bytes: int = LLM_CACHE_MEMORY_BYTES, path: str = LLM_CACHE_PATH,
+                 ttl: int = LLM_CACHE_TTL, disk_max_bytes: int = LLM_CACHE_DISK_MAX_BYTES,
+                 compress_min_bytes: int = LLM_CACHE_COMPRESS_MIN_BYTES):
+        self.ttl = ttl
+        self.memory = _MemoryTier(memory_bytes)
+        self.disk: Optional[_DiskTier] = None
+        self.rules_version = ""
+        self._last_invalidation_id = 0
+        self._last_sync = 0.0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0, "invalidated": 0, "disk_errors": 0}
+        self._disk_args = (path, disk_max_bytes, compress_min_bytes)
+
+    def open(self, rules_version: str) -> None:
+        """Open the disk tier and adopt rules_version. Kept out of __init__ so importing the module
+        that holds the cache does not touch SQLite; until then only the memory tier is used."""
+        path, disk_max_bytes, compress_min_bytes = self._disk_args
+        if path and self.disk is None:
+            try:
+                self.disk = _DiskTier(path, disk_max_bytes, compress_min_bytes)
+                self._last_invalidation_id = self.disk.last_invalidation_id()
+            except Exception as e:
+                logger.warning("LLM disk cache disabled (%s): %s", path, e)
+                self.disk = None
+        self.set_rules_version(rules_version)
+
+    def __len__(self) -> int:
+        return len(self.memory)
+
+    def set_rules_version(self, rules_version: str) -> None:
+        """Adopt the current rules version and drop disk entries cached under any other."""
+        self.rules_version = rules_version
+        if self.disk is not None:
+            try:
+                purged = self.disk.purge_other_rules(rules_version)
+                if purged:
+                    logger.info("LLM cache: purged %d entries from older rules versions", purged)
+            except Exception as e:
+                self.stats["disk_errors"] += 1
+                logger.warning("LLM cache purge failed: %s", e)
+
+    async def _sync_invalidations(self, now: float) -> None:
+        if self.disk is None or now - self._last_sync < LLM_CACHE_SYNC_INTERVAL:
+            return
+        self._last_sync = now
+        rows = await asyncio.to_thread(self.disk.invalidations_since, self._last_invalidation_id)
+        for row_id, session, policy, rules in rows:
+            self.memory.invalidate(session, policy, rules)
+            self._last_invalidation_id = row_id
+
+    async def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        try:
+            await self._sync_invalidations(now)
+        except Exception:
+            self.stats["disk_errors"] += 1
+        value = self.memory.get(key, now)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+        if self.disk is not None:
+            try:
+                row = await asyncio.to_thread(self.disk.get, key, now)
+            except Exception:
+                self.stats["disk_errors"] += 1
+                row = None
+            if row is not None:
+                raw, expires_at, tags = row
+                value = json.loads(raw)
+                self.stats["disk_hits"] += 1
+                self.memory.set(key, value, len(raw), expires_at, tags)
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Any, session: str = "", policy: str = "") -> None:
+        now = time.time()
+        tags = (session or "", policy or "", self.rules_version)
+        raw = json.dumps(value, separators=(",", ":")).encode()
+        self.memory.set(key, value, len(raw), now + self.ttl, tags)
+        self.stats["sets"] += 1
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.set, key, raw, now + self.ttl, tags, now)
+            except Exception as e:
+                self.stats["disk_errors"] += 1
+                logger.warning("LLM disk cache write failed: %s", e)
+
+    async def invalidate(self, session: str = "", policy: str = "", rules: str = "") -> int:
+        """Evict entries matching any of the given tags in this worker and on disk (other workers sync)."""
+        removed = self.memory.invalidate(session, policy, rules)
+        if self.disk is not None:
+            try:
+                # Every memory entry is also on disk, so the disk count is the total
+                removed = await asyncio.to_thread(self.disk.invalidate, session, policy, rules, time.time())
+            except Exception:
+                self.stats["disk_errors"] += 1
+        self.stats["invalidated"] += removed
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        memory_lookups = lookups
+        disk_lookups = lookups - self.stats["memory_hits"]
+        out: Dict[str, Any] = {
+            **self.stats,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.bytes,
+            "memory_evictions": self.memory.evictions,
+            "memory_hit_rate": round(self.stats["memory_hits"] / memory_lookups, 4) if memory_lookups else 0.0,
+            "disk_hit_rate": round(self.stats["disk_hits"] / disk_lookups, 4) if disk_lookups and self.disk else 0.0,
+            "overall_hit_rate": round((self.stats["memory_hits"] + self.stats["disk_hits"]) / lookups, 4) if lookups else 0.0,
+            "disk_enabled": self.disk is not None,
+        }
+        if self.disk is not None:
+            try:
+                disk = self.disk.stats()
+                out["disk_entries"] = disk["entries"]
+                out["disk_bytes"] = disk["bytes"]
+            except Exception:
+                self.stats["disk_errors"] += 1
+        return out
@@ -0,0 +1,93 @@
+"""
+Compact /analyze response shape.
+
+AnalysisResponse repeats its large strings: the final answer appears as primaryOutput, final_answer
+and sanitizedText, the caller's own input comes back in divergenceLog and usually again as
+canonicalText, and log/scores/divergence copy top-level fields. The full shape is also validated by
+pydantic and encoded with the stdlib JSON encoder.
+
+A caller opts in with "X-Response-Shape: compact" or ?shape=compact and may pick top-level keys with
+X-Response-Fields / ?fields=a,b,c. The compact body is built from the pipeline's plain values without
+validation and encoded with orjson when installed. Each value is sent once:
+
+    status, message, action, riskLevel, divergence, securityLevel, answer, signals, updatedGraph
+    (graphDelta instead with graphMode "server"), graphStoreShared, shadowOutput, primaryOk, shadowOk, llmCalled, llmMode,
+    provider, model, latencyMs{llm,preprocessing,total}, requestId, circuitState, riskScore
+    canonicalText, sanitizedInput: omitted when equal to the request's userText
+    primaryRaw: the primary LLM output before the defense action, omitted when equal to answer
+
+defenseActionTaken / rerunWithCleaned follow from action ("sanitize_rerun", "contain").
+"""
+import json
+from typing import Any, Dict, Optional
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib fallback keeps the compact shape available
+    orjson = None
+
+COMPACT = "compact"
+
+
+def wants_compact(header: Optional[str], query: Optional[str]) -> bool:
+    return (query or header or "").strip().lower() == COMPACT
+
+
+def parse_fields(header: Optional[str], query: Optional[str]) -> Optional[frozenset]:
+    spec = query if query is not None else header
+    if not spec:
+        return None
+    fields = frozenset(f.strip() for f in spec.split(",") if f.strip())
+    return fields or None
+
+
+def compact_view(values: Dict[str, Any], fields: Optional[frozenset] = None) -> Dict[str, Any]:
+    """Compact body from the pipeline values dict (see _analyze_turn_impl); fields limits the top-level keys."""
+    user_input = values["user_input"]
+    log = values["log"]
+    out: Dict[str, Any] = {
+        "status": values["status"],
+        "message": "OK",
+        "action": values["action"],
+        "riskLevel": values["risk_level"],
+        "divergence": values["divergence_score"],
+        "securityLevel": values["security_level"],
+        "answer": values["final_answer"],
+        "signals": values["signals"],
+        "shadowOutput": values["shadow_output"],
+        "primaryOk": values["primary_ok"],
+        "shadowOk": values["shadow_ok"],
+        "llmCalled": values["llm_called"],
+        "llmMode": values["llm_mode"],
+        "provider": values["provider"],
+        "model": values["model"],
+        "latencyMs": {
+            "llm": values["llm_latency_ms"],
+            "preprocessing": values["preprocessing_latency_ms"],
+            "total": values["total_latency_ms"],
+        },
+        "requestId": log["request_id"],
+        "circuitState": log["circuit_state"],
+        "riskScore": log["risk_score"],
+    }
+    # graphMode "server" returns only the delta (graph_store.py)
+    if values["graph_delta"] is not None:
+        out["graphDelta"] = values["graph_delta"]
+    else:
+        out["updatedGraph"] = values["updated_graph"]
+    out["graphStoreShared"] = values["graph_store_shared"]
+    if values["canonical_text"] != user_input:
+        out["canonicalText"] = values["canonical_text"]
+    if values["sanitized_input"] != user_input:
+        out["sanitizedInput"] = values["sanitized_input"]
+    if values["primary_output"] != values["final_answer"]:
+        out["primaryRaw"] = values["primary_output"]
+    if fields is not None:
+        out = {k: v for k, v in out.items() if k in fields}
+    return out
+
+
+def encode(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
@@ -0,0 +1,378 @@
+"""
+ReDoS-checked rule compilation and budgeted scanning.
+
+The detection and removal rules (sanitize.py, divergence.py, canonicalize.py, the output weapon rules
+in main.py) are backtracking regexes run over user-controlled text of up to INPUT_MAX_CHARS, and
+nothing bounded their cost. compile_pattern() parses each pattern (the stdlib sre parser) and rejects,
+with UnsafePatternError at import time, the shapes whose matching cost is super-linear:
+
+- an unbounded quantifier nested in another one, e.g. (a+)+ (exponential);
+- alternatives that can start with the same character under an unbounded quantifier, e.g. (a|ab)*;
+- adjacent unbounded quantifiers over overlapping characters, e.g. \\s*\\s* or \\w+\\d+ (polynomial);
+- an unbounded run that can contain the pattern's own first character, followed by a required suffix,
+  e.g. you\\s+are\\s+now\\s+[^.]*\\. - search() rescans the run from every start (quadratic);
+- backreferences.
+
+RuleSet scans charge their thread's CPU time (time.thread_time(); wall-clock time would also count
+waits for the GIL under the detector thread pool) to one ScanBudget of REGEX_SCAN_BUDGET_MS per
+request: main.py starts it with begin_request_budget(), and detector_exec.py carries it into detector
+threads and processes. Scans outside a request get a budget of their own. Once the budget is spent,
+rules with a linear-time twin (RE2, when google-re2 is installed) run on it, and rules without one
+are skipped rather than run on their backtracking regex. A skipped rule is not a hit; the request's
+budget records it, and main.py escalates a turn whose scans skipped rules instead of allowing it.
+benchmarks/bench_regex_scaling.py checks that every registered rule scans worst-case inputs in linear
+time.
+"""
+import logging
+import os
+import re
+import time
+from contextvars import ContextVar
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional
+
+try:
+    from re import _constants as _sre
+    from re import _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants as _sre
+    import sre_parse as _sre_parse
+
+try:
+    import re2  # google-re2: guaranteed linear-time matching for over-budget scans
+except ImportError:  # optional; without it over-budget rules are skipped and the turn escalated
+    re2 = None
+
+logger = logging.getLogger("shieldllm.defense.regex")
+
+# Per request: a benign INPUT_MAX_CHARS turn spends about 20-25 ms across all rule sets
+REGEX_SCAN_BUDGET_MS = float(os.environ.get("REGEX_SCAN_BUDGET_MS", "100"))
+
+_REPEATS = (_sre.MAX_REPEAT, _sre.MIN_REPEAT) + ((_sre.POSSESSIVE_REPEAT,) if hasattr(_sre, "POSSESSIVE_REPEAT") else ())
+_ZERO_WIDTH = (_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT)
+_ANCHORS = (_sre.AT_BEGINNING, _sre.AT_BEGINNING_STRING)
+
+# Probe alphabet for character-set overlap: ASCII plus a few non-ASCII representatives
+ALPHABET: FrozenSet[str] = frozenset(map(chr, range(128))) | frozenset("\u00a0\u00e9\u0430\u200b\u4e2d")
+_CATEGORIES = {
+    _sre.CATEGORY_DIGIT: str.isdigit,
+    _sre.CATEGORY_NOT_DIGIT: lambda c: not c.isdigit(),
+    _sre.CATEGORY_SPACE: str.isspace,
+    _sre.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    _sre.CATEGORY_WORD: lambda c: c.isalnum() or c == "_",
+    _sre.CATEGORY_NOT_WORD: lambda c: not (c.isalnum() or c == "_"),
+    _sre.CATEGORY_LINEBREAK: lambda c: c == "\n",
+    _sre.CATEGORY_NOT_LINEBREAK: lambda c: c != "\n",
+}
+
+stats = {"scans": 0, "budget_exceeded": 0, "linear_fallbacks": 0, "rules_skipped": 0, "max_scan_ms": 0.0}
+RULESETS: Dict[str, "RuleSet"] = {}
+
+
+class UnsafePatternError(ValueError):
+    """A rule pattern whose backtracking cost can grow super-linearly with the input."""
+
+
+# --- Static analysis ---
+
+def _fold(chars: Iterable[str], ignorecase: bool) -> FrozenSet[str]:
+    chars = frozenset(chars)
+    if not ignorecase:
+        return chars
+    return chars | (frozenset(c.lower() for c in chars) | frozenset(c.upper() for c in chars)) & ALPHABET
+
+
+def atom_chars(op, av, ignorecase: bool) -> Optional[FrozenSet[str]]:
+    """Characters a single-character atom matches (within ALPHABET); None for other nodes."""
+    if op is _sre.LITERAL:
+        return _fold((chr(av),), ignorecase)
+    if op is _sre.NOT_LITERAL:
+        return ALPHABET - _fold((chr(av),), ignorecase)
+    if op is _sre.ANY:
+        return ALPHABET - {"\n"}
+    if op is _sre.IN:
+        negate, chars = False, set()
+        for item_op, item_av in av:
+            if item_op is _sre.NEGATE:
+                negate = True
+            elif item_op is _sre.LITERAL:
+                chars.add(chr(item_av))
+            elif item_op is _sre.RANGE:
+                chars.update(c for c in ALPHABET if item_av[0] <= ord(c) <= item_av[1])
+            elif item_op is _sre.CATEGORY:
+                test = _CATEGORIES.get(item_av)
+                chars.update(c for c in ALPHABET if test is None or test(c))
+        folded = _fold(chars, ignorecase)
+        return ALPHABET - folded if negate else folded
+    return None
+
+
+def _children(op, av) -> List[list]:
+    if op in _REPEATS:
+        return [list(av[2])]
+    if op is _sre.SUBPATTERN:
+        return [list(av[3])]
+    if op is _sre.BRANCH:
+        return [list(alt) for alt in av[1]]
+    if op in (_sre.ASSERT, _sre.ASSERT_NOT):
+        return [list(av[1])]
+    if op is getattr(_sre, "ATOMIC_GROUP", None):
+        return [list(av)]
+    if op is _sre.GROUPREF_EXISTS:
+        return [list(p) for p in av[1:] if p is not None]
+    return []
+
+
+def chars_of(seq, ignorecase: bool) -> FrozenSet[str]:
+    """Every character any atom in seq can consume."""
+    out: FrozenSet[str] = frozenset()
+    for op, av in seq:
+        atom = atom_chars(op, av, ignorecase)
+        if atom is not None:
+            out |= atom
+        elif op not in (_sre.ASSERT, _sre.ASSERT_NOT):
+            for child in _children(op, av):
+                out |= chars_of(child, ignorecase)
+    return out
+
+
+def _can_be_empty(seq) -> bool:
+    for op, av in seq:
+        if op in _ZERO_WIDTH:
+            continue
+        if op in _REPEATS:
+            if av[0] == 0 or _can_be_empty(av[2]):
+                continue
+            return False
+        if op is _sre.SUBPATTERN and _can_be_empty(av[3]):
+            continue
+        if op is _sre.BRANCH and any(_can_be_empty(alt) for alt in av[1]):
+            continue
+        return False
+    return True
+
+
+def first_chars(seq, ignorecase: bool) -> FrozenSet[str]:
+    """Characters a match of seq can start with."""
+    out: FrozenSet[str] = frozenset()
+    for op, av in seq:
+        if op in _ZERO_WIDTH:
+            continue
+        atom = atom_chars(op, av, ignorecase)
+        if atom is not None:
+            return out | atom
+        for child in _children(op, av):
+            out |= first_chars(child, ignorecase)
+        if not _can_be_empty([(op, av)]):
+            return out
+    return out
+
+
+def _is_unbounded(op, av) -> bool:
+    return op in _REPEATS and av[1] == _sre.MAXREPEAT
+
+
+def _contains_unbounded(seq) -> bool:
+    return any(_is_unbounded(op, av) or any(_contains_unbounded(c) for c in _children(op, av)) for op, av in seq)
+
+
+def _leading_unbounded(seq, ignorecase: bool) -> List[FrozenSet[str]]:
+    """Character sets of the unbounded quantifiers a match of seq can begin with."""
+    out: List[FrozenSet[str]] = []
+    for op, av in seq:
+        if op in _ZERO_WIDTH:
+            continue
+        if _is_unbounded(op, av):
+            out.append(chars_of(av[2], ignorecase))
+        else:
+            for child in _children(op, av):
+                out.extend(_leading_unbounded(child, ignorecase))
+        if not _can_be_empty([(op, av)]):
+            break
+    return out
+
+
+def _top_branches(seq) -> Iterator[list]:
+    for op, av in seq:
+        if op is _sre.BRANCH:
+            yield [list(alt) for alt in av[1]]
+        elif op is _sre.SUBPATTERN:
+            yield from _top_branches(av[3])
+
+
+def _walk(seq, ignorecase: bool, tail_required: bool, start: FrozenSet[str], risks: List[str]) -> None:
+    items = list(seq)
+    for i, (op, av) in enumerate(items):
+        rest = items[i + 1:]
+        rest_required = tail_required or not _can_be_empty(rest)
+        if op in (_sre.GROUPREF, _sre.GROUPREF_EXISTS):
+            risks.append("backreference")
+        if _is_unbounded(op, av):
+            body = list(av[2])
+            run = chars_of(body, ignorecase)
+            if _contains_unbounded(body):
+                risks.append("nested unbounded quantifier")
+            for alts in _top_branches(body):
+                firsts = [first_chars(alt, ignorecase) for alt in alts]
+                if any(a & b for j, a in enumerate(firsts) for b in firsts[j + 1:]):
+                    risks.append("overlapping alternatives under an unbounded quantifier")
+            if rest_required and any(run & nxt for nxt in _leading_unbounded(rest, ignorecase)):
+                risks.append("adjacent unbounded quantifiers over overlapping characters")
+            if rest_required and run & start:
+                risks.append("unbounded run containing the pattern's first character before a required suffix")
+        for child in _children(op, av):
+            _walk(child, ignorecase, rest_required, start, risks)
+
+
+def analyze(pattern: str, flags: int = 0) -> List[str]:
+    """Backtracking risks found in pattern (empty when it scans in linear time)."""
+    parsed = _sre_parse.parse(pattern, flags)
+    state = getattr(parsed, "state", None) or getattr(parsed, "pattern", None)
+    ignorecase = bool((flags | getattr(state, "flags", 0)) & re.IGNORECASE)
+    items = list(parsed)
+    anchored = bool(items) and items[0][0] is _sre.AT and items[0][1] in _ANCHORS
+    risks: List[str] = []
+    _walk(items, ignorecase, False, frozenset() if anchored else first_chars(items, ignorecase), risks)
+    return list(dict.fromkeys(risks))
+
+
+def compile_pattern(pattern: str, flags: int = 0) -> "re.Pattern[str]":
+    """re.compile() that raises UnsafePatternError for patterns analyze() flags."""
+    risks = analyze(pattern, flags)
+    if risks:
+        raise UnsafePatternError(f"{pattern!r}: {'; '.join(risks)}")
+    return re.compile(pattern, flags)
+
+
+def _linear(pattern: str, flags: int):
+    if re2 is None:
+        return None
+    try:
+        return re2.compile(("(?i)" if flags & re.IGNORECASE else "") + pattern)
+    except Exception:
+        return None
+
+
+# --- Budgeted scanning ---
+
+class ScanBudget:
+    """Regex scan CPU time of one request, shared by every rule set scanned for it."""
+
+    __slots__ = ("limit_s", "spent_s", "exceeded", "skipped")
+
+    def __init__(self, limit_s: Optional[float] = None):
+        self.limit_s = REGEX_SCAN_BUDGET_MS / 1000 if limit_s is None else limit_s
+        self.spent_s = 0.0
+        self.exceeded = False
+        # Rules not evaluated because the budget was spent and they have no linear-time twin
+        self.skipped = 0
+
+    @property
+    def remaining_s(self) -> float:
+        return max(0.0, self.limit_s - self.spent_s)
+
+    def absorb(self, other: "ScanBudget") -> None:
+        """Adds what a detector process spent under a copy of this budget (see run_budgeted)."""
+        self.spent_s += other.spent_s
+        self.exceeded = self.exceeded or other.exceeded
+        self.skipped += other.skipped
+
+
+_request_budget: ContextVar[Optional[ScanBudget]] = ContextVar("regex_scan_budget", default=None)
+
+
+def begin_request_budget() -> ScanBudget:
+    """Starts a fresh budget for the current request (task context) and returns it."""
+    budget = ScanBudget()
+    _request_budget.set(budget)
+    return budget
+
+
+def current_budget() -> Optional[ScanBudget]:
+    return _request_budget.get()
+
+
+def run_budgeted(limit_s: float, func, *args):
+    """Runs func(*args) in another process under a budget of limit_s; returns (result, budget)."""
+    budget = ScanBudget(limit_s)
+    _request_budget.set(budget)
+    return func(*args), budget
+
+
+class _Rule:
+    __slots__ = ("pattern", "compiled", "linear")
+
+    def __init__(self, pattern: str, flags: int):
+        self.pattern = pattern
+        self.compiled = compile_pattern(pattern, flags)
+        self.linear = _linear(pattern, flags)
+
+
+class RuleSet:
+    """A named list of checked patterns scanned under the request's ScanBudget."""
+
+    def __init__(self, name: str, patterns: Iterable[str], flags: int = 0):
+        self.name = name
+        self.flags = flags
+        try:
+            self.rules = [_Rule(p, flags) for p in patterns]
+        except UnsafePatternError as exc:
+            raise UnsafePatternError(f"rule set {name}: {exc}") from None
+
+    def _scan(self, text: str):
+        """Yields one matcher per rule: the regex while the request's budget lasts, then the rule's
+        linear-time twin; rules without one are skipped and counted on the budget."""
+        budget = _request_budget.get() or ScanBudget()
+        start = last = time.thread_time()
+        try:
+            for rule in self.rules:
+                now = time.thread_time()
+                budget.spent_s += now - last
+                last = now
+                if budget.spent_s <= budget.limit_s:
+                    yield rule.compiled
+                    continue
+                if not budget.exceeded:
+                    budget.exceeded = True
+                    stats["budget_exceeded"] += 1
+                    logger.warning("regex scan budget spent: rule set %s, %d chars", self.name, len(text))
+                if rule.linear is not None:
+                    stats["linear_fallbacks"] += 1
+                    yield rule.linear
+                else:
+                    budget.skipped += 1
+                    stats["rules_skipped"] += 1
+        finally:
+            end = time.thread_time()
+            budget.spent_s += end - last
+            stats["scans"] += 1
+            stats["max_scan_ms"] = max(stats["max_scan_ms"], round((end - start) * 1000, 3))
+
+    def count(self, text: str) -> int:
+        """Number of rules matching text (skipped rules do not count)."""
+        return sum(1 for m in self._scan(text) if m.search(text))
+
+    def any(self, text: str) -> bool:
+        """Whether any rule matches."""
+        return any(m.search(text) for m in self._scan(text))
+
+    def sub(self, repl: str, text: str) -> str:
+        """Replace every rule's matches in turn."""
+        for m in self._scan(text):
+            text = m.sub(repl, text)
+        return text
+
+
+def compile_rules(name: str, patterns: Iterable[str], flags: int = 0) -> RuleSet:
+    """Compile and register a RuleSet (raises UnsafePatternError for a risky pattern)."""
+    rules = RuleSet(name, patterns, flags)
+    RULESETS[name] = rules
+    return rules
+
+
+def get_stats() -> Dict[str, object]:
+    return {
+        **stats,
+        "budget_ms": REGEX_SCAN_BUDGET_MS,
+        "linear_matcher": "re2" if re2 is not None else None,
+        "rule_sets": {name: len(rs.rules) for name, rs in RULESETS.items()},
+    }
@@ -6,8 +6,11 @@ import re
 import unicodedata
 from typing import List
 
+from safe_regex import compile_pattern, compile_rules
+
 # Zero-width characters that might hide malicious content
-ZERO_WIDTH_PATTERN = re.compile(r"[\u200b\u200c\u200d\ufeff]")
+ZERO_WIDTH_PATTERN = compile_pattern(r"[\u200b\u200c\u200d\ufeff]")
+WHITESPACE_PATTERN = compile_pattern(r"\s+")
 
 # Phrases to remove for shadow path (baseline safe behavior)
 SANITIZE_PHRASES = [
@@ -23,7 +26,7 @@ SANITIZE_PHRASES = [
     r"\bshow\s+(?:me\s+)?(?:the\s+)?system\s+prompt\b",
     r"\breveal\s+(?:the\s+)?(?:system\s+)?(?:prompt|instructions?)\b",
 ]
-SANITIZE_COMPILED = [re.compile(p, re.IGNORECASE) for p in SANITIZE_PHRASES]
+SANITIZE_RULES = compile_rules("sanitize", SANITIZE_PHRASES, re.IGNORECASE)
 
 
 def sanitize_input(user_text: str) -> str:
@@ -35,7 +38,6 @@ def sanitize_input(user_text: str) -> str:
         return user_text
     cleaned = unicodedata.normalize("NFKC", user_text)
     cleaned = ZERO_WIDTH_PATTERN.sub("", cleaned)
-    for pat in SANITIZE_COMPILED:
-        cleaned = pat.sub(" ", cleaned)
-    cleaned = re.sub(r"\s+", " ", cleaned).strip()
+    cleaned = SANITIZE_RULES.sub(" ", cleaned)
+    cleaned = WHITESPACE_PATTERN.sub(" ", cleaned).strip()
     return cleaned if cleaned else user_text
@@ -0,0 +1,88 @@
+"""
+Canonical-text LLM response cache for single-turn requests.
+
+The exact cache in call_primary/call_shadow keys on the raw messages, policy ID and full intent
+graph, so a whitespace/casing change or a longer graph history is always a miss. This cache keys on
+the canonicalized text (progressive_canonicalize output) plus the policy ID (policy_registry.py)
+and the intent constraints that shape the system prompt (goal/allowed/forbidden, not history), so
+inputs that canonicalize to the same text (zero-width characters, homoglyphs, encodings) reuse the
+earlier answer.
+
+Responses are reused only for the identical canonical text. This used to be a SimHash
+near-duplicate lookup (Hamming distance <= 3), but the cached value is the LLM's answer and threat
+assessment: a benign prompt with a short injected suffix landed within that distance and got the
+benign verdict without either LLM seeing the suffix.
+
+Only single-turn requests (no conversation history) are eligible; entries are shared across
+sessions because no session context went into the answer. Enable with SEMANTIC_CACHE_ENABLED=1.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "0").strip().lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", "3600"))
+
+
+def semantic_scope(policy_id: str, intent_graph: Optional[Dict[str, Any]], model_type: str) -> str:
+    """Compact fingerprint of everything besides the user text that shapes a single-turn answer."""
+    graph = intent_graph or {}
+    material = json.dumps(
+        [policy_id, graph.get("goal"), graph.get("allowed"), graph.get("forbidden"), model_type],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.blake2b(material.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _key(role: str, canonical_text: str, scope: str) -> str:
+    digest = hashlib.blake2b(canonical_text.encode("utf-8"), digest_size=16).hexdigest()
+    return f"{role}:{scope}:{digest}"
+
+
+class SemanticCache:
+    def __init__(self, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, ttl: int = SEMANTIC_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # role:scope:text hash -> (value, expires_at)
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "expired": 0, "sets": 0, "evictions": 0}
+
+    def lookup(self, role: str, canonical_text: str, scope: str) -> Optional[Any]:
+        self.stats["lookups"] += 1
+        key = _key(role, canonical_text, scope)
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at >= time.time():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return value
+            del self._entries[key]
+            self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        return None
+
+    def store(self, role: str, canonical_text: str, scope: str, value: Any) -> None:
+        key = _key(role, canonical_text, scope)
+        self._entries[key] = (value, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        self.stats["sets"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": SEMANTIC_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "hit_rate": round(self.stats["hits"] / self.stats["lookups"], 4) if self.stats["lookups"] else 0.0,
+        }
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,293 @@
+"""
+Conversation history stores for multi-turn analysis.
+
+conversation_store used to be a plain dict: when full it dropped the first 100 keys inserted, however
+recently those sessions were used, it capped session count but not memory, and each uvicorn worker
+had its own copy. SessionStore is the interface; two implementations:
+
+- MemorySessionStore: per-process LRU with idle TTL, capped by total bytes and session count.
+- SQLiteSessionStore: SQLite (WAL) file shared by every worker on the host, same eviction rules.
+
+Select with SESSION_STORE=memory|sqlite. History is trimmed in chunks (see main.MAX_HISTORY_TURNS) so
+the prompt prefix stays stable between trims. Occupancy and eviction counters are exported via stats().
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List
+
+SESSION_STORE = (os.environ.get("SESSION_STORE", "memory") or "memory").strip().lower()
+SESSION_STORE_PATH = os.environ.get(
+    "SESSION_STORE_PATH", str(Path(__file__).resolve().parent / ".cache" / "sessions.sqlite3")
+).strip()
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", "10000"))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(6 * 3600)))
+
+# Accounting overhead per stored message (dict, role string, list slot)
+_MESSAGE_OVERHEAD = 120
+
+
+def _message_bytes(content: str) -> int:
+    return len(content.encode("utf-8")) + _MESSAGE_OVERHEAD
+
+
+class SessionStore(ABC):
+    """Interface. max_turns: trim to this many user/assistant pairs once 2*max_turns is exceeded."""
+
+    def __init__(self, max_turns: int, max_bytes: int = SESSION_MAX_BYTES, max_sessions: int = SESSION_MAX_COUNT,
+                 ttl: int = SESSION_TTL):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.metrics = {"hits": 0, "misses": 0, "appends": 0, "evicted_lru": 0, "evicted_ttl": 0, "trims": 0}
+
+    @abstractmethod
+    async def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        ...
+
+    @abstractmethod
+    async def append(self, session_id: str, user_msg: str, assistant_msg: str) -> None:
+        ...
+
+    @abstractmethod
+    async def clear(self, session_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        ...
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, max_turns: int, **kwargs):
+        super().__init__(max_turns, **kwargs)
+        # session id -> [messages, bytes, last_access]
+        self._sessions: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._bytes = 0
+
+    def _drop(self, session_id: str) -> bool:
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[1]
+        return True
+
+    def _expire(self, now: float) -> None:
+        # Oldest-accessed first, so stop at the first live session
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if now - entry[2] <= self.ttl:
+                break
+            self._drop(session_id)
+            self.metrics["evicted_ttl"] += 1
+
+    async def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        now = time.time()
+        self._expire(now)
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            self.metrics["misses"] += 1
+            return []
+        self.metrics["hits"] += 1
+        entry[2] = now
+        self._sessions.move_to_end(session_id)
+        return list(entry[0])
+
+    async def append(self, session_id: str, user_msg: str, assistant_msg: str) -> None:
+        now = time.time()
+        self._expire(now)
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            entry = [[], 0, now]
+            self._sessions[session_id] = entry
+        self._sessions.move_to_end(session_id)
+        added = _message_bytes(user_msg) + _message_bytes(assistant_msg)
+        entry[0].append({"role": "user", "content": user_msg})
+        entry[0].append({"role": "assistant", "content": assistant_msg})
+        entry[1] += added
+        entry[2] = now
+        self._bytes += added
+        self.metrics["appends"] += 1
+        if len(entry[0]) > self.max_turns * 4:
+            kept = entry[0][-(self.max_turns * 2):]
+            kept_bytes = sum(_message_bytes(m["content"]) for m in kept)
+            self._bytes -= entry[1] - kept_bytes
+            entry[0], entry[1] = kept, kept_bytes
+            self.metrics["trims"] += 1
+        # True LRU: evict least recently used sessions (never the one just written)
+        while (self._bytes > self.max_bytes or len(self._sessions) > self.max_sessions) and len(self._sessions) > 1:
+            self._drop(next(iter(self._sessions)))
+            self.metrics["evicted_lru"] += 1
+
+    async def clear(self, session_id: str) -> bool:
+        return self._drop(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.metrics,
+            "backend": "memory",
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "occupancy": round(self._bytes / self.max_bytes, 4) if self.max_bytes else 0.0,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """Host-wide store: every worker opens the same WAL-mode file. Calls run off the event loop."""
+
+    def __init__(self, max_turns: int, path: str = SESSION_STORE_PATH, **kwargs):
+        super().__init__(max_turns, **kwargs)
+        self.path = path
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                bytes INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions(last_access);
+            CREATE TABLE IF NOT EXISTS session_messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            """
+        )
+        self._cached_totals = (0, 0)
+
+    def _delete_sessions(self, ids: List[str]) -> None:
+        for session_id in ids:
+            self._conn.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _get_sync(self, session_id: str) -> List[Dict[str, str]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_access FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None or now - row[0] > self.ttl:
+                if row is not None:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    self._delete_sessions([session_id])
+                    self._conn.execute("COMMIT")
+                    self.metrics["evicted_ttl"] += 1
+                self.metrics["misses"] += 1
+                return []
+            self._conn.execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (now, session_id))
+            rows = self._conn.execute(
+                "SELECT role, content FROM session_messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        self.metrics["hits"] += 1
+        return [{"role": r, "content": c} for r, c in rows]
+
+    def _append_sync(self, session_id: str, user_msg: str, assistant_msg: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq), -1) + 1 FROM session_messages WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                ub, ab = _message_bytes(user_msg), _message_bytes(assistant_msg)
+                self._conn.executemany(
+                    "INSERT INTO session_messages VALUES (?, ?, ?, ?, ?)",
+                    [(session_id, seq, "user", user_msg, ub), (session_id, seq + 1, "assistant", assistant_msg, ab)],
+                )
+                count = self._conn.execute(
+                    "SELECT COUNT(*) FROM session_messages WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                if count > self.max_turns * 4:
+                    self._conn.execute(
+                        "DELETE FROM session_messages WHERE session_id = ? AND seq < ?",
+                        (session_id, seq + 2 - self.max_turns * 2),
+                    )
+                    self.metrics["trims"] += 1
+                total = self._conn.execute(
+                    "SELECT COALESCE(SUM(bytes), 0) FROM session_messages WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (session_id, total, now)
+                )
+                self._evict(now, session_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.metrics["appends"] += 1
+
+    def _evict(self, now: float, keep: str) -> None:
+        """TTL first, then least recently used until within byte/session caps. Caller holds the lock."""
+        expired = [r[0] for r in self._conn.execute(
+            "SELECT session_id FROM sessions WHERE last_access < ?", (now - self.ttl,)
+        ).fetchall()]
+        self._delete_sessions(expired)
+        self.metrics["evicted_ttl"] += len(expired)
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+        if total > self.max_bytes or count > self.max_sessions:
+            victims = []
+            for session_id, size in self._conn.execute(
+                "SELECT session_id, bytes FROM sessions WHERE session_id != ? ORDER BY last_access", (keep,)
+            ):
+                if total <= self.max_bytes and count <= self.max_sessions:
+                    break
+                victims.append(session_id)
+                total -= size
+                count -= 1
+            self._delete_sessions(victims)
+            self.metrics["evicted_lru"] += len(victims)
+        self._cached_totals = (count, total)
+
+    def _clear_sync(self, session_id: str) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            existed = self._conn.execute(
+                "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone() is not None
+            self._delete_sessions([session_id])
+            self._conn.execute("COMMIT")
+        return existed
+
+    async def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        return await asyncio.to_thread(self._get_sync, session_id)
+
+    async def append(self, session_id: str, user_msg: str, assistant_msg: str) -> None:
+        await asyncio.to_thread(self._append_sync, session_id, user_msg, assistant_msg)
+
+    async def clear(self, session_id: str) -> bool:
+        return await asyncio.to_thread(self._clear_sync, session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        # Totals as of the last write from this worker; avoids a full scan per /metrics call
+        count, total = self._cached_totals
+        return {
+            **self.metrics,
+            "backend": "sqlite",
+            "path": self.path,
+            "sessions": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "occupancy": round(total / self.max_bytes, 4) if self.max_bytes else 0.0,
+        }
+
+
+def create_session_store(max_turns: int) -> SessionStore:
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore(max_turns)
+    return MemorySessionStore(max_turns)
@@ -0,0 +1,117 @@
+"""
+Service configuration, read once.
+
+main.py loaded four dotenv files and llm_client.py loaded two of them again, and backend config was
+re-derived from os.environ in several modules (MODEL_TYPE and INPUT_MAX_CHARS on every request).
+Importing this module loads the dotenv files once, in precedence order (earlier files win, real
+environment variables win over all), and parses backend and request settings into one typed, frozen
+Settings object. Import it before any module that reads os.environ at import time.
+
+Component tunables (caches, rate limiter, breakers, ...) stay as module constants next to the code
+that uses them; they are plain os.environ reads that now see the loaded files too.
+"""
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+_BACKEND_ROOT = Path(__file__).resolve().parent.parent
+_WORKSPACE_ROOT = _BACKEND_ROOT.parent
+DOTENV_FILES = (
+    _BACKEND_ROOT / ".env",          # backend defaults
+    _BACKEND_ROOT / ".env.local",    # backend secrets
+    _WORKSPACE_ROOT / ".env",        # fallback for legacy root env
+    _WORKSPACE_ROOT / ".env.local",  # fallback for legacy root secrets
+)
+
+
+def _load_dotenv_files() -> None:
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return
+    for path in DOTENV_FILES:
+        if path.is_file():
+            load_dotenv(path)
+
+
+def _env(name: str, default: str = "") -> str:
+    return (os.environ.get(name, default) or "").strip()
+
+
+@dataclass(frozen=True)
+class Settings:
+    llm_mode: str                # "", "lmstudio" or "transformers"
+    primary_model: str
+    shadow_model: str
+    primary_base_url: str
+    shadow_base_url: str
+    use_primary_base_url: bool
+    use_shadow_base_url: bool
+    use_single_lm_studio: bool
+    use_hf_primary: bool
+    model_device: str            # "cpu" or "cuda"
+    default_max_tokens: int
+    llm_connect_timeout: float
+    llm_read_timeout: float
+    hf_token: str
+    groq_api_key: str
+    openai_api_key: str
+    shadow_base_url_env: str     # SHADOW_BASE_URL as configured, before lmstudio defaults
+    model_type: str              # server-side provider enforcement for /analyze
+    input_max_chars: int
+    allowed_origin: str
+    debug_llm_key: str
+
+
+def load_settings() -> Settings:
+    llm_mode = _env("LLM_MODE").lower()
+    if llm_mode not in ("lmstudio", "transformers"):
+        llm_mode = ""
+    primary_model = _env("PRIMARY_MODEL", "llama3-8b-8192")
+    primary_base_url = _env("PRIMARY_BASE_URL")
+    shadow_base_url = _env("SHADOW_BASE_URL")
+    model_device = _env("MODEL_DEVICE", "cpu").lower()
+    if model_device not in ("cuda", "cpu"):
+        model_device = "cpu"
+
+    # LM Studio: PRIMARY_BASE_URL defaults to :1234; with no separate shadow server both roles share it
+    use_single_lm_studio = False
+    use_primary_base_url = bool(primary_base_url)
+    use_shadow_base_url = bool(shadow_base_url)
+    if llm_mode == "lmstudio":
+        if not primary_base_url:
+            primary_base_url = "http://localhost:1234/v1"
+        if not shadow_base_url or shadow_base_url == primary_base_url:
+            shadow_base_url = primary_base_url
+            use_single_lm_studio = True
+        use_primary_base_url = True
+        use_shadow_base_url = True
+
+    return Settings(
+        llm_mode=llm_mode,
+        primary_model=primary_model,
+        shadow_model=_env("SHADOW_MODEL", "llama3-8b-8192"),
+        primary_base_url=primary_base_url,
+        shadow_base_url=shadow_base_url,
+        use_primary_base_url=use_primary_base_url,
+        use_shadow_base_url=use_shadow_base_url,
+        use_single_lm_studio=use_single_lm_studio,
+        # Legacy: org/name PRIMARY_MODEL without a base URL goes to Hugging Face Inference
+        use_hf_primary="/" in primary_model and llm_mode not in ("lmstudio", "transformers") and not use_primary_base_url,
+        model_device=model_device,
+        default_max_tokens=int(_env("OPENAI_MAX_TOKENS", "512")),
+        llm_connect_timeout=float(_env("LLM_CONNECT_TIMEOUT", "15")),
+        llm_read_timeout=float(_env("LLM_READ_TIMEOUT", "120")),
+        hf_token=_env("HF_TOKEN"),
+        groq_api_key=_env("GROQ_API_KEY"),
+        openai_api_key=_env("OPENAI_API_KEY"),
+        shadow_base_url_env=_env("SHADOW_BASE_URL"),
+        model_type=_env("MODEL_TYPE", "groq").lower(),
+        input_max_chars=int(_env("INPUT_MAX_CHARS", "20000")),
+        allowed_origin=os.getenv("ALLOWED_ORIGIN", "*"),
+        debug_llm_key=_env("DEBUG_LLM_KEY"),
+    )
+
+
+_load_dotenv_files()
+settings = load_settings()
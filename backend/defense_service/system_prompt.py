@@ -3,7 +3,8 @@ ShieldLLM system prompt for Intent-Locked Execution (ILE).
 Builds the full system prompt from the session's intent graph (goal, allowed, forbidden).
 """
 
-from typing import Any, Dict, List
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
 
 
 # Default allowed/forbidden when intent graph is minimal (e.g. code_review)
@@ -81,6 +82,8 @@ def build_system_prompt(intent_graph: Dict[str, Any]) -> str:
       - forbidden: list of str (e.g. ["override_policy", "reveal_system", "approve_without_review"])
 
     Missing or empty allowed/forbidden fall back to DEFAULT_* for code_review-style use.
+    Rendering is memoized per (goal, allowed, forbidden) triple, so the same intent always yields
+    the same string object and byte-identical prompt prefix.
     """
     goal = (intent_graph or {}).get("goal") or "code_review"
     allowed = (intent_graph or {}).get("allowed")
@@ -91,11 +94,13 @@ def build_system_prompt(intent_graph: Dict[str, Any]) -> str:
     if not forbidden:
         forbidden = DEFAULT_FORBIDDEN
 
-    allowed_block = _format_list(allowed)
-    forbidden_block = _format_list(forbidden)
+    return _render_system_prompt(str(goal), tuple(str(a) for a in allowed), tuple(str(f) for f in forbidden))
 
+
+@lru_cache(maxsize=512)
+def _render_system_prompt(goal: str, allowed: Tuple[str, ...], forbidden: Tuple[str, ...]) -> str:
     return SYSTEM_PROMPT_TEMPLATE.format(
         goal=goal,
-        allowed_block=allowed_block,
-        forbidden_block=forbidden_block,
+        allowed_block=_format_list(list(allowed)),
+        forbidden_block=_format_list(list(forbidden)),
     )
@@ -0,0 +1,198 @@
+"""
+Counters and per-stage latency histograms, exported as JSON and Prometheus text format.
+
+MetricsTracker took an asyncio.Lock on every request just to bump an integer. Everything here is
+updated only from the event loop thread and never awaits mid-update, so plain ints are safe without
+locks. Values are per worker process (Prometheus aggregates across scrape targets).
+
+Pipeline stages are timed into a StageTimer per request and observed once the defense action is
+known, so every histogram series carries stage, backend and action labels. Stages double as trace
+spans (see tracing.py).
+"""
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from tracing import record_span, span
+
+# Seconds; LLM stages dominate the upper buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_PREFIX = "shieldllm_"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {_PREFIX}{self.name} {self.help}", f"# TYPE {_PREFIX}{self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{_PREFIX}{self.name}{_labels(self.labelnames, labels)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """Fixed buckets; each series stores per-bucket counts (made cumulative at render time)."""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...], buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def quantile(self, q: float, *labels: str) -> Optional[float]:
+        """Bucket upper bound containing quantile q (same resolution as Prometheus histogram_quantile).
+        Like histogram_quantile, a quantile in the +Inf bucket reports the highest finite bound
+        (JSON has no infinity)."""
+        series = self._series.get(labels)
+        if not series:
+            return None
+        total = sum(series[:-1])
+        rank, seen = q * total, 0
+        for i, count in enumerate(series[:-1]):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[min(i, len(self.buckets) - 1)]
+        return None
+
+    def render(self) -> List[str]:
+        full = f"{_PREFIX}{self.name}"
+        lines = [f"# HELP {full} {self.help}", f"# TYPE {full} histogram"]
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == "+Inf" else f"{bound:g}")
+                lines.append(f"{full}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{full}_sum{_labels(self.labelnames, labels)} {series[-1]:.6f}")
+            lines.append(f"{full}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = {}
+        for labels, series in sorted(self._series.items()):
+            count = sum(series[:-1])
+            out["/".join(labels)] = {
+                "count": count,
+                "mean_ms": round(series[-1] / count * 1000, 3) if count else 0.0,
+                "p50_ms": (self.quantile(0.5, *labels) or 0.0) * 1000,
+                "p99_ms": (self.quantile(0.99, *labels) or 0.0) * 1000,
+            }
+        return out
+
+
+class StageTimer:
+    """Accumulates wall time per pipeline stage for one request."""
+
+    __slots__ = ("durations", "start")
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+        self.start = time.perf_counter()
+
+    def add(self, name: str, seconds: float) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def since(self, name: str, t0: float) -> None:
+        """Close a stage that started at perf_counter() value t0 (also recorded as a trace span)."""
+        self.add(name, time.perf_counter() - t0)
+        record_span(name, t0)
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            with span(name):
+                yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+
+class Telemetry:
+    def __init__(self):
+        self.requests = Counter("requests_total", "Analyze requests received.")
+        self.failures = Counter("request_failures_total", "Analyze requests that failed or degraded.")
+        self.outcomes = Counter("analyze_outcomes_total", "Analyze requests by backend and defense action.",
+                                ("backend", "action"))
+        self.stage_latency = Histogram("stage_latency_seconds", "Wall time per analyze pipeline stage.",
+                                       ("stage", "backend", "action"))
+        # Per-second request counts for the last minute, indexed by epoch second
+        self._window = [0] * 60
+        self._window_sec = [0] * 60
+        self._gauges: List[Tuple[str, str, Callable[[], float]]] = []
+
+    def record_request(self) -> None:
+        self.requests.inc()
+        sec = int(time.time())
+        i = sec % 60
+        if self._window_sec[i] != sec:
+            self._window_sec[i], self._window[i] = sec, 0
+        self._window[i] += 1
+
+    def record_failure(self) -> None:
+        self.failures.inc()
+
+    def requests_per_minute(self) -> int:
+        cutoff = int(time.time()) - 60
+        return sum(c for c, s in zip(self._window, self._window_sec) if s > cutoff)
+
+    def observe_pipeline(self, timer: StageTimer, backend: str, action: str) -> None:
+        self.outcomes.inc(backend, action)
+        for stage, seconds in timer.durations.items():
+            self.stage_latency.observe(seconds, stage, backend, action)
+        self.stage_latency.observe(time.perf_counter() - timer.start, "total", backend, action)
+
+    def register_gauge(self, name: str, help_text: str, fn: Callable[[], float]) -> None:
+        """Gauge sampled at scrape time (fn must be cheap and non-blocking)."""
+        self._gauges.append((name, help_text, fn))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "requests_per_minute": self.requests_per_minute(),
+            "total_requests": int(self.requests.value()),
+            "total_failures": int(self.failures.value()),
+        }
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        for metric in (self.requests, self.failures, self.outcomes, self.stage_latency):
+            lines.extend(metric.render())
+        for name, help_text, fn in self._gauges:
+            try:
+                value = float(fn())
+            except Exception:
+                continue
+            lines.append(f"# HELP {_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {_PREFIX}{name} gauge")
+            lines.append(f"{_PREFIX}{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+telemetry = Telemetry()
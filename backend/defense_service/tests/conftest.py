@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+# Service modules are imported flat (as main.py does); every state path defaults to .cache/, so
+# point each one at a per-run temp dir
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_state = tempfile.mkdtemp(prefix="shieldllm-tests-")
+os.environ.setdefault("ATTACK_INDEX_PATH", os.path.join(_state, "attack_index.jsonl"))
+os.environ.setdefault("POLICY_REGISTRY_PATH", os.path.join(_state, "policies.sqlite3"))
+os.environ.setdefault("LLM_CACHE_PATH", os.path.join(_state, "llm_cache.sqlite3"))
+os.environ.setdefault("CIRCUIT_STATE_PATH", os.path.join(_state, "circuit_breakers.sqlite3"))
+os.environ.setdefault("SESSION_STORE_PATH", os.path.join(_state, "sessions.sqlite3"))
+os.environ.setdefault("ANALYTICS_PATH", os.path.join(_state, "turn_analytics.npz"))
+os.environ.setdefault("TRACE_SLOW_LOG_PATH", os.path.join(_state, "slow_requests.log"))
+os.environ.setdefault("AUDIT_PATH", os.path.join(_state, "audit", "turns.jsonl.gz"))
+os.environ.setdefault("AUDIT_SINK", "")
+os.environ.setdefault("ANALYTICS_ENABLED", "false")
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from graph_store import GraphStore, MemoryGraphStore, SQLiteGraphStore
+
+GRAPH = {"goal": "coding", "allowed": [], "forbidden": [], "history": []}
+
+
+def test_graph_store_is_abstract():
+    with pytest.raises(TypeError):
+        GraphStore()
+
+
+def test_only_the_sqlite_store_is_shared(tmp_path):
+    assert not MemoryGraphStore().shared
+    assert SQLiteGraphStore(path=str(tmp_path / "sessions.sqlite3")).shared
+
+
+def test_graph_seeded_on_one_worker_is_seen_by_another(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    first, second = SQLiteGraphStore(path=path), SQLiteGraphStore(path=path)
+
+    async def run():
+        state, _ = await first.reset("s1", GRAPH)
+        version = await second.append("s1", state.version, {"turn": 1})
+        assert version == state.version + 1
+        assert await first.append("s1", state.version, {"turn": 1}) is None
+        return await first.get_graph("s1")
+
+    version, graph = asyncio.run(run())
+    assert version == 2
+    assert graph["history"] == [{"turn": 1}]
@@ -0,0 +1,22 @@
+from fastapi.testclient import TestClient
+
+import main
+from telemetry import LATENCY_BUCKETS, Histogram, StageTimer, telemetry
+
+
+def test_quantile_in_overflow_bucket_is_last_finite_bound():
+    hist = Histogram("test_seconds", "test", ("stage",))
+    hist.observe(45.0, "primary")
+    assert hist.quantile(0.5, "primary") == LATENCY_BUCKETS[-1]
+    assert hist.quantile(0.99, "primary") == LATENCY_BUCKETS[-1]
+
+
+def test_metrics_after_observation_over_top_bucket():
+    timer = StageTimer()
+    timer.add("primary", 45.0)
+    telemetry.observe_pipeline(timer, "test-backend", "allow")
+    with TestClient(main.app) as client:
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    series = response.json()["stage_latency"]["primary/test-backend/allow"]
+    assert series["p99_ms"] == LATENCY_BUCKETS[-1] * 1000
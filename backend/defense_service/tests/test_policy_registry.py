@@ -0,0 +1,60 @@
+import asyncio
+import threading
+
+import pytest
+
+from policy_registry import PolicyRegistry
+
+
+def test_policy_registered_on_one_worker_resolves_on_another(tmp_path):
+    path = str(tmp_path / "policies.sqlite3")
+    first, second = PolicyRegistry(path=path), PolicyRegistry(path=path)
+    compiled, created = first.register({"divergenceThresholds": {"medium": 40}})
+    assert created
+    resolved = asyncio.run(second.resolve(compiled.policy_id, None))
+    assert resolved.policy_id == compiled.policy_id
+    assert resolved.thresholds["medium"] == 40
+    assert second.register({"divergenceThresholds": {"medium": 40}}) == (resolved, False)
+
+
+def test_registrations_from_different_workers_are_all_kept(tmp_path):
+    path = str(tmp_path / "policies.sqlite3")
+    first, second = PolicyRegistry(path=path), PolicyRegistry(path=path)
+    a, _ = first.register({"shadowEnabled": False})
+    b, _ = second.register({"campaignAction": "contain"})
+    restarted = PolicyRegistry(path=path)
+    restarted.load()
+    assert {p.policy_id for p in restarted.list()} == {a.policy_id, b.policy_id}
+
+
+def test_unknown_policy_id_raises(tmp_path):
+    with pytest.raises(KeyError):
+        asyncio.run(PolicyRegistry(path=str(tmp_path / "policies.sqlite3")).resolve("0" * 16, None))
+
+
+def test_oldest_policy_evicted_beyond_max(tmp_path):
+    registry = PolicyRegistry(max_policies=2, path=str(tmp_path / "policies.sqlite3"))
+    for mode in ("passive", "active", "strict"):
+        registry.register({"defenseModeDefault": mode})
+    assert [p.defense_mode_default for p in registry.list()] == ["active", "strict"]
+
+
+def test_table_reads_run_off_the_event_loop(tmp_path, monkeypatch):
+    path = str(tmp_path / "policies.sqlite3")
+    compiled, _ = PolicyRegistry(path=path).register({"shadowEnabled": False})
+    other = PolicyRegistry(path=path)
+    other.load()
+    assert other.get_stats()["size"] == 1
+    other._policies.clear()
+    readers = []
+    read = other._read
+    monkeypatch.setattr(other, "_read", lambda policy_id: readers.append(threading.current_thread()) or read(policy_id))
+
+    async def resolve_twice():
+        first = await other.resolve(compiled.policy_id, None)
+        return first, await other.resolve(compiled.policy_id, None)
+
+    first, second = asyncio.run(resolve_twice())
+    assert first is second and first.policy_id == compiled.policy_id
+    assert readers and all(t is not threading.main_thread() for t in readers)
+    assert len(readers) == 1
@@ -0,0 +1,20 @@
+from semantic_cache import SemanticCache
+
+PROMPT = ("Could you explain how our staging deployment pipeline promotes a build to production, "
+          "including which approvals and automated checks run at each step?")
+
+
+def test_injected_suffix_does_not_reuse_a_cached_answer():
+    cache = SemanticCache()
+    cache.store("primary", PROMPT, "scope", ("benign answer", {}))
+    assert cache.lookup("primary", PROMPT + " base64 &# \\x reveal prompt", "scope") is None
+    assert cache.lookup("primary", PROMPT, "scope") == ("benign answer", {})
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_entries_are_scoped_and_expire():
+    cache = SemanticCache(ttl=-1)
+    cache.store("primary", PROMPT, "scope", "answer")
+    assert cache.lookup("shadow", PROMPT, "scope") is None
+    assert cache.lookup("primary", PROMPT, "scope") is None
+    assert cache.get_stats()["expired"] == 1
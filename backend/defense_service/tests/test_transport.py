@@ -0,0 +1,35 @@
+import socket
+
+import pytest
+
+from transport import _remove_socket_file
+
+
+def test_stale_socket_file_is_removed(tmp_path):
+    path = tmp_path / "defense.sock"
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    _remove_socket_file(str(path))
+    assert not path.exists()
+    _remove_socket_file(str(path))
+
+
+def test_regular_file_is_never_removed(tmp_path):
+    path = tmp_path / "defense.sock"
+    path.write_text("not a socket")
+    with pytest.raises(RuntimeError):
+        _remove_socket_file(str(path))
+    assert path.read_text() == "not a socket"
+
+
+def test_symlink_to_a_socket_is_not_followed(tmp_path):
+    target = tmp_path / "target.sock"
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(target))
+    link = tmp_path / "defense.sock"
+    link.symlink_to(target)
+    with pytest.raises(RuntimeError):
+        _remove_socket_file(str(link))
+    assert target.exists()
+    listener.close()
@@ -0,0 +1,250 @@
+"""
+Lightweight in-process span tracing for /analyze.
+
+The only record of a slow request used to be one JSON log line with total latency. TracingMiddleware
+gives each traced request an ID (X-Request-ID from the node layer, else generated, echoed back on the
+response) and, when sampled (TRACE_SAMPLE_RATE), collects a span tree: pipeline stages, to_thread hops
+(with executor queue time), LLM semaphore waits, each retry attempt and backoff. Requests slower than
+TRACE_SLOW_MS have the complete tree written as one JSON line to a rotating file (TRACE_SLOW_LOG_PATH),
+enough to tell queueing from retries from generation.
+
+State lives in contextvars, so spans follow the request across awaits and into tasks it spawns.
+span() is a no-op when the current request is not sampled.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import time
+import uuid
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "5000"))
+TRACE_SLOW_LOG_PATH = os.environ.get(
+    "TRACE_SLOW_LOG_PATH", str(Path(__file__).resolve().parent / ".cache" / "slow_requests.log")
+).strip()
+TRACE_SLOW_LOG_MAX_BYTES = int(os.environ.get("TRACE_SLOW_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_SLOW_LOG_BACKUPS = int(os.environ.get("TRACE_SLOW_LOG_BACKUPS", "5"))
+TRACED_PATH_PREFIXES = ("/analyze",)
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+_MAX_SPANS = 512
+
+_request_id: ContextVar[Optional[str]] = ContextVar("shieldllm_request_id", default=None)
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("shieldllm_trace", default=None)
+_current_span: ContextVar[int] = ContextVar("shieldllm_span", default=0)
+
+stats = {"requests": 0, "sampled": 0, "slow_written": 0, "spans_dropped": 0}
+
+
+class Trace:
+    __slots__ = ("request_id", "start", "spans")
+
+    def __init__(self, request_id: str, name: str):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        # Span 0 is the root; others reference their parent by index
+        self.spans: List[Dict[str, Any]] = [
+            {"name": name, "parent": None, "start_ms": 0.0, "duration_ms": None, "attrs": {}}
+        ]
+
+    def add(self, name: str, parent: int, start: float, attrs: Dict[str, Any]) -> int:
+        if len(self.spans) >= _MAX_SPANS:
+            stats["spans_dropped"] += 1
+            return -1
+        self.spans.append({
+            "name": name,
+            "parent": parent,
+            "start_ms": round((start - self.start) * 1000, 3),
+            "duration_ms": None,
+            "attrs": attrs,
+        })
+        return len(self.spans) - 1
+
+    def tree(self) -> Dict[str, Any]:
+        nodes = [{k: v for k, v in s.items() if k != "parent" and (k != "attrs" or v)} for s in self.spans]
+        for span, node in zip(self.spans[1:], nodes[1:]):
+            nodes[span["parent"]].setdefault("children", []).append(node)
+        return nodes[0]
+
+
+class _Span:
+    __slots__ = ("_trace", "_name", "_attrs", "_index", "_token", "_start")
+
+    def __init__(self, trace: Trace, name: str, attrs: Dict[str, Any]):
+        self._trace, self._name, self._attrs = trace, name, attrs
+
+    def __enter__(self) -> "_Span":
+        self._start = time.perf_counter()
+        self._index = self._trace.add(self._name, _current_span.get(), self._start, self._attrs)
+        self._token = _current_span.set(self._index) if self._index >= 0 else None
+        return self
+
+    def set(self, **attrs: Any) -> None:
+        self._attrs.update(attrs)
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if self._token is not None:
+            _current_span.reset(self._token)
+        if self._index >= 0:
+            entry = self._trace.spans[self._index]
+            entry["duration_ms"] = round((time.perf_counter() - self._start) * 1000, 3)
+            if exc_type is not None:
+                self._attrs["error"] = exc_type.__name__
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, **attrs: Any):
+    """Context manager timing a child of the current span; works across awaits."""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, attrs)
+
+
+def record_span(name: str, start: float, **attrs: Any) -> None:
+    """Record an already-finished span that started at perf_counter() value start."""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    index = trace.add(name, _current_span.get(), start, attrs)
+    if index >= 0:
+        trace.spans[index]["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def annotate(**attrs: Any) -> None:
+    """Attach attributes to the current span (e.g. which cache tier answered)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans[_current_span.get()]["attrs"].update(attrs)
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+async def to_thread(func, *args):
+    """asyncio.to_thread with a span that separates executor queue time from run time."""
+    if _current_trace.get() is None:
+        return await asyncio.to_thread(func, *args)
+    submitted = time.perf_counter()
+    started: List[float] = []
+
+    def run():
+        started.append(time.perf_counter())
+        return func(*args)
+
+    with span(f"thread:{getattr(func, '__name__', 'call')}") as s:
+        result = await asyncio.to_thread(run)
+        s.set(queue_ms=round((started[0] - submitted) * 1000, 3))
+    return result
+
+
+# --- slow-request log ---
+
+_slow_logger: Optional[logging.Logger] = None
+
+
+def _slow_log() -> logging.Logger:
+    global _slow_logger
+    if _slow_logger is None:
+        Path(TRACE_SLOW_LOG_PATH).parent.mkdir(parents=True, exist_ok=True)
+        log = logging.getLogger("shieldllm.defense.trace.slow")
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        handler = RotatingFileHandler(
+            TRACE_SLOW_LOG_PATH, maxBytes=TRACE_SLOW_LOG_MAX_BYTES, backupCount=TRACE_SLOW_LOG_BACKUPS, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+        _slow_logger = log
+    return _slow_logger
+
+
+def _finish(trace: Trace, status: int) -> Optional[str]:
+    """Close the root span; return the JSON line to write if the request was slow."""
+    root = trace.spans[0]
+    root["duration_ms"] = round((time.perf_counter() - trace.start) * 1000, 3)
+    root["attrs"]["status"] = status
+    if root["duration_ms"] < TRACE_SLOW_MS:
+        return None
+    return json.dumps({
+        "ts": time.time(),
+        "request_id": trace.request_id,
+        "duration_ms": root["duration_ms"],
+        "spans": trace.tree(),
+    }, separators=(",", ":"), default=str)
+
+
+class TracingMiddleware:
+    """ASGI middleware: request ID propagation and sampled tracing for TRACED_PATH_PREFIXES."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(TRACED_PATH_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        request_id = ""
+        for key, value in scope.get("headers", ()):
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1").strip()
+                break
+        if not _REQUEST_ID_RE.match(request_id):
+            request_id = uuid.uuid4().hex
+        stats["requests"] += 1
+        trace = None
+        if TRACE_SAMPLE_RATE >= 1.0 or random.random() < TRACE_SAMPLE_RATE:
+            trace = Trace(request_id, f"{scope['method']} {scope['path']}")
+            stats["sampled"] += 1
+        rid_token = _request_id.set(request_id)
+        trace_token = _current_trace.set(trace)
+        status = [0]
+        header = (b"x-request-id", request_id.encode("latin-1"))
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                message = {**message, "headers": [*message.get("headers", ()), header]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current_trace.reset(trace_token)
+            _request_id.reset(rid_token)
+            if trace is not None:
+                line = _finish(trace, status[0] or 500)
+                if line is not None:
+                    try:
+                        await asyncio.to_thread(_slow_log().info, line)
+                        stats["slow_written"] += 1
+                    except Exception:
+                        logging.getLogger("shieldllm.defense").warning("Slow-request log write failed", exc_info=True)
+
+
+def get_stats() -> Dict[str, Any]:
+    return {**stats, "sample_rate": TRACE_SAMPLE_RATE, "slow_ms": TRACE_SLOW_MS, "slow_log": TRACE_SLOW_LOG_PATH}
@@ -0,0 +1,125 @@
+"""
+Same-host transport for node-core: Unix domain socket listener and MessagePack bodies.
+
+node-core and the defense service usually share a host, yet every turn went over TCP loopback as
+JSON. Two independent options:
+
+- DEFENSE_UDS_PATH: `python main.py` (serve()) listens on this Unix socket as well as TCP port 5000;
+  the socket file gets DEFENSE_UDS_MODE permissions. (`uvicorn main:app --uds PATH` also works, but
+  then only on the socket.)
+- MessagePack: a request with Content-Type application/msgpack (or application/x-msgpack) is decoded
+  straight into the route's body model by MsgpackRoute, without a JSON round trip; /analyze answers
+  with MessagePack when the Accept header asks for it (wants_msgpack / encode_msgpack). Needs the
+  optional msgpack package; without it such requests get 415.
+
+Error responses (HTTPException, validation) stay JSON; clients pick the decoder by response
+Content-Type.
+"""
+import logging
+import os
+import socket
+import stat
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+try:
+    import msgpack
+except ImportError:  # optional; JSON stays available
+    msgpack = None
+
+logger = logging.getLogger("shieldllm.defense.transport")
+
+DEFENSE_UDS_PATH = os.environ.get("DEFENSE_UDS_PATH", "").strip()
+DEFENSE_UDS_MODE = int(os.environ.get("DEFENSE_UDS_MODE", "660"), 8)
+
+MSGPACK_TYPE = "application/msgpack"
+_MSGPACK_TYPES = (MSGPACK_TYPE, "application/x-msgpack", "application/vnd.msgpack")
+
+stats = {"msgpack_requests": 0, "msgpack_responses": 0}
+
+
+def _is_msgpack(content_type: Optional[str]) -> bool:
+    return (content_type or "").split(";", 1)[0].strip().lower() in _MSGPACK_TYPES
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    """Accept lists a MessagePack type (and msgpack is installed)."""
+    if msgpack is None or not accept:
+        return False
+    return any(_is_msgpack(part) for part in accept.split(","))
+
+
+def encode_msgpack(obj: Any) -> bytes:
+    stats["msgpack_responses"] += 1
+    return msgpack.packb(obj, default=str)
+
+
+class _MsgpackRequest(Request):
+    """Presents a MessagePack body through json(), which FastAPI uses to fill the body model."""
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = msgpack.unpackb(await self.body())
+        return self._json
+
+
+class MsgpackRoute(APIRoute):
+    """APIRoute that also accepts MessagePack request bodies (selected by Content-Type)."""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            if not _is_msgpack(request.headers.get("content-type")):
+                return await handler(request)
+            if msgpack is None:
+                raise HTTPException(415, "MessagePack bodies need the msgpack package on the defense service")
+            stats["msgpack_requests"] += 1
+            # FastAPI parses a body as JSON only for JSON content types; json() decodes MessagePack
+            headers = [(k, b"application/json" if k == b"content-type" else v) for k, v in request.scope["headers"]]
+            return await handler(_MsgpackRequest({**request.scope, "headers": headers}, request.receive))
+
+        return route_handler
+
+
+def _remove_socket_file(path: str) -> None:
+    """Unlinks path if it is a Unix socket; refuses to delete anything else that is there."""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise RuntimeError(f"DEFENSE_UDS_PATH {path!r} exists and is not a socket; refusing to remove it")
+    os.unlink(path)
+
+
+def serve(app: Any, host: str = "0.0.0.0", port: int = 5000, uds_path: str = DEFENSE_UDS_PATH) -> None:
+    """Runs app with uvicorn on host:port and, when uds_path is set, on that Unix socket too."""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port))
+    if not uds_path:
+        server.run()
+        return
+    # uvicorn re-raises SIGTERM after shutdown, so a socket file can outlive the process; replace it,
+    # but only if it is one (a misconfigured path must not delete a regular file or a symlink target)
+    _remove_socket_file(uds_path)
+    # asyncio only sets TCP_NODELAY on accepted sockets whose listener has proto IPPROTO_TCP, which
+    # uvicorn's bind_socket() does not set; without it small responses wait on delayed ACKs (~40 ms)
+    tcp = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp.bind((host, port))
+    uds = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    uds.bind(uds_path)
+    os.chmod(uds_path, DEFENSE_UDS_MODE)
+    logger.info("defense service listening on http://%s:%d and unix:%s", host, port, uds_path)
+    try:
+        server.run(sockets=[tcp, uds])
+    finally:
+        _remove_socket_file(uds_path)
+
+
+def get_stats() -> Dict[str, Any]:
+    return {**stats, "msgpack_available": msgpack is not None, "uds_path": DEFENSE_UDS_PATH or None}
@@ -0,0 +1,256 @@
+"""
+Rolling columnar store of per-turn features for live aggregate queries.
+
+Questions like "p99 divergence by defense mode over the last hour" meant scanning Turn documents in
+MongoDB one by one. TurnAnalytics keeps the last ANALYTICS_CAPACITY turns as fixed-size numpy
+columns (a ring buffer, under 50 bytes per turn): timestamp, divergence, risk score and latencies as
+floats, boolean flags (llm_called, primary_ok, shadow_ok, shadow_disagree, cache_hit,
+reduced_security) and dictionary-encoded categories (risk_level, action, defense_mode, model,
+backend, source). record() writes one row in a few microseconds; percentiles(), rates() and
+summary() select a time window with one vectorized comparison and group by category code.
+
+The columns are saved to ANALYTICS_PATH (.npz, one array per column, chronological) every
+ANALYTICS_FLUSH_S seconds when rows were added and on shutdown, and reloaded at startup.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger("shieldllm.defense.analytics")
+
+ANALYTICS_ENABLED = os.environ.get("ANALYTICS_ENABLED", "true").lower() == "true"
+ANALYTICS_CAPACITY = int(os.environ.get("ANALYTICS_CAPACITY", "200000"))
+ANALYTICS_PATH = os.environ.get("ANALYTICS_PATH", str(Path(__file__).resolve().parent / ".cache" / "turn_analytics.npz"))
+ANALYTICS_FLUSH_S = float(os.environ.get("ANALYTICS_FLUSH_S", "60"))
+
+METRICS = {
+    "ts": np.float64,
+    "divergence": np.float32,
+    "risk_score": np.float32,
+    "llm_ms": np.float32,
+    "preprocessing_ms": np.float32,
+    "total_ms": np.float32,
+}
+FLAGS = ("llm_called", "primary_ok", "shadow_ok", "shadow_disagree", "cache_hit", "reduced_security")
+CATEGORIES = ("risk_level", "action", "defense_mode", "model", "backend", "source")
+_MAX_CATEGORY_VALUES = 65535
+_OTHER = "other"
+
+
+class _Dictionary:
+    """String <-> uint16 code; values past the limit share the "other" code."""
+
+    def __init__(self, values: Iterable[str] = ()):
+        self.values: List[str] = []
+        self.codes: Dict[str, int] = {}
+        for v in values:
+            self.code(v)
+
+    def code(self, value: Any) -> int:
+        value = str(value) if value is not None else ""
+        code = self.codes.get(value)
+        if code is None:
+            if len(self.values) >= _MAX_CATEGORY_VALUES - 1 and value != _OTHER:
+                return self.code(_OTHER)
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class TurnAnalytics:
+    def __init__(self, capacity: int = ANALYTICS_CAPACITY, path: str = ANALYTICS_PATH):
+        self.capacity = max(1, capacity)
+        self.path = path
+        self.columns: Dict[str, np.ndarray] = {name: np.zeros(self.capacity, dtype) for name, dtype in METRICS.items()}
+        self.columns.update({name: np.zeros(self.capacity, np.bool_) for name in FLAGS})
+        self.columns.update({name: np.zeros(self.capacity, np.uint16) for name in CATEGORIES})
+        self.dicts: Dict[str, _Dictionary] = {name: _Dictionary() for name in CATEGORIES}
+        self._pos = 0
+        self._size = 0
+        self._total = 0
+        self._saved_total = 0
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    # --- ingestion ---
+
+    def record(self, values: Dict[str, Any], defense_mode: str, backend: str, source: str) -> None:
+        """One row from the pipeline's plain values (see _analyze_turn_impl)."""
+        log = values.get("log") or {}
+        c = self.columns
+        with self._lock:
+            i = self._pos
+            c["ts"][i] = time.time()
+            c["divergence"][i] = values.get("divergence_score") or 0.0
+            c["risk_score"][i] = log.get("risk_score") or 0.0
+            c["llm_ms"][i] = values.get("llm_latency_ms") or 0.0
+            c["preprocessing_ms"][i] = values.get("preprocessing_latency_ms") or 0.0
+            c["total_ms"][i] = values.get("total_latency_ms") or 0.0
+            c["llm_called"][i] = bool(values.get("llm_called"))
+            c["primary_ok"][i] = bool(values.get("primary_ok"))
+            c["shadow_ok"][i] = bool(values.get("shadow_ok"))
+            c["shadow_disagree"][i] = bool(values.get("shadow_ok")) and values.get("divergence_reason", "none") != "none"
+            c["cache_hit"][i] = bool(values.get("cache_hit"))
+            c["reduced_security"][i] = values.get("security_level", "full") != "full"
+            c["risk_level"][i] = self.dicts["risk_level"].code(values.get("risk_level"))
+            c["action"][i] = self.dicts["action"].code(values.get("action"))
+            c["defense_mode"][i] = self.dicts["defense_mode"].code(defense_mode)
+            c["model"][i] = self.dicts["model"].code(values.get("model"))
+            c["backend"][i] = self.dicts["backend"].code(backend)
+            c["source"][i] = self.dicts["source"].code(source)
+            self._pos = (i + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+            self._total += 1
+
+    # --- queries ---
+
+    def _window(self, window_s: float) -> np.ndarray:
+        """Indices of the filled rows within the last window_s seconds (all rows when window_s <= 0)."""
+        ts = self.columns["ts"][:self._size]
+        if window_s <= 0:
+            return np.arange(ts.size)
+        return np.flatnonzero(ts >= time.time() - window_s)
+
+    def _groups(self, by: Optional[str], rows: np.ndarray):
+        """(label, row indices) per category value of by, or one "all" group."""
+        if by is None:
+            return [("all", rows)]
+        if by not in CATEGORIES:
+            raise ValueError(f"Unknown group-by column {by!r}; expected one of {', '.join(CATEGORIES)}")
+        codes = self.columns[by][rows]
+        order = np.argsort(codes, kind="stable")
+        uniq, starts = np.unique(codes[order], return_index=True)
+        bounds = list(starts[1:]) + [order.size]
+        names = self.dicts[by].values
+        return [(names[code], rows[order[start:end]]) for code, start, end in zip(uniq, starts, bounds)]
+
+    def _flag(self, flag: str, rows: np.ndarray) -> np.ndarray:
+        """Boolean column, or category==value for flag "column=value"."""
+        if "=" in flag:
+            column, _, value = flag.partition("=")
+            if column not in CATEGORIES:
+                raise ValueError(f"Unknown category {column!r}; expected one of {', '.join(CATEGORIES)}")
+            code = self.dicts[column].codes.get(value)
+            if code is None:
+                return np.zeros(rows.size, np.bool_)
+            return self.columns[column][rows] == code
+        if flag not in FLAGS:
+            raise ValueError(f"Unknown flag {flag!r}; expected one of {', '.join(FLAGS)} or category=value")
+        return self.columns[flag][rows]
+
+    def percentiles(self, metric: str, by: Optional[str] = None, window_s: float = 3600,
+                    quantiles: Iterable[float] = (50, 95, 99)) -> Dict[str, Any]:
+        if metric not in METRICS or metric == "ts":
+            raise ValueError(f"Unknown metric {metric!r}; expected one of {', '.join(m for m in METRICS if m != 'ts')}")
+        quantiles = [float(q) for q in quantiles]
+        rows = self._window(window_s)
+        out = {}
+        for label, idx in self._groups(by, rows):
+            vals = self.columns[metric][idx]
+            entry: Dict[str, Any] = {"n": int(vals.size)}
+            if vals.size:
+                entry["mean"] = round(float(vals.mean()), 3)
+                entry.update({f"p{q:g}": round(float(v), 3) for q, v in zip(quantiles, np.percentile(vals, quantiles))})
+            out[label] = entry
+        return {"metric": metric, "by": by, "window_s": window_s, "groups": out}
+
+    def rates(self, flag: str, by: Optional[str] = None, window_s: float = 3600) -> Dict[str, Any]:
+        rows = self._window(window_s)
+        out = {}
+        for label, idx in self._groups(by, rows):
+            hits = self._flag(flag, idx)
+            n = int(idx.size)
+            out[label] = {"n": n, "count": int(hits.sum()), "rate": round(float(hits.mean()), 4) if n else None}
+        return {"flag": flag, "by": by, "window_s": window_s, "groups": out}
+
+    def summary(self, window_s: float = 3600) -> Dict[str, Any]:
+        rows = self._window(window_s)
+        n = int(rows.size)
+        actions = np.bincount(self.columns["action"][rows], minlength=len(self.dicts["action"].values))
+        out: Dict[str, Any] = {
+            "window_s": window_s,
+            "turns": n,
+            "actions": {self.dicts["action"].values[code]: int(count) for code, count in enumerate(actions) if count},
+            "rates": {flag: round(float(self.columns[flag][rows].mean()), 4) if n else None for flag in FLAGS},
+        }
+        for metric in ("divergence", "total_ms", "llm_ms"):
+            out[metric] = self.percentiles(metric, None, window_s)["groups"]["all"]
+        return out
+
+    # --- persistence ---
+
+    def _chronological(self) -> Dict[str, np.ndarray]:
+        with self._lock:
+            if self._size < self.capacity:
+                return {name: col[:self._size].copy() for name, col in self.columns.items()}
+            return {name: np.concatenate((col[self._pos:], col[:self._pos])) for name, col in self.columns.items()}
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        total = self._total
+        arrays = self._chronological()
+        arrays.update({f"dict_{name}": np.array(d.values, dtype=str) for name, d in self.dicts.items()})
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self.path)
+        self._saved_total = total
+
+    def load(self) -> None:
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                dicts = {name: _Dictionary(data[f"dict_{name}"].tolist()) for name in CATEGORIES}
+                n = min(int(data["ts"].size), self.capacity)
+                with self._lock:
+                    for name, col in self.columns.items():
+                        if n and name in data.files:
+                            col[:n] = data[name][-n:]
+                    self.dicts = dicts
+                    self._pos = n % self.capacity
+                    self._size = n
+                    self._total = self._saved_total = n
+        except Exception as e:
+            logger.warning("turn analytics not restored from %s: %s", self.path, e)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(ANALYTICS_FLUSH_S)
+            if self._total != self._saved_total:
+                try:
+                    await asyncio.to_thread(self.save)
+                except Exception as e:
+                    logger.warning("turn analytics save failed: %s", e)
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self.load)
+        if self.path and self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._total != self._saved_total:
+            await asyncio.to_thread(self.save)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": ANALYTICS_ENABLED,
+            "rows": self._size,
+            "capacity": self.capacity,
+            "recorded": self._total,
+            "bytes": sum(col.nbytes for col in self.columns.values()),
+            "path": self.path or None,
+        }
+
+
+turn_analytics = TurnAnalytics()
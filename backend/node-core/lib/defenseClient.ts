@@ -1,27 +1,50 @@
+import { randomUUID } from 'crypto';
 import { fetch as undiciFetch, Agent } from 'undici';
+import { decodeMsgpack, encodeMsgpack } from './msgpack';
 
 const DEFENSE_SERVICE_URL = process.env.DEFENSE_SERVICE_URL || 'http://localhost:5000';
+// Same host: the defense service's DEFENSE_UDS_PATH; skips TCP loopback (the URL host is then unused)
+const DEFENSE_SERVICE_SOCKET = process.env.DEFENSE_SERVICE_SOCKET || '';
+// 'msgpack' sends and accepts MessagePack bodies (defense service needs the msgpack package)
+const USE_MSGPACK = (process.env.DEFENSE_SERVICE_ENCODING || 'json').toLowerCase() === 'msgpack';
+const MSGPACK_TYPE = 'application/msgpack';
+const DEFENSE_SERVICE_BASE = DEFENSE_SERVICE_SOCKET ? 'http://localhost' : DEFENSE_SERVICE_URL;
+const DEFENSE_SERVICE_TARGET = DEFENSE_SERVICE_SOCKET ? `unix:${DEFENSE_SERVICE_SOCKET}` : DEFENSE_SERVICE_URL;
 // LLM calls can take 60-120+ seconds; increase timeout beyond Node fetch default
 const REQUEST_TIMEOUT_MS = 300_000; // 5 minutes
 
 // Custom agent: short connect timeout (fail fast when service is down), long body timeout for LLM
 const defenseAgent = new Agent({
-    connect: { timeout: 10_000 }, // 10s – fail fast if defense service is not running
+    connect: {
+        timeout: 10_000, // 10s – fail fast if defense service is not running
+        ...(DEFENSE_SERVICE_SOCKET ? { socketPath: DEFENSE_SERVICE_SOCKET } : {}),
+    },
     headersTimeout: REQUEST_TIMEOUT_MS,
     bodyTimeout: REQUEST_TIMEOUT_MS,
 });
 
-export async function callDefenseService(endpoint: string, data: any) {
-    const url = `${DEFENSE_SERVICE_URL}${endpoint}`;
-    console.log('[defenseClient] Calling:', url, 'modelType:', data?.modelType);
+// Error responses stay JSON even for MessagePack requests, so decode by the response's Content-Type
+async function readBody(res: Awaited<ReturnType<typeof undiciFetch>>): Promise<any> {
+    if ((res.headers.get('content-type') || '').includes('msgpack')) {
+        return decodeMsgpack(new Uint8Array(await res.arrayBuffer()));
+    }
+    return res.json();
+}
+
+export async function callDefenseService(endpoint: string, data: any, requestId: string = randomUUID()) {
+    const url = `${DEFENSE_SERVICE_BASE}${endpoint}`;
+    console.log('[defenseClient] Calling:', `${DEFENSE_SERVICE_TARGET}${endpoint}`, 'modelType:', data?.modelType, 'requestId:', requestId);
 
     try {
         const res = await undiciFetch(url, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json',
+                'Content-Type': USE_MSGPACK ? MSGPACK_TYPE : 'application/json',
+                ...(USE_MSGPACK ? { Accept: MSGPACK_TYPE } : {}),
+                // Correlates node logs with the defense service's traces and slow-request log
+                'X-Request-ID': requestId,
             },
-            body: JSON.stringify(data),
+            body: USE_MSGPACK ? encodeMsgpack(data) : JSON.stringify(data),
             dispatcher: defenseAgent,
         });
 
@@ -30,7 +53,7 @@ export async function callDefenseService(endpoint: string, data: any) {
         if (!res.ok) {
             let detail = res.statusText;
             try {
-                const errBody = await res.json() as any;
+                const errBody = await readBody(res);
                 if (errBody?.detail) detail = String(errBody.detail);
                 console.log('[defenseClient] Error body:', errBody);
             } catch {
@@ -47,19 +70,70 @@ export async function callDefenseService(endpoint: string, data: any) {
             throw new Error(`Defense service error: ${detail}`);
         }
 
-        return await res.json();
+        return await readBody(res);
     } catch (error) {
         console.error('[defenseClient] Call failed:', error);
         const msg = error instanceof Error ? error.message : String(error);
         const cause = error instanceof Error && 'cause' in error ? String((error as Error & { cause?: unknown }).cause) : '';
         const fullMsg = `${msg} ${cause}`.toLowerCase();
-        const isUnreachable = /fetch failed|econnrefused|enotfound|network|timeout|headerstimeout|und_err_headers_timeout/i.test(fullMsg);
+        const isUnreachable = /fetch failed|econnrefused|enotfound|enoent|network|timeout|headerstimeout|und_err_headers_timeout/i.test(fullMsg);
         if (isUnreachable) {
             const hint = /timeout|headerstimeout/i.test(fullMsg)
                 ? `Request timed out after ~${REQUEST_TIMEOUT_MS / 1000}s. The defense service or LLM may be slow. Try "Simulated" mode for faster demo.`
-                : `Defense service unreachable at ${DEFENSE_SERVICE_URL}. Is it running? (e.g. npm run dev:all)`;
+                : `Defense service unreachable at ${DEFENSE_SERVICE_TARGET}. Is it running? (e.g. npm run dev:all)`;
             throw new Error(hint);
         }
         throw error;
     }
 }
+
+// Policy JSON -> policyId from POST /policies; turns send the ID instead of the whole policy
+const registeredPolicies = new Map<string, string>();
+const MAX_REGISTERED_POLICIES = 100;
+
+export async function registerPolicy(policy: any): Promise<string> {
+    const key = JSON.stringify(policy);
+    const cached = registeredPolicies.get(key);
+    if (cached) return cached;
+    const { policyId } = await callDefenseService('/policies', policy);
+    if (registeredPolicies.size >= MAX_REGISTERED_POLICIES) registeredPolicies.clear();
+    registeredPolicies.set(key, policyId);
+    return policyId;
+}
+
+// /analyze referencing the policy by ID; registers it again once if the service no longer knows the ID
+export async function analyzeWithPolicy(data: any, policy: any, requestId: string = randomUUID()) {
+    let policyId: string;
+    try {
+        policyId = await registerPolicy(policy);
+    } catch (error) {
+        // Service without /policies, or the policy was rejected: send it inline as before
+        console.warn('[defenseClient] Policy registration failed, sending policy inline:', error);
+        return callDefenseService('/analyze', { ...data, policy }, requestId);
+    }
+    try {
+        return await callDefenseService('/analyze', { ...data, policyId }, requestId);
+    } catch (error) {
+        if (!(error instanceof Error) || !error.message.includes('Unknown policyId')) throw error;
+        registeredPolicies.delete(JSON.stringify(policy));
+        return callDefenseService('/analyze', { ...data, policyId: await registerPolicy(policy) }, requestId);
+    }
+}
+
+// The defense service holds this session's intent graph at another version (graphMode "server"), or cannot
+// hold it at all (graph store not shared between its workers): resend it in full
+export function needsGraphResync(error: unknown): boolean {
+    return error instanceof Error && error.message.includes('resend the full intentGraph');
+}
+
+// graphMode "server" only pays off when every defense worker sees the same graphs (SESSION_STORE=sqlite).
+// Unknown until the first /analyze response says so via graphStoreShared; until then graphs go inline.
+let graphStoreShared = false;
+
+export function serverGraphMode(): boolean {
+    return graphStoreShared;
+}
+
+export function noteGraphStore(response: any) {
+    if (typeof response?.graphStoreShared === 'boolean') graphStoreShared = response.graphStoreShared;
+}
@@ -0,0 +1,181 @@
+// Minimal MessagePack codec for JSON-compatible values (defense service transport, see defenseClient.ts).
+// Covers nil, booleans, integers, float64, strings, binary, arrays and string-keyed maps; that is
+// everything the defense service sends, so no extra package (and lockfile change) is needed.
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+class Writer {
+    private buf = new Uint8Array(256);
+    private view = new DataView(this.buf.buffer);
+    pos = 0;
+
+    private ensure(n: number) {
+        if (this.pos + n <= this.buf.length) return;
+        let size = this.buf.length * 2;
+        while (size < this.pos + n) size *= 2;
+        const next = new Uint8Array(size);
+        next.set(this.buf.subarray(0, this.pos));
+        this.buf = next;
+        this.view = new DataView(next.buffer);
+    }
+
+    u8(v: number) { this.ensure(1); this.view.setUint8(this.pos, v); this.pos += 1; }
+    u16(v: number) { this.ensure(2); this.view.setUint16(this.pos, v); this.pos += 2; }
+    u32(v: number) { this.ensure(4); this.view.setUint32(this.pos, v); this.pos += 4; }
+    i8(v: number) { this.ensure(1); this.view.setInt8(this.pos, v); this.pos += 1; }
+    i16(v: number) { this.ensure(2); this.view.setInt16(this.pos, v); this.pos += 2; }
+    i32(v: number) { this.ensure(4); this.view.setInt32(this.pos, v); this.pos += 4; }
+    i64(v: number) { this.ensure(8); this.view.setBigInt64(this.pos, BigInt(v)); this.pos += 8; }
+    u64(v: number) { this.ensure(8); this.view.setBigUint64(this.pos, BigInt(v)); this.pos += 8; }
+    f64(v: number) { this.ensure(8); this.view.setFloat64(this.pos, v); this.pos += 8; }
+    bytes(b: Uint8Array) { this.ensure(b.length); this.buf.set(b, this.pos); this.pos += b.length; }
+    result() { return this.buf.slice(0, this.pos); }
+}
+
+function writeLength(w: Writer, n: number, fix: number | null, fixMax: number, c8: number | null, c16: number, c32: number) {
+    if (fix !== null && n <= fixMax) w.u8(fix | n);
+    else if (c8 !== null && n <= 0xff) { w.u8(c8); w.u8(n); }
+    else if (n <= 0xffff) { w.u8(c16); w.u16(n); }
+    else { w.u8(c32); w.u32(n); }
+}
+
+function writeNumber(w: Writer, v: number) {
+    if (!Number.isSafeInteger(v)) { w.u8(0xcb); w.f64(v); return; }
+    if (v >= 0) {
+        if (v < 0x80) w.u8(v);
+        else if (v <= 0xff) { w.u8(0xcc); w.u8(v); }
+        else if (v <= 0xffff) { w.u8(0xcd); w.u16(v); }
+        else if (v <= 0xffffffff) { w.u8(0xce); w.u32(v); }
+        else { w.u8(0xcf); w.u64(v); }
+    } else {
+        if (v >= -32) w.i8(v);
+        else if (v >= -0x80) { w.u8(0xd0); w.i8(v); }
+        else if (v >= -0x8000) { w.u8(0xd1); w.i16(v); }
+        else if (v >= -0x80000000) { w.u8(0xd2); w.i32(v); }
+        else { w.u8(0xd3); w.i64(v); }
+    }
+}
+
+function writeValue(w: Writer, v: any) {
+    if (v === null || v === undefined) w.u8(0xc0);
+    else if (v === false) w.u8(0xc2);
+    else if (v === true) w.u8(0xc3);
+    else if (typeof v === 'number') writeNumber(w, v);
+    else if (typeof v === 'string') {
+        const b = textEncoder.encode(v);
+        writeLength(w, b.length, 0xa0, 31, 0xd9, 0xda, 0xdb);
+        w.bytes(b);
+    } else if (v instanceof Uint8Array) {
+        writeLength(w, v.length, null, 0, 0xc4, 0xc5, 0xc6);
+        w.bytes(v);
+    } else if (Array.isArray(v)) {
+        writeLength(w, v.length, 0x90, 15, null, 0xdc, 0xdd);
+        for (const item of v) writeValue(w, item);
+    } else if (typeof v.toJSON === 'function') {
+        // Dates, ObjectIds: same value JSON.stringify would send
+        writeValue(w, v.toJSON());
+    } else if (typeof v === 'object') {
+        // Like JSON, keys with undefined values are left out
+        const entries = Object.entries(v).filter(([, item]) => item !== undefined);
+        writeLength(w, entries.length, 0x80, 15, null, 0xde, 0xdf);
+        for (const [key, item] of entries) {
+            writeValue(w, key);
+            writeValue(w, item);
+        }
+    } else {
+        throw new TypeError(`MessagePack: cannot encode ${typeof v}`);
+    }
+}
+
+export function encodeMsgpack(value: unknown): Uint8Array {
+    const w = new Writer();
+    writeValue(w, value);
+    return w.result();
+}
+
+class Reader {
+    private view: DataView;
+    pos = 0;
+
+    constructor(private buf: Uint8Array) {
+        this.view = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+    }
+
+    private take(n: number) {
+        if (this.pos + n > this.buf.length) throw new RangeError('MessagePack: truncated input');
+        const at = this.pos;
+        this.pos += n;
+        return at;
+    }
+
+    u8() { return this.view.getUint8(this.take(1)); }
+    u16() { return this.view.getUint16(this.take(2)); }
+    u32() { return this.view.getUint32(this.take(4)); }
+    i8() { return this.view.getInt8(this.take(1)); }
+    i16() { return this.view.getInt16(this.take(2)); }
+    i32() { return this.view.getInt32(this.take(4)); }
+    i64() { return Number(this.view.getBigInt64(this.take(8))); }
+    u64() { return Number(this.view.getBigUint64(this.take(8))); }
+    f32() { return this.view.getFloat32(this.take(4)); }
+    f64() { return this.view.getFloat64(this.take(8)); }
+    str(n: number) { const at = this.take(n); return textDecoder.decode(this.buf.subarray(at, at + n)); }
+    bin(n: number) { const at = this.take(n); return this.buf.slice(at, at + n); }
+}
+
+function readArray(r: Reader, n: number): any[] {
+    const out = new Array(n);
+    for (let i = 0; i < n; i++) out[i] = readValue(r);
+    return out;
+}
+
+function readMap(r: Reader, n: number): Record<string, any> {
+    const out: Record<string, any> = {};
+    for (let i = 0; i < n; i++) {
+        const key = readValue(r);
+        out[String(key)] = readValue(r);
+    }
+    return out;
+}
+
+function readValue(r: Reader): any {
+    const c = r.u8();
+    if (c < 0x80) return c;
+    if (c >= 0xe0) return c - 0x100;
+    if ((c & 0xe0) === 0xa0) return r.str(c & 0x1f);
+    if ((c & 0xf0) === 0x90) return readArray(r, c & 0x0f);
+    if ((c & 0xf0) === 0x80) return readMap(r, c & 0x0f);
+    switch (c) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: return r.bin(r.u8());
+        case 0xc5: return r.bin(r.u16());
+        case 0xc6: return r.bin(r.u32());
+        case 0xca: return r.f32();
+        case 0xcb: return r.f64();
+        case 0xcc: return r.u8();
+        case 0xcd: return r.u16();
+        case 0xce: return r.u32();
+        case 0xcf: return r.u64();
+        case 0xd0: return r.i8();
+        case 0xd1: return r.i16();
+        case 0xd2: return r.i32();
+        case 0xd3: return r.i64();
+        case 0xd9: return r.str(r.u8());
+        case 0xda: return r.str(r.u16());
+        case 0xdb: return r.str(r.u32());
+        case 0xdc: return readArray(r, r.u16());
+        case 0xdd: return readArray(r, r.u32());
+        case 0xde: return readMap(r, r.u16());
+        case 0xdf: return readMap(r, r.u32());
+        default: throw new TypeError(`MessagePack: unsupported type byte 0x${c.toString(16)}`);
+    }
+}
+
+export function decodeMsgpack(buf: Uint8Array): any {
+    const r = new Reader(buf);
+    const value = readValue(r);
+    if (r.pos !== buf.length) throw new RangeError('MessagePack: trailing bytes');
+    return value;
+}
@@ -24,6 +24,7 @@ const SessionSchema = new Schema({
     },
     trustScore: { type: Number, default: 100 },
     intentGraph: { type: Schema.Types.Mixed, default: {} }, // JSON object of the graph
+    graphVersion: { type: Number, default: null }, // Defense service's graph version (delta protocol)
     createdAt: { type: Date, default: Date.now },
 });
 
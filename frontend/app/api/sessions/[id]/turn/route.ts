@@ -6,7 +6,7 @@ import Turn from '@backend/models/Turn';
 import Policy from '@backend/models/Policy';
 import Alert from '@backend/models/Alert';
 import { requireAuth } from '@backend/lib/auth';
-import { callDefenseService } from '@backend/lib/defenseClient';
+import { analyzeWithPolicy, needsGraphResync, noteGraphStore, serverGraphMode } from '@backend/lib/defenseClient';
 
 export async function POST(req: Request, { params }: { params: Promise<{ id: string }> }) {
     console.log('[turn/POST] ===== NEW TURN REQUEST =====');
@@ -32,11 +32,16 @@ export async function POST(req: Request, { params }: { params: Promise<{ id: str
             };
 
         // 2. Call Defense Service (with fallback to simulated if OpenAI key/quota fails)
-        const payload = {
+        // When the service's graph store is shared by its workers it holds the intent graph (graphMode
+        // "server"): the full graph is sent only when it has no copy at our version, and the response
+        // carries just the new history node (graphDelta). Otherwise the graph goes inline every turn.
+        const intentGraph = session.intentGraph ?? { goal: session.toolType, allowed: [], forbidden: [], history: [] };
+        const serverGraph = serverGraphMode();
+        const payload: Record<string, unknown> = {
             userText,
-            intentGraph: session.intentGraph ?? { goal: session.toolType, allowed: [], forbidden: [], history: [] },
+            ...(serverGraph ? { graphMode: 'server' } : {}),
+            ...(serverGraph && session.graphVersion != null ? { graphVersion: session.graphVersion } : { intentGraph }),
             defenseMode: session.defenseMode,
-            policy: policyPayload,
             modelType: session.modelType,
             sessionId: sessionId
         };
@@ -47,7 +52,12 @@ export async function POST(req: Request, { params }: { params: Promise<{ id: str
         let defenseResponse: any;
         try {
             console.log('[turn/POST] Attempting defense service call...');
-            defenseResponse = await callDefenseService('/analyze', payload);
+            // The policy is registered once and referenced by policyId (see defenseClient.ts)
+            defenseResponse = await analyzeWithPolicy(payload, policyPayload).catch((error: unknown) => {
+                if (!needsGraphResync(error)) throw error;
+                return analyzeWithPolicy({ ...payload, graphVersion: undefined, intentGraph }, policyPayload);
+            });
+            noteGraphStore(defenseResponse);
             console.log('[turn/POST] Defense service call SUCCESS');
             console.log(`[turn/POST] Response: action=${defenseResponse.action}, riskLevel=${defenseResponse.riskLevel}, divergence=${defenseResponse.divergence_score}`);
         } catch (firstError: unknown) {
@@ -84,7 +94,16 @@ export async function POST(req: Request, { params }: { params: Promise<{ id: str
 
 
         // 3. Update Session State (Intent Graph & Trust Score)
-        session.intentGraph = defenseResponse.updatedGraph;
+        const delta = defenseResponse.graphDelta;
+        if (delta) {
+            session.intentGraph = { ...intentGraph, ...delta.changed, history: [...(intentGraph.history ?? []), delta.node] };
+            session.graphVersion = delta.version;
+            defenseResponse.updatedGraph = session.intentGraph;
+        } else {
+            session.intentGraph = defenseResponse.updatedGraph;
+            // Answered inline: the service holds no graph at this version, so seed it again next time
+            session.graphVersion = null;
+        }
 
         // Simple trust score decay logic
         if (defenseResponse.action !== 'unverified' && (defenseResponse.scores?.total ?? 0) > 20) {